@@ -9,16 +9,67 @@
 from carthage import inject, Injector
 import carthage.config
 from . import layout
+from .assets import *
+from .benchmark import *
+from .bulkcopy import *
+from .cache import *
+from .checkpoint import *
 from .cd import *
+from .clone import *
 from .config import *
+from .distribution import *
+from .export import *
+from .guest_channel import *
+from .layers import *
+from .matrix import *
+from .pool import *
 from .qemu import *
+from .remoting import *
+from .profiling import *
+from .scheduler import *
+from .servicing import *
 
 class WindowsSchema(carthage.config.ConfigSchema, prefix='windows'):
     # Where the base windows CD is
     assets_dir: carthage.config.ConfigPath
     #: Where we place large output artificats like the modified windows CD
     image_dir:carthage.config.ConfigPath = '{cache_dir}/windows'
+    #: Size in MiB beyond which least recently used artifacts are removed from the shared asset cache in *image_dir*; 0 disables eviction
+    cache_max_size: int = 100*1024
+    #: How many large artifacts (ISO repacks, driver extraction, CD mastering) may be built at once; 0 for no limit
+    io_concurrency: int = 2
+    #: I/O units available to concurrent installs on this host; each install uses *install_io* of them (1 by default)
+    install_io_capacity: int = 4
+    #: Most installs that may run at once on this host, across all Carthage processes; 0 to be limited only by memory, cpus and I/O
+    max_concurrent_installs: int = 0
+    #: Comma separated formats (``qcow2``, ``raw``) to export each built image in; see :mod:`carthage_windows.export`.  Empty to not export.
+    export_formats: str = ''
+    #: Directory chunk store to which built images and their install media are published; see :mod:`carthage_windows.distribution`.  Unset to not publish.
+    chunk_store: carthage.config.ConfigPath
+    #: Compression of exported qcow2 images: ``zstd``, ``zlib`` or ``none``
+    export_compression: str = 'zstd'
+    #: ``setup`` or ``offline``; see :attr:`WindowsConfig.driver_injection`
+    driver_injection: str = 'setup'
+    #: ``cd`` places OEM payloads on the autounattend CD; ``virtiofs`` serves them to the installing guest from a read-only virtiofs share.  See :attr:`AutoUnattendCd.virtiofs_bootstrap`.
+    payload_transport: str = 'cd'
+    #: Comma separated globs of ``.msu`` and ``.cab`` files in the assets directory to slipstream into the install image; ``{version}`` is replaced by the Windows version.  See :mod:`carthage_windows.servicing`.
+    offline_packages: str = ''
+    #: Use ``io_uring`` for the disks of the install VM; needs libvirt 6.3 and qemu 5.0 or later
+    build_io: bool = False
+    #: Directory, ideally on tmpfs or a fast scratch volume, holding the install disk while an image is built; the disk is converted into *image_dir* once the install finishes.  Unset to install directly into the image.
+    build_scratch_dir: carthage.config.ConfigPath
+    #: Checkpoint installs at phase boundaries and resume from the latest checkpoint whose inputs are unchanged; see :mod:`carthage_windows.checkpoint`.  Layers are not checkpointed.
+    install_checkpoints: bool = False
+    #: Seconds between starting installs, so their boot and file copy phases do not coincide
+    install_stagger: int = 15
 
 @inject(injector=Injector)
 def carthage_plugin(injector):
     injector.add_provider(layout.layout)
+    injector.add_provider(AssetCache)
+    injector.add_provider(AssetCatalog)
+    injector.add_provider(BuildProfile)
+    injector.add_provider(WindowsConfigBuilder)
+    injector.add_provider(InstallScheduler)
+    injector.add_provider(PullCommand)
+    injector.add_provider(BenchmarkCommand)
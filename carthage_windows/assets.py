@@ -0,0 +1,127 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+An index of the files in the assets directory (see :func:`~carthage_windows.config.assets_path`).
+
+The assets directory is often on NFS and may hold many versions of each asset.  :class:`AssetCatalog` lists it once and afterwards only stats the directory; the listing is refreshed when the directory's modification time changes, which happens whenever a file is added, removed or renamed.
+
+'''
+
+import dataclasses
+import fnmatch
+import logging
+import os
+import re
+from pathlib import Path
+from carthage import *
+from .fingerprint import file_digest
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+def version_key(name:str):
+    '''
+    :returns: A key ordering *name* by the numbers in it, so ``virtio-win-0.1.262.iso`` sorts after ``virtio-win-0.1.96.iso``.
+    '''
+    return tuple(int(n) for n in re.findall(r'\d+', name))
+
+__all__ += ['version_key']
+
+@inject(
+    carthage_windows=InjectionKey(CarthagePlugin, name='carthage-windows'),
+    injector=Injector)
+def assets_path(*, carthage_windows, injector) -> Path:
+    '''
+    :returns: The assets directory: *windows.assets_dir*/windows if configured, otherwise the assets bundled with the plugin.
+    '''
+    config = injector(ConfigLayout)
+    if assets_dir := config.windows.assets_dir:
+        return Path(assets_dir)/'windows'
+    return carthage_windows.resource_dir/'assets'
+
+__all__ += ['assets_path']
+
+@dataclasses.dataclass(frozen=True)
+class Asset:
+
+    path: Path
+    size: int
+    mtime_ns: int
+
+    @property
+    def name(self):
+        return self.path.name
+
+    @property
+    def version(self):
+        return version_key(self.name)
+
+    def digest(self) -> str:
+        '''
+        :returns: The sha256 of the asset; computed once and remembered as described in :func:`~carthage_windows.fingerprint.file_digest`.
+        '''
+        return file_digest(self.path)
+
+__all__ += ['Asset']
+
+@inject_autokwargs(injector=Injector)
+class AssetCatalog(Injectable):
+
+    '''
+    Query the assets directory::
+
+        catalog.newest('virtio-win-*.iso')
+
+    Only files directly within the assets directory are indexed.
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.root = None
+        self.root_mtime = None
+        self.assets: dict[str, Asset] = {}
+
+    def refresh(self):
+        root = self.injector(assets_path)
+        try:
+            mtime = os.stat(root).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if root == self.root and mtime == self.root_mtime: return
+        assets = {}
+        if mtime is not None:
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if not entry.is_file(): continue
+                    stat = entry.stat()
+                    assets[entry.name] = Asset(
+                        path=Path(entry.path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        logger.debug('Indexed %d assets in %s', len(assets), root)
+        self.root, self.root_mtime, self.assets = root, mtime, assets
+
+    def find(self, pattern:str) -> list[Asset]:
+        '''
+        :returns: The assets whose names match the glob *pattern*, newest version first.
+        '''
+        self.refresh()
+        results = [a for name, a in self.assets.items() if fnmatch.fnmatchcase(name, pattern)]
+        results.sort(key=lambda a: (a.version, a.mtime_ns, a.name), reverse=True)
+        return results
+
+    def newest(self, pattern:str) -> Asset|None:
+        '''
+        :returns: The newest version of the asset matching *pattern*, or None.
+        '''
+        results = self.find(pattern)
+        if len(results) > 1:
+            logger.debug('Using %s; also found %s', results[0].name, ', '.join(a.name for a in results[1:]))
+        return results[0] if results else None
+
+__all__ += ['AssetCatalog']
@@ -0,0 +1,252 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Benchmark the host side of the image build pipeline without Windows media or libvirt.
+
+:func:`run_benchmark` generates a synthetic install ISO and virtio ISO of the size and file count given by a :class:`BenchmarkSpec`, then runs the real pipeline against them in a scratch directory: ``extract_cd``, the noprompt repack, virtio driver extraction, plugin application and autounattend CD mastering, including its payload copy.  None of these stages touch libvirt or a guest, so no stand-in for either is needed; the install itself is not measured.
+
+The result records the wall time of each stage, its throughput where the stage reports the bytes it produced, the peak disk usage of the scratch directory and the total wall time.  Results are JSON; :func:`compare` checks a result against a stored baseline::
+
+    carthage-runner windows-benchmark --size-mb 2048 --files 5000 --output result.json --baseline baseline.json
+
+'''
+
+import asyncio
+import contextlib
+import dataclasses
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from carthage import *
+from carthage import files
+from carthage.console import CarthageRunnerCommand
+from .assets import AssetCatalog
+from .cache import AssetCache
+from .cd import AutoUnattendCd, NoPromptInstallImage, extract_cd
+from .config import *
+from .profiling import BuildProfile, tree_size
+from .qemu import QemuDrivers
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+@dataclasses.dataclass
+class BenchmarkSpec:
+
+    #: Size of the synthetic install ISO
+    iso_size_mb: int = 512
+    #: Files on the synthetic install ISO; one large ``install.wim`` holds most of the data
+    iso_files: int = 2000
+    #: Files in each driver directory of the synthetic virtio ISO
+    driver_files: int = 20
+    windows_version: str = 'w11'
+    seed: int = 0
+
+__all__ += ['BenchmarkSpec']
+
+def make_tree(root:Path, total_bytes:int, count:int, rand:random.Random):
+    '''
+    Fill *root* with *count* files of pseudo-random data: half of *total_bytes* in ``sources/install.wim`` and the rest spread over the other files.
+    '''
+    block = rand.randbytes(1024**2)
+    def write(path, size):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('wb') as f:
+            while size > 0:
+                f.write(block[:min(size, len(block))])
+                size -= len(block)
+    write(root/'sources/install.wim', total_bytes//2)
+    small = max(count-1, 1)
+    for i in range(small):
+        write(root/f'sources/dir{i%50}/file{i}.dll', (total_bytes//2)//small)
+
+__all__ += ['make_tree']
+
+async def make_install_iso(assets:Path, spec:BenchmarkSpec) -> Path:
+    rand = random.Random(spec.seed)
+    # A name matching the install ISO pattern for the version
+    pattern = NoPromptInstallImage.base_cd_patterns[spec.windows_version]
+    builder = files.CdContext(assets, pattern.replace('[Ss]', 'S').replace('*', '_'))
+    async with builder as contents:
+        make_tree(contents, spec.iso_size_mb*1024**2, spec.iso_files, rand)
+        for boot_file in ('boot/etfsboot.com', 'efi/microsoft/boot/efisys_noprompt.bin'):
+            contents.joinpath(boot_file).parent.mkdir(parents=True, exist_ok=True)
+            contents.joinpath(boot_file).write_bytes(rand.randbytes(4096))
+    return builder.iso_path
+
+async def make_virtio_iso(assets:Path, spec:BenchmarkSpec) -> Path:
+    rand = random.Random(spec.seed+1)
+    builder = files.CdContext(assets, 'virtio-win-0.0.1.iso')
+    async with builder as contents:
+        for driver in QemuDrivers.drivers:
+            for version in ('w10', spec.windows_version):
+                driver_dir = contents/driver/version/'amd64'
+                driver_dir.mkdir(parents=True, exist_ok=True)
+                for i in range(spec.driver_files):
+                    driver_dir.joinpath(f'{driver}{i}.sys').write_bytes(rand.randbytes(64*1024))
+        for msi in QemuDrivers.oem_msis:
+            contents.joinpath(msi).parent.mkdir(parents=True, exist_ok=True)
+            contents.joinpath(msi).write_bytes(rand.randbytes(1024**2))
+    return builder.iso_path
+
+class DiskSampler:
+
+    '''
+    Track the peak size of a directory tree while the context is active.
+    '''
+
+    def __init__(self, path:Path, interval=0.2):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+
+    async def sample(self):
+        while True:
+            size, _ = await asyncio.to_thread(tree_size, self.path)
+            self.peak = max(self.peak, size)
+            await asyncio.sleep(self.interval)
+
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(self.sample())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.task.cancel()
+        size, _ = tree_size(self.path)
+        self.peak = max(self.peak, size)
+        return False
+
+@contextlib.contextmanager
+def scratch_config(config, work:Path):
+    '''
+    Point the state, image and assets directories of *config* at *work* for the duration of the context.
+    '''
+    saved = (config.state_dir, config.windows.image_dir, config.windows.assets_dir)
+    config.state_dir = str(work/'state')
+    config.windows.image_dir = str(work/'images')
+    config.windows.assets_dir = str(work/'assets')
+    try:
+        yield
+    finally:
+        config.state_dir, config.windows.image_dir, config.windows.assets_dir = saved
+
+@inject(injector=Injector)
+async def run_benchmark(spec:BenchmarkSpec=None, *, injector, work_dir=None) -> dict:
+    '''
+    Run the pipeline once against synthetic media.
+
+    :param work_dir: Scratch directory, which should be on the filesystem that will hold *windows.image_dir*.  By default a temporary directory, removed afterwards.
+    '''
+    spec = spec or BenchmarkSpec()
+    with contextlib.ExitStack() as stack:
+        if work_dir is None:
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='carthage_windows_bench_'))
+        work = Path(work_dir)
+        assets = work/'assets/windows'
+        assets.mkdir(parents=True)
+        generate_start = time.time()
+        iso, _ = await asyncio.gather(make_install_iso(assets, spec), make_virtio_iso(assets, spec))
+        generate_time = time.time()-generate_start
+
+        config = injector(ConfigLayout)
+        stack.enter_context(scratch_config(config, work))
+        bench_injector = injector(Injector)
+        for cls in (AssetCache, AssetCatalog, BuildProfile, WindowsConfigBuilder,
+                    NoPromptInstallImage, AutoUnattendCd, QemuDrivers):
+            bench_injector.add_provider(cls)
+        bench_injector.add_provider(windows_version_key, spec.windows_version)
+        ainjector = bench_injector(AsyncInjector)
+        profile = await ainjector.get_instance_async(BuildProfile)
+
+        start = time.time()
+        async with DiskSampler(work) as sampler:
+            async with profile.stage('extract_cd', iso=iso.name) as stage, \
+                       extract_cd(str(iso), work/'extract') as extracted:
+                stage.bytes, stage.files = tree_size(extracted)
+            await ainjector.get_instance_async(NoPromptInstallImage)
+            await ainjector.get_instance_async(QemuDrivers)
+            async with profile.stage('plugin_apply'):
+                await WindowsConfigBuilder().build(WindowsConfig(spec.windows_version), ainjector)
+            await ainjector.get_instance_async(AutoUnattendCd)
+        wall_time = time.time()-start
+
+        stages = {}
+        for s in profile.stages:
+            if s.category != 'host': continue
+            stages[s.name] = dict(
+                duration=s.duration,
+                bytes=s.bytes,
+                files=s.files,
+                throughput_mb_s=(s.bytes/1024**2/s.duration) if s.bytes and s.duration else None)
+        shutil.rmtree(work/'state', ignore_errors=True)
+        return dict(
+            spec=dataclasses.asdict(spec),
+            generate_time=generate_time,
+            wall_time=wall_time,
+            peak_disk_bytes=sampler.peak,
+            stages=stages,
+            host=dict(cpus=os.cpu_count(), node=os.uname().nodename),
+            timestamp=time.time(),
+            )
+
+__all__ += ['run_benchmark']
+
+def compare(result:dict, baseline:dict, tolerance=0.2) -> list[str]:
+    '''
+    :returns: A description of each stage (and of total wall time and peak disk usage) more than *tolerance* worse in *result* than in *baseline*.
+    '''
+    regressions = []
+    def check(name, value, base):
+        if base and value > base*(1+tolerance):
+            regressions.append(f'{name}: {value:.2f} vs {base:.2f} baseline ({(value/base-1)*100:+.0f}%)')
+    check('wall_time', result['wall_time'], baseline.get('wall_time'))
+    check('peak_disk_bytes', result['peak_disk_bytes'], baseline.get('peak_disk_bytes'))
+    for name, stage in result['stages'].items():
+        if base := baseline.get('stages', {}).get(name):
+            check(name, stage['duration'], base['duration'])
+    return regressions
+
+__all__ += ['compare']
+
+class BenchmarkCommand(CarthageRunnerCommand):
+
+    name = 'windows-benchmark'
+
+    subparser_kwargs = dict(help='Benchmark the Windows image pipeline against synthetic media')
+
+    def setup_subparser(self, parser):
+        parser.add_argument('--size-mb', type=int, default=BenchmarkSpec.iso_size_mb, help='Size of the synthetic install ISO')
+        parser.add_argument('--files', type=int, default=BenchmarkSpec.iso_files, help='Files on the synthetic install ISO')
+        parser.add_argument('--work-dir', help='Scratch directory; should be on the filesystem holding windows.image_dir')
+        parser.add_argument('--output', help='Write the result as JSON')
+        parser.add_argument('--baseline', help='Compare against a stored result')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown relative to the baseline')
+
+    async def run(self, args):
+        spec = BenchmarkSpec(iso_size_mb=args.size_mb, iso_files=args.files)
+        result = await self.ainjector(run_benchmark, spec, work_dir=args.work_dir)
+        for name, stage in result['stages'].items():
+            throughput = f"{stage['throughput_mb_s']:.0f} MiB/s" if stage['throughput_mb_s'] else ''
+            print(f"{name:30} {stage['duration']:8.2f}s {throughput}")
+        print(f"{'total':30} {result['wall_time']:8.2f}s peak disk {result['peak_disk_bytes']//1024**2} MiB")
+        if args.output:
+            Path(args.output).write_text(json.dumps(result, indent=2))
+        if args.baseline:
+            regressions = compare(result, json.loads(Path(args.baseline).read_text()), args.tolerance)
+            for r in regressions:
+                print('REGRESSION', r)
+            return 1 if regressions else 0
+
+__all__ += ['BenchmarkCommand']
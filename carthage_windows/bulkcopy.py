@@ -0,0 +1,137 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+In-process copying of batches of files, used instead of one rsync process per file.
+'''
+
+import asyncio
+import concurrent.futures
+import dataclasses
+import fcntl
+import logging
+import os
+import shutil
+from pathlib import Path
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+#: From linux/fs.h
+FICLONE = 0x40049409
+
+def _clone(src, dest, link=True) -> str:
+    '''
+    Make *dest* share the contents of *src* as cheaply as the filesystems allow.
+    :param link: Allow a hardlink.  A hardlink shares the inode, so a later in-place change to either file changes both; a reflink or copy does not.
+    :returns: how: ``link``, ``reflink``, or ``copy``
+    '''
+    if link:
+        try:
+            os.link(src, dest)
+            return 'link'
+        except OSError: pass
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            how = 'reflink'
+        except OSError:
+            how = 'copy'
+            try:
+                remaining = os.fstat(s.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                    if copied == 0: break
+                    remaining -= copied
+            except OSError:
+                s.seek(0)
+                d.seek(0)
+                d.truncate()
+                shutil.copyfileobj(s, d, 1<<20)
+    shutil.copystat(src, dest)
+    return how
+
+def clone_file(src, dest, *, link=True):
+    '''
+    Make *dest* share the contents of *src*: a hardlink if possible (and *link* is true), otherwise a reflink, otherwise a copy (with :func:`os.copy_file_range` where supported).  Suitable as a *copy_function* for :func:`shutil.copytree`.
+    '''
+    _clone(src, dest, link)
+    return dest
+
+__all__ += ['clone_file']
+
+@dataclasses.dataclass
+class CopyStats:
+
+    #: Files placed
+    files: int = 0
+    #: Bytes in those files
+    bytes: int = 0
+    #: Files that share storage with their source (hardlinked or reflinked) rather than being copied
+    shared: int = 0
+
+__all__ += ['CopyStats']
+
+def _plan(items):
+    '''
+    Expand *items* into directories to create and (source, destination) file pairs.
+    '''
+    dirs = []
+    files = {}
+    for src, dest_dir in items:
+        src_str = str(src)
+        src = Path(src)
+        dest_dir = Path(dest_dir)
+        if not src.is_dir():
+            dirs.append(dest_dir)
+            files[dest_dir/src.name] = src
+            continue
+        # rsync semantics: a trailing slash copies the contents of the directory
+        dest_root = dest_dir if src_str.endswith('/') else dest_dir/src.name
+        dirs.append(dest_root)
+        for root, subdirs, filenames in os.walk(src):
+            rel = Path(root).relative_to(src)
+            for d in subdirs:
+                dirs.append(dest_root/rel/d)
+            for f in filenames:
+                files[dest_root/rel/f] = Path(root)/f
+    # Later items replace earlier ones with the same destination
+    return dirs, [(src, dest) for dest, src in files.items()]
+
+async def bulk_copy(items, *, max_workers=8, link=True) -> CopyStats:
+    '''
+    Copy a batch of files and directories in one call.
+
+    :param items: An iterable of *(source, destination_directory)*.  As with ``rsync -a``, a directory source is copied to *destination_directory*/name, unless the source ends in ``/`` in which case its contents are copied into *destination_directory*.
+
+    Files are hardlinked where possible, otherwise reflinked, otherwise copied; the work happens in a thread pool.  Destination files that already exist are replaced.
+
+    :param link: Allow hardlinks.  Pass False when the destination must not change if a source is later modified in place, for example when building an :class:`~carthage_windows.cache.AssetCache` artifact.
+
+    '''
+    dirs, files = _plan(items)
+    for d in dirs:
+        d.mkdir(parents=True, exist_ok=True)
+    stats = CopyStats()
+    def copy_one(pair):
+        src, dest = pair
+        dest.unlink(missing_ok=True)
+        return _clone(src, dest, link), src.stat().st_size
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = await asyncio.gather(*(
+            loop.run_in_executor(executor, copy_one, pair) for pair in files))
+    for how, size in results:
+        stats.files += 1
+        stats.bytes += size
+        if how != 'copy': stats.shared += 1
+    logger.debug('Copied %d files (%d bytes, %d shared)', stats.files, stats.bytes, stats.shared)
+    return stats
+
+__all__ += ['bulk_copy']
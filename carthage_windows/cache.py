@@ -0,0 +1,179 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+A content addressed cache of build artifacts shared by every layout (and every Carthage process) using the same *windows.image_dir*.
+
+Artifacts are keyed by a :class:`~carthage_windows.fingerprint.Fingerprint` of their inputs, typically the sha256 of an input ISO plus the parameters of the transform applied to it.  Consumers receive hardlinks (or reflinks, or as a last resort copies) of cached artifacts, so the artifact is built once per host no matter how many layouts use it.
+
+A hardlink shares the artifact's inode, so an in-place change through any link would change the artifact under an unchanged key.  Builds therefore never hardlink their inputs into an artifact (see the *link* parameter of :func:`~carthage_windows.bulkcopy.clone_file`), stored artifacts are made read-only, and consumers that need to write receive a reflink or copy.
+
+'''
+
+import asyncio
+import contextlib
+import errno
+import fcntl
+import functools
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from carthage import *
+from .bulkcopy import clone_file
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+def link_out(src:Path, dest:Path, *, writable=False):
+    '''
+    Replace *dest* with a :func:`clone <clone_file>` of *src*, which may be a file or directory.
+
+    :param writable: *dest* will be modified, so it must not be a hardlink of *src*; it is reflinked or copied and made writable.
+    '''
+    if dest.is_dir() and not dest.is_symlink():
+        shutil.rmtree(dest)
+    else:
+        dest.unlink(missing_ok=True)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    clone = functools.partial(clone_file, link=not writable)
+    if src.is_dir():
+        shutil.copytree(src, dest, copy_function=clone)
+    else:
+        clone(src, dest)
+    if writable:
+        _set_mode(dest, 0o644)
+
+__all__ += ['link_out']
+
+def _set_mode(path:Path, mode):
+    '''
+    Set the mode of *path*, or of every file under it if it is a directory.  Directories stay writable so the entry can be removed.
+    '''
+    if not path.is_dir():
+        os.chmod(path, mode)
+        return
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            os.chmod(os.path.join(root, f), mode)
+
+def _entry_size(path:Path):
+    if not path.is_dir():
+        return path.stat().st_size
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size += os.stat(os.path.join(root, f)).st_size
+    return size
+
+@inject_autokwargs(config_layout=ConfigLayout)
+class AssetCache(Injectable):
+
+    '''
+    A shared cache of artifacts under *windows.image_dir*/cache.
+
+    * Each artifact is stored under ``objects/<key>``.  Artifacts are immutable once stored; their files are made read-only.
+
+    * A lock file per key (``locks/<key>.lock``) serializes building an artifact, so concurrent Carthage runs that need the same artifact build it once and share the result.
+
+    * At most *windows.io_concurrency* artifacts are built at once by a given cache instance.
+
+    * The modification time of an artifact records when it was last used.  When the cache grows beyond *windows.cache_max_size* MiB, least recently used artifacts are removed.  Artifacts that have been linked out stay on disk until their last link is removed.
+
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.path = Path(self.config_layout.windows.image_dir)/'cache'
+        self.max_size = self.config_layout.windows.cache_max_size*1024**2
+        if io_concurrency := self.config_layout.windows.io_concurrency:
+            self.io_slots = asyncio.Semaphore(io_concurrency)
+        else:
+            self.io_slots = contextlib.nullcontext()
+        for d in ('objects', 'locks', 'tmp'):
+            self.path.joinpath(d).mkdir(parents=True, exist_ok=True)
+
+    def object_path(self, key) -> Path:
+        return self.path/'objects'/key
+
+    @contextlib.asynccontextmanager
+    async def locked(self, key):
+        '''
+        Hold the lock for *key*.  The lock is taken in a thread so waiting for another process does not block the event loop.
+        '''
+        fd = os.open(self.path/'locks'/f'{key}.lock', os.O_RDWR|os.O_CREAT, 0o644)
+        try:
+            await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    async def fetch(self, key:str, build, dest:Path=None, *, limit_io=True, writable=False) -> Path:
+        '''
+        Return the cached artifact for *key*, building it if needed.
+
+        :param build: An async function called with a path that does not yet exist; it must create the artifact (a file or directory) at that path.
+
+        :param dest: If supplied, *dest* is replaced with a link to the artifact.
+
+        :param writable: *dest* will be modified, so it receives a reflink or copy rather than a hardlink; see :func:`link_out`.
+
+        :param limit_io: If true, *build* counts against *windows.io_concurrency*.  Builds that mostly wait on something else, such as a VM install, should pass False.
+
+        '''
+        obj = self.object_path(key)
+        async with self.locked(key):
+            if obj.exists():
+                logger.debug('Using cached artifact %s', key)
+            else:
+                with tempfile.TemporaryDirectory(dir=self.path/'tmp', prefix=key[:16]) as tmp:
+                    output = Path(tmp)/'output'
+                    async with self.io_slots if limit_io else contextlib.nullcontext():
+                        await build(output)
+                    await asyncio.to_thread(_set_mode, output, 0o444)
+                    output.rename(obj)
+            os.utime(obj)
+            if dest is not None:
+                await asyncio.to_thread(link_out, obj, Path(dest), writable=writable)
+        await asyncio.to_thread(self.evict, keep=key)
+        return obj
+
+    def evict(self, keep=None):
+        '''
+        Remove least recently used artifacts until the cache is below its size limit.  Artifacts that are locked by another process and *keep* are never removed.
+        '''
+        if not self.max_size: return
+        entries = []
+        for obj in self.path.joinpath('objects').iterdir():
+            entries.append((obj.stat().st_mtime, _entry_size(obj), obj))
+        total = sum(e[1] for e in entries)
+        entries.sort()
+        for mtime, size, obj in entries:
+            if total <= self.max_size: break
+            if obj.name == keep: continue
+            fd = os.open(self.path/'locks'/f'{obj.name}.lock', os.O_RDWR|os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    continue
+                raise
+            try:
+                logger.info('Evicting %s from the windows asset cache', obj.name)
+                if obj.is_dir():
+                    shutil.rmtree(obj)
+                else:
+                    obj.unlink()
+                total -= size
+            finally:
+                os.close(fd)
+
+__all__ += ['AssetCache']
@@ -6,31 +6,108 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
 # LICENSE for details.
 
+import asyncio
 import contextlib
+import dataclasses
+import fnmatch
+import json
+import logging
+import os
 import shutil
+import tempfile
+import time
+import uuid
+import xml.etree.ElementTree as ET
 from pathlib import Path
 import carthage
+import carthage.vm
 from carthage import *
 from carthage.modeling import *
 from carthage import files
 from carthage import sh
 from carthage.plugins import CarthagePlugin
 from .config import *
+from .assets import AssetCatalog, assets_path
+from .bulkcopy import bulk_copy
+from .checkpoint import InstallCheckpoints, checkpoint_drive, checkpoint_powershell, phase_launcher
+from .cache import AssetCache
+from .fingerprint import Fingerprint, stat_digest
+from .distribution import publish
+from .export import export_image
+from .guest_channel import GuestChannel, InstallFailed, Scriptlet, monitored_script, send_event
+from .profiling import BuildProfile, Stage, profiled_mako_task, tree_size
+from .scheduler import InstallScheduler
+from .servicing import find_offline_packages, offline_package_assets, package_dir, slipstream
 
 __all__ = []
 
+logger = logging.getLogger('carthage_windows')
+
+def member_selected(member:str, patterns) -> bool:
+    '''
+    :returns: True if *member* (a path within a CD) is selected by any of *patterns*.  A pattern is a path or glob; a pattern naming a directory selects everything beneath it.
+    '''
+    for pattern in patterns:
+        pattern = pattern.strip('/')
+        if fnmatch.fnmatchcase(member, pattern) or fnmatch.fnmatchcase(member, pattern+'/*'):
+            return True
+    return False
+
+async def list_cd(iso_file) -> list[str]:
+    '''
+    :returns: the paths of the files (not directories) on *iso_file*.  Only the directory records are read.
+    '''
+    sevenzip = getattr(carthage.sh, '7z')
+    result = await sevenzip('l', '-slt', '--', str(iso_file), _bg=True, _bg_exc=False)
+    members = []
+    path = None
+    for line in str(result.stdout, 'utf-8').splitlines():
+        if line.startswith('Path = '):
+            path = line[7:]
+        elif line == 'Folder = -' and path:
+            members.append(path)
+    # The first Path is the archive itself and has no Folder line.
+    return members
+
 @contextlib.asynccontextmanager
-async def extract_cd(iso_file:str, out_dir:Path) -> Path:
+async def extract_cd(iso_file:str, out_dir:Path, members=None) -> Path:
     '''
     Returns a path of the directory containing the contents of the CD.
     Perhaps by extracting; perhaps by mounting.
     Will be deleted/unmounted when the context exits
     :param out_dir: an output directory that will be created if it does not exist and will be claned on context exit.
+    :param members: If supplied, a list of paths or globs (see :func:`member_selected`); only matching files are read from the CD.  Paths are preserved relative to *out_dir*, so callers can move members out of *out_dir* rather than copying them; a rename only succeeds if the destination is on the filesystem of *out_dir*.
     '''
     out_dir.mkdir(parents=True, exist_ok=True)
     if sevenzip := getattr(carthage.sh, '7z', None):
         try:
-            await sevenzip('x', '-o'+str(out_dir), '--', iso_file)
+            if members is None:
+                await sevenzip('x', '-o'+str(out_dir), '--', iso_file)
+            else:
+                selected = [m for m in await list_cd(iso_file) if member_selected(m, members)]
+                if selected:
+                    with tempfile.NamedTemporaryFile('wt', dir=out_dir.parent, prefix='members_') as listfile:
+                        listfile.write(''.join(m+'\n' for m in selected))
+                        listfile.flush()
+                        await sevenzip('x', '-o'+str(out_dir), '-i@'+listfile.name, '--', iso_file)
+            yield Path(out_dir)
+        finally:
+            shutil.rmtree(out_dir)
+    elif members is not None:
+        with tempfile.TemporaryDirectory(dir=out_dir.parent, prefix='mount_') as mount_dir:
+            await carthage.sh.mount(
+                '-oloop,ro',
+                iso_file, mount_dir)
+            try:
+                for root, dirs, files in os.walk(mount_dir):
+                    for f in files:
+                        member = str(Path(root, f).relative_to(mount_dir))
+                        if not member_selected(member, members): continue
+                        out_dir.joinpath(member).parent.mkdir(parents=True, exist_ok=True)
+                        shutil.copy2(Path(root, f), out_dir/member)
+            finally:
+                await carthage.sh.umount(mount_dir)
+        try:
             yield Path(out_dir)
         finally:
             shutil.rmtree(out_dir)
@@ -42,23 +119,105 @@ async def extract_cd(iso_file:str, out_dir:Path) -> Path:
             yield out_dir
         finally:
             await carthage.sh.umount(out_dir)
-            
+
+def entry_subdir(subdir, matrix_entry):
+    '''
+    :returns: *subdir*, made unique to *matrix_entry* if it is not None.
+    '''
+    if matrix_entry is None: return subdir
+    return f'{subdir}/{matrix_entry.name}'
+
+class IsoOverlayContext:
+
+    '''
+    Like :class:`carthage.files.CdContext`, but rather than mastering a CD from a directory, produce a modified copy of an existing ISO.  xorriso reads the directory records of *source_iso* and copies unchanged file extents directly into the output; neither extraction nor a loop mount is required.  Typical usage::
+
+        async with IsoOverlayContext(source, output_dir, 'out.iso', *commands) as overlay_dir:
+            # Files written under overlay_dir are added to (or replace files in) the output image
+
+    :param commands: xorriso commands (for example ``-boot_image``) applied to the loaded image before it is written.
+
+    '''
+
+    def __init__(self, source_iso, path, iso_name, *commands):
+        self.source_iso = Path(source_iso)
+        self.path = Path(path)
+        self.iso_name = iso_name
+        self.commands = commands
+        self.temp = None
+        assert '/' not in self.iso_name
+
+    @property
+    def iso_path(self) -> Path:
+        return self.path/self.iso_name
+
+    async def __aenter__(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.temp = tempfile.TemporaryDirectory(dir=self.path, prefix='isooverlay_', suffix=self.iso_name)
+        return Path(self.temp.name)
+
+    async def __aexit__(self, *exc_info):
+        try:
+            if exc_info[0] is not None: return
+            iso_temp = self.path/(self.iso_name+'.tmp')
+            iso_temp.unlink(missing_ok=True)
+            overlay = []
+            if any(Path(self.temp.name).iterdir()):
+                overlay = ['-map', self.temp.name, '/']
+            try:
+                await sh.xorriso(
+                    '-indev', str(self.source_iso),
+                    '-outdev', str(iso_temp),
+                    *overlay,
+                    *self.commands,
+                    '-commit',
+                    _bg=True, _bg_exc=False)
+            except sh.ErrorReturnCode as e:
+                iso_temp.unlink(missing_ok=True)
+                raise RuntimeError(str(e.stderr, 'utf-8'))
+            iso_temp.rename(self.iso_path)
+        finally:
+            self.temp.cleanup()
+
+__all__ += ['IsoOverlayContext']
+
 @inject_autokwargs(
     carthage_windows=InjectionKey(CarthagePlugin, name='carthage-windows'),
+    asset_cache=AssetCache,
+    asset_catalog=AssetCatalog,
+    build_profile=BuildProfile,
+    windows_version=windows_version_key,
+    matrix_entry=InjectionKey(MatrixEntry, _optional=True),
     )
 class NoPromptInstallImage(SetupTaskMixin):
 
-    stamp_subdir = 'carthage_windows/no_prompt_install'
+    @property
+    def stamp_subdir(self):
+        return entry_subdir('carthage_windows/no_prompt_install', self.matrix_entry)
+
+    #: Globs matching the install image for each windows version in the assets directory; the newest version is used.
+    base_cd_patterns = {
+        'w10': 'Win10*.iso',
+        'w11': 'Win11*.iso',
+        '2k19': '*[Ss]erver*2019*.iso',
+        '2k22': '*[Ss]erver*2022*.iso',
+        '2k25': '*[Ss]erver*2025*.iso',
+    }
+
+    @property
+    def base_cd_pattern(self):
+        if self.matrix_entry and self.matrix_entry.iso_pattern:
+            return self.matrix_entry.iso_pattern
+        try:
+            return self.base_cd_patterns[self.windows_version]
+        except KeyError:
+            raise ValueError(f'No install image pattern known for {self.windows_version}; set iso_pattern') from None
 
     def find_base_cd(self):
-        if assets_dir := self.config_layout.windows.assets_dir:
-            assets_path = Path(assets_dir)/'windows'
-        else:
-            assets_path = self.carthage_windows.resource_dir/'assets'
-        images = assets_path.glob('Win11*.iso')
-        images_list = list(images)
-        assert len(images_list) == 1, f'Expecting only one image in {assets_path}'
-        return images_list[0]
+        image = self.asset_catalog.newest(self.base_cd_pattern)
+        if image is None:
+            raise FileNotFoundError(f'No {self.base_cd_pattern} in {self.injector(assets_path)}')
+        return image.path
 
     @memoproperty
     def output_path(self):
@@ -87,114 +246,468 @@ class NoPromptInstallImage(SetupTaskMixin):
             qemu_source='file'
         )
 
+    #: How the image is repacked.  In ``overlay`` mode xorriso copies the source image directly into the output and only the boot catalog and any overlay files are rewritten.  In ``extract`` mode the source image is extracted (or loop mounted) and remastered with :attr:`mkisofs_options`; this needs temporary space the size of the ISO.
+    repack_mode = 'overlay'
+
+    #: xorrisofs options used to master the image in extract mode; see https://palant.info/2023/02/13/automating-windows-installation-in-a-vm/
+    mkisofs_options = (
+        '-iso-level', '4',
+        '-disable-deep-relocation',
+        '-untranslated-filenames',
+        '-b', 'boot/etfsboot.com',
+        '-no-emul-boot',
+        '-boot-load-size', '8',
+        '-eltorito-alt-boot',
+        '-eltorito-platform', 'efi',
+        '-b', 'efi/microsoft/boot/efisys_noprompt.bin',
+    )
+
+    #: xorriso commands used in overlay mode; the equivalent of :attr:`mkisofs_options`.
+    overlay_commands = (
+        '-compliance', 'iso_9660_level=3:untranslated_names:deep_paths',
+        '-joliet', 'on',
+        '-boot_image', 'any', 'discard',
+        '-boot_image', 'any', 'cat_hidden=on',
+        '-boot_image', 'any', 'bin_path=/boot/etfsboot.com',
+        '-boot_image', 'any', 'load_size=4096',
+        '-boot_image', 'any', 'next',
+        '-boot_image', 'any', 'efi_path=/efi/microsoft/boot/efisys_noprompt.bin',
+        '-boot_image', 'any', 'platform_id=0xef',
+    )
+
+    async def fingerprint(self):
+        '''
+        A digest of everything that goes into the repacked image.
+        '''
+        fp = Fingerprint()
+        await fp.add_path('source', self.find_base_cd())
+        fp.add('repack_mode', self.repack_mode)
+        for package in await self.offline_packages():
+            fp.add('offline_package', package.source.name, package.digest)
+        if self.repack_mode == 'overlay':
+            fp.add('overlay_commands', *self.overlay_commands)
+        else:
+            fp.add('mkisofs_options', *self.mkisofs_options)
+        return fp.hexdigest()
+
+    async def input_stamp(self):
+        '''
+        A digest of the names, sizes and modification times of what :meth:`fingerprint` covers.  Nothing is read, so this is cheap enough to check whenever an existing image is validated.  Raises :class:`FileNotFoundError` if the install ISO is not present.
+        '''
+        image = self.asset_catalog.newest(self.base_cd_pattern)
+        if image is None:
+            raise FileNotFoundError(f'No {self.base_cd_pattern} in {self.injector(assets_path)}')
+        fp = Fingerprint()
+        fp.add('source', image.name, image.size, image.mtime_ns)
+        fp.add('repack_mode', self.repack_mode, *self.overlay_commands, *self.mkisofs_options)
+        for asset in self.injector(offline_package_assets, self.windows_version):
+            fp.add('offline_package', asset.name, asset.size, asset.mtime_ns)
+        return fp.hexdigest()
+
+    async def offline_packages(self):
+        '''
+        :returns: The :class:`~carthage_windows.servicing.OfflinePackage` list slipstreamed into ``install.wim``; see :mod:`carthage_windows.servicing`.
+        '''
+        return await self.ainjector(find_offline_packages, self.windows_version)
+
+    async def slipstream(self, wim:Path, packages):
+        async with self.build_profile.stage('slipstream', packages=len(packages)) as stage:
+            await slipstream(wim, packages)
+            stage.bytes = wim.stat().st_size
+
+    async def add_overlay(self, overlay_dir:Path):
+        '''
+        Add anything that should be overlayed into the image into *overlay_dir*.  Files in *overlay_dir* replace files of the same name in the source image.
+        '''
+        pass
+
+    async def build_image(self, output:Path):
+        '''
+        Repack the base image into *output*.
+        '''
+        image = self.find_base_cd()
+        packages = await self.offline_packages()
+        async with self.build_profile.stage(
+                'repack_noprompt', iso=image.name, mode=self.repack_mode) as stage:
+            if self.repack_mode == 'overlay':
+                async with IsoOverlayContext(
+                        image, output.parent, output.name,
+                        *self.overlay_commands) as overlay_dir:
+                    if packages:
+                        wim = overlay_dir/'sources/install.wim'
+                        wim.parent.mkdir()
+                        # Extract beside overlay_dir so the WIM is renamed rather than copied; the state directory is often on another filesystem.
+                        extract_dir = overlay_dir.with_name(overlay_dir.name+'_wim')
+                        async with extract_cd(str(image), extract_dir, members=['sources/install.wim']) as extracted:
+                            shutil.move(extracted/'sources/install.wim', wim)
+                        await self.slipstream(wim, packages)
+                    await self.add_overlay(overlay_dir)
+            else:
+                extract_dir = self.state_path/'extract'
+                iso_builder = files.CdContext(
+                    output.parent,
+                    output.name,
+                    *self.mkisofs_options,
+                    # And include the original image contents
+                    extract_dir,
+                    )
+                async with contextlib.AsyncExitStack() as stack:
+                    async with self.build_profile.stage('extract_cd', iso=image.name) as extract_stage:
+                        await stack.enter_async_context(extract_cd(str(image), extract_dir))
+                        extract_stage.bytes, extract_stage.files = tree_size(extract_dir)
+                    if packages:
+                        await self.slipstream(extract_dir/'sources/install.wim', packages)
+                    async with iso_builder as extra_dir:
+                        await self.add_overlay(extra_dir)
+            stage.bytes = output.stat().st_size
+
     @setup_task("Repack without Prompt")
     async def repack_noprompt_image(self):
-# See https://palant.info/2023/02/13/automating-windows-installation-in-a-vm/ for the mkisofs options
-        extract_dir = self.state_path/'extract'
-        image = self.find_base_cd()
-        iso_builder = files.CdContext(
-            self.output_path,
-            (self.image_name).name,
-            '-iso-level', '4',
-            '-disable-deep-relocation',
-            '-untranslated-filenames',
-            '-b', 'boot/etfsboot.com',
-            '-no-emul-boot',
-            '-boot-load-size', '8',
-            '-eltorito-alt-boot',
-                        '-eltorito-platform', 'efi',
-            '-b', 'efi/microsoft/boot/efisys_noprompt.bin',
-            # And include the original image contents
-            extract_dir,
-            )
-        async with extract_cd(str(image), extract_dir):
-            async with iso_builder as extra_dir:
-                # Add anything we want to overlay into the image into extra_dir
-                pass
-
-    @repack_noprompt_image.check_completed()
-    def repack_noprompt_image(self):
-        image = self.find_base_cd()
-        output = self.image_name
-        image_stat = image.stat()
-        if not output.exists(): return False
-        output_stat = output.stat()
-        if output_stat.st_mtime > image_stat.st_mtime:
-            return output_stat.st_mtime
-        return False
+        await self.asset_cache.fetch(
+            await self.fingerprint(), self.build_image, self.image_name)
+
+    @repack_noprompt_image.hash()
+    async def repack_noprompt_image(self):
+        return await self.fingerprint()
+
+    @repack_noprompt_image.invalidator()
+    def repack_noprompt_image(self, **kwargs):
+        return self.image_name.exists()
 
 __all__ += ['NoPromptInstallImage']
         
 
+#: Generalize the running system and shut down.  The unattend file is the ``sysprep=True`` rendering of the template, which the autounattend CD places in ``c:\windows\setup``.
+sysprep_command = 'c:\\windows\\system32\\sysprep\\sysprep /generalize /oobe /shutdown /unattend:c:\\windows\\setup\\sysprep_unattend.xml'
+
+__all__ += ['sysprep_command']
+
+#: Run before :data:`sysprep_command` when :attr:`WindowsConfig.trim_before_generalize` is set
+trim_command = 'Optimize-Volume -DriveLetter C -ReTrim -Verbose'
+
+__all__ += ['trim_command']
+
+#: Run in the specialize pass of a generalized image.  If a CD containing ``carthage-layer\layer.ps1`` is attached (see :class:`carthage_windows.layers.LayerCd`), run it.
+layer_hook_powershell = '''\
+foreach ($drive in Get-PSDrive -PSProvider FileSystem) {
+    $layer = Join-Path $drive.Root 'carthage-layer\\layer.ps1'
+    if (Test-Path $layer) {
+        & $layer
+        break
+    }
+}
+'''
+
+#: With *windows.payload_transport* ``virtiofs``, run at first logon once the bootstrap MSIs are installed.  Wait for the payload share (identified by :data:`payload_marker`) and copy it to ``c:\windows\setup``.
+payload_copy_powershell = '''\
+Start-Service VirtioFsSvc
+$deadline = (Get-Date).AddMinutes(5)
+$share = $null
+while (-not $share) {
+    foreach ($drive in [System.IO.DriveInfo]::GetDrives()) {
+        if (Test-Path (Join-Path $drive.RootDirectory.FullName 'carthage-payloads')) {
+            $share = $drive.RootDirectory.FullName
+        }
+    }
+    if (-not $share) {
+        if ((Get-Date) -gt $deadline) { throw 'The virtiofs payload share did not appear' }
+        Start-Sleep -Seconds 2
+    }
+}
+Copy-Item -Recurse -Force (Join-Path $share '*') c:\\windows\\setup\\ -Exclude carthage-payloads
+'''
+
+#: File at the root of the payload share
+payload_marker = 'carthage-payloads'
+
 @inject_autokwargs(
     carthage_windows=InjectionKey(CarthagePlugin, name='carthage-windows'),
     windows_version=windows_version_key,
+    asset_cache=AssetCache,
+    build_profile=BuildProfile,
+    config_builder=WindowsConfigBuilder,
+    matrix_entry=InjectionKey(MatrixEntry, _optional=True),
     )
 class AutoUnattendCd(SetupTaskMixin):
 
-    stamp_subdir = 'carthage_windows/autounattend_cd'
+    @property
+    def stamp_subdir(self):
+        return entry_subdir('carthage_windows/autounattend_cd', self.matrix_entry)
     
+    #: With *windows.payload_transport* ``virtiofs``, the MSIs that stay on the CD because they provide virtiofs to the guest.  They are installed before anything else at first logon.
+    virtiofs_bootstrap = ('virtio-win-gt-x64.msi', 'winfsp*.msi')
+
+    #: Drive letters the autounattend CD may have in Windows PE.  The offlineServicing pass names driver paths by drive letter, so with ``offline`` driver injection ``$WinPEDriver$`` is listed on each; letters that do not exist are skipped by Setup.
+    driver_drive_letters = 'DEFGH'
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.injector.add_provider(InjectionKey(WindowsConfig), self.build_config)
-        
+
+    @property
+    def offline_driver_paths(self):
+        return [f'{letter}:\\$WinPEDriver$' for letter in self.driver_drive_letters]
+
+    @property
+    def virtiofs_payloads(self):
+        '''
+        True if *windows.payload_transport* is ``virtiofs``: OEM files other than :attr:`virtiofs_bootstrap` are served from :attr:`payload_path` over virtiofs rather than placed on the CD.
+        '''
+        transport = self.config_layout.windows.payload_transport
+        if transport not in ('cd', 'virtiofs'):
+            raise ValueError(f'Unknown payload_transport {transport}')
+        return transport == 'virtiofs'
+
+    @property
+    def payload_path(self):
+        return self.stamp_path/'payloads'
+
+    @property
+    def checkpoints(self):
+        '''
+        True if the install checkpoints at phase boundaries; see :mod:`carthage_windows.checkpoint`.
+        '''
+        return self.config_layout.windows.install_checkpoints
+
+    def on_cd(self, oem_file) -> bool:
+        '''
+        :returns: True if *oem_file* is placed on the CD rather than in the payload share.
+        '''
+        if not self.virtiofs_payloads: return True
+        oem_file = Path(oem_file)
+        return oem_file.is_relative_to(self.stamp_path) or any(
+            fnmatch.fnmatch(oem_file.name, p) for p in self.virtiofs_bootstrap)
+
     async def build_config(self)-> WindowsConfig:
         config = WindowsConfig(self.windows_version)
-        for _, plugin in await self.ainjector.filter_instantiate_async(
-                WinConfigPlugin,
-                ['name']):
-            await plugin.apply(config)
-        return config
-    autounattend_xml = mako_task('autounattend.xml.mako', wconfig=InjectionKey(WindowsConfig), sysprep=False)
-    sysprep_xml = mako_task('autounattend.xml.mako', sysprep=True, wconfig=InjectionKey(WindowsConfig), output='sysprep_unattend.xml')
+        config.driver_injection = self.config_layout.windows.driver_injection
+        if config.driver_injection not in ('setup', 'offline'):
+            raise ValueError(f'Unknown driver_injection {config.driver_injection}')
+        if self.matrix_entry:
+            config.product_key = self.matrix_entry.product_key
+        config.offline_packages = await self.ainjector(find_offline_packages, self.windows_version)
+        return await self.config_builder.build(config, self.ainjector)
+    autounattend_xml = profiled_mako_task('autounattend.xml.mako', wconfig=InjectionKey(WindowsConfig), sysprep=False)
+    sysprep_xml = profiled_mako_task('autounattend.xml.mako', sysprep=True, wconfig=InjectionKey(WindowsConfig), output='sysprep_unattend.xml')
     
 
+    def prepare_config(self, wconfig:WindowsConfig) -> WindowsConfig:
+        '''
+        Return a copy of *wconfig* with the settings that are implemented as scriptlets (sshd, device encryption, generalize) expanded.  *wconfig* itself is not modified so this can be called both when building the CD and when fingerprinting it.
+        '''
+        wconfig = dataclasses.replace(
+            wconfig,
+            oem_files=list(wconfig.oem_files),
+            driver_files=list(wconfig.driver_files),
+            specialize_powershell=list(wconfig.specialize_powershell),
+            firstlogon_powershell=list(wconfig.firstlogon_powershell))
+        if not wconfig.generalize:
+            run_service ='-Status Running'
+        else:
+            run_service = ''
+        if wconfig.offline_packages:
+            # Setup installed them in the offlineServicing pass
+            wconfig.specialize_powershell.append(
+                'Remove-Item -Recurse -Force C:\\'+package_dir.replace('/', '\\'))
+        if wconfig.enable_sshd:
+            add_capability = []
+            if not any(p.identity.get('name', '').startswith('OpenSSH-Server-Package')
+                       for p in wconfig.offline_packages):
+                add_capability = ['Add-WindowsCapability -online -name OpenSSH.Server~~~~0.0.1.0']
+            # Adding the capability takes minutes and is independent of MSI installs
+            wconfig.firstlogon_powershell.append(Scriptlet('\n'.join(add_capability+[
+                f'Set-Service sshd -StartupType automatic {run_service}',
+                'get-NetFirewallRule -name *openssh* |set-NetFirewallRule -profile public,private,domain',
+                ]), name='sshd', parallel=True))
+        if wconfig.disable_device_encryption:
+            wconfig.specialize_powershell.extend([
+                'New-ItemProperty -Path "HKLM:\\SYSTEM\\CurrentControlSet\\Control\\BitLocker" -Name "PreventDeviceEncryption" -Value 1 -PropertyType DWord',
+                'New-ItemProperty -Path "HKLM:\\SYSTEM\\CurrentControlSet\\Control\\BitLocker" -Name "DisableBDE" -Value 1 -PropertyType DWord'])
+
+        wconfig.oem_files.append(self.stamp_path/'sysprep_unattend.xml')
+        if self.virtiofs_payloads:
+            bootstrap = [s for s in wconfig.firstlogon_powershell
+                         if getattr(s, 'name', None) and self.on_cd(s.name)]
+            for pattern in self.virtiofs_bootstrap:
+                if not any(fnmatch.fnmatch(s.name, pattern) for s in bootstrap):
+                    raise ValueError(f'virtiofs payload_transport requires {pattern} to be installed')
+            wconfig.firstlogon_powershell = bootstrap + [Scriptlet(payload_copy_powershell, name='payloads')] + [
+                s for s in wconfig.firstlogon_powershell if not any(s is b for b in bootstrap)]
+        if wconfig.generalize:
+            if wconfig.trim_before_generalize:
+                wconfig.firstlogon_powershell.append(trim_command)
+            if self.checkpoints:
+                wconfig.firstlogon_powershell.append(checkpoint_powershell('sysprep'))
+            wconfig.firstlogon_powershell.append(send_event('sysprep', 'start'))
+            wconfig.firstlogon_powershell.append(sysprep_command)
+        return wconfig
+
+    @staticmethod
+    def script_contents(phase, scriptlets):
+        '''
+        :returns: The powershell script for *phase*.  The script reports its progress over the :mod:`guest channel <carthage_windows.guest_channel>`; see :func:`~carthage_windows.guest_channel.monitored_script`.
+        '''
+        return monitored_script(phase, scriptlets)
+
+    def phase_scripts(self, wconfig) -> dict[str, str]:
+        '''
+        :returns: The scripts placed in ``$OEM$\\$$\\Setup`` for the specialize and firstlogon phases, by file name.  With :attr:`checkpoints`, ``specialize.ps1`` and ``firstlogon.ps1`` are launchers that request a checkpoint before running the phase's ``_body.ps1``.
+        '''
+        specialize = self.script_contents('specialize', wconfig.specialize_powershell)
+        firstlogon = self.script_contents('firstlogon', wconfig.firstlogon_powershell)
+        if not self.checkpoints:
+            return {'specialize.ps1': specialize, 'firstlogon.ps1': firstlogon}
+        return {
+            'specialize.ps1': phase_launcher('setup', 'specialize_body.ps1'),
+            'specialize_body.ps1': specialize,
+            'firstlogon.ps1': phase_launcher('specialize', 'firstlogon_body.ps1'),
+            'firstlogon_body.ps1': firstlogon,
+            }
+
+    async def checkpoint_keys(self) -> dict[str, str]:
+        '''
+        Digests of what determines the state of the guest at each checkpoint (see :mod:`carthage_windows.checkpoint`).  The ``setup`` key covers the XML and every file placed on the CD except the phase scripts, which the launchers read when their phase begins; ``specialize`` adds the specialize script and ``sysprep`` the firstlogon script.
+        '''
+        wconfig = self.prepare_config(
+            await self.ainjector.get_instance_async(WindowsConfig))
+        scripts = self.phase_scripts(wconfig)
+        fp = Fingerprint()
+        await fp.add_path('autounattend', self.stamp_path/'autounattend.xml')
+        fp.add('layer_hook', layer_hook_powershell)
+        for oem_file in wconfig.oem_files:
+            await fp.add_path('oem' if self.on_cd(oem_file) else 'payload', oem_file)
+        for driver_file in wconfig.driver_files:
+            await fp.add_path('driver', driver_file)
+        if self.checkpoints:
+            fp.add('launchers', scripts['specialize.ps1'], scripts['firstlogon.ps1'])
+        keys = dict(setup=fp.hexdigest())
+        fp.add('specialize', self.script_contents('specialize', wconfig.specialize_powershell))
+        keys['specialize'] = fp.hexdigest()
+        fp.add('firstlogon', self.script_contents('firstlogon', wconfig.firstlogon_powershell))
+        keys['sysprep'] = fp.hexdigest()
+        return keys
+
+    async def input_stamp(self):
+        '''
+        A digest of the settings and :class:`WinConfigPlugin` inputs that the CD is built from, or None if a plugin does not report its inputs; see :meth:`WindowsConfigBuilder.input_stamp`.  Unlike :meth:`fingerprint`, the config is not built.  The files placed on the CD are covered by :meth:`payload_files`.
+        '''
+        windows = self.config_layout.windows
+        plugins = await self.config_builder.input_stamp(self.ainjector)
+        if plugins is None: return None
+        fp = Fingerprint()
+        fp.add('settings', self.windows_version, repr(self.matrix_entry),
+               windows.driver_injection, windows.payload_transport,
+               windows.install_checkpoints, windows.offline_packages)
+        templates = Path(__file__).parent/'templates'
+        fp.add('templates', *(t.stat().st_mtime_ns for t in sorted(templates.glob('*.mako'))))
+        fp.add('plugins', plugins)
+        return fp.hexdigest()
+
+    async def payload_files(self) -> list[Path]:
+        '''
+        :returns: The OEM and driver files placed on the CD.  The config must already be built.
+        '''
+        wconfig = self.prepare_config(await self.ainjector.get_instance_async(WindowsConfig))
+        return [*map(Path, wconfig.oem_files), *map(Path, wconfig.driver_files)]
+
+    async def fingerprint(self):
+        '''
+        A digest of the rendered XML, the generated scripts and every file placed on the CD.
+        '''
+        return (await self.checkpoint_keys())['sysprep']
+
+    async def build_cd(self, output:Path):
+        '''
+        Master the autounattend CD into *output*.
+        '''
+        iso_builder = files.CdContext(output.parent,
+                                      output.name,
+                                      )
+        async with self.build_profile.stage('master_autounattend') as stage:
+            async with iso_builder as contents_path:
+                wconfig = self.prepare_config(
+                    await self.ainjector.get_instance_async(WindowsConfig))
+                oem_setup = contents_path/'$OEM$/$$/Setup'
+                oem_setup.mkdir(parents=True)
+                driver_dir = contents_path/'$WinPEDriver$'
+                driver_dir.mkdir()
+                async with self.build_profile.stage('copy_payloads') as copy_stage:
+                    stats = await bulk_copy(
+                        [(oem_file, oem_setup) for oem_file in wconfig.oem_files if self.on_cd(oem_file)]
+                        + [(driver_file, driver_dir) for driver_file in wconfig.driver_files])
+                    copy_stage.bytes, copy_stage.files = stats.bytes, stats.files
+                    copy_stage.attrs['shared'] = stats.shared
+                for name, script in self.phase_scripts(wconfig).items():
+                    oem_setup.joinpath(name).write_text(script)
+                oem_setup.joinpath('layer_hook.ps1').write_text(layer_hook_powershell)
+
+                shutil.copy2(self.stamp_path/'autounattend.xml',
+                             contents_path)
+            stage.bytes = output.stat().st_size
+
     @setup_task("Create autounattend CD")
     async def create_autounattend_cd(self):
-        assets = self.carthage_windows.resource_dir/'assets'
-        iso_builder = files.CdContext(self.stamp_path,
-                                      'autounattend.iso',
-                                      )
-        async with iso_builder as contents_path:
-            wconfig = await self.ainjector.get_instance_async(WindowsConfig)
-            if not wconfig.generalize:
-                run_service ='-Status Running'
-            else:
-                run_service = ''
-            if wconfig.enable_sshd:
-                wconfig.firstlogon_powershell.extend([
-                    'Add-WindowsCapability -online -name OpenSSH.Server~~~~0.0.1.0',
-                    f'Set-Service sshd -StartupType automatic {run_service}',
-                    'get-NetFirewallRule -name *openssh* |set-NetFirewallRule -profile public,private,domain',
-                    ])
-            if wconfig.disable_device_encryption:
-                wconfig.specialize_powershell.extend([
-                    'New-ItemProperty -Path "HKLM:\\SYSTEM\\CurrentControlSet\\Control\\BitLocker" -Name "PreventDeviceEncryption" -Value 1 -PropertyType DWord',
-                    'New-ItemProperty -Path "HKLM:\\SYSTEM\\CurrentControlSet\\Control\\BitLocker" -Name "DisableBDE" -Value 1 -PropertyType DWord'])
-
-            wconfig.oem_files.append(self.stamp_path/'sysprep_unattend.xml')
-            if wconfig.generalize:
-                wconfig.firstlogon_powershell.append(
-                    'c:\\windows\\system32\\sysprep\\sysprep /generalize /oobe /shutdown /unattend:c:\\windows\\setup\\sysprep_unattend.xml')
-            oem_setup = contents_path/'$OEM$/$$/Setup'
-            oem_setup.mkdir(parents=True)
-            for oem_file in wconfig.oem_files:
-                await sh.rsync('-a', oem_file, str(oem_setup))
-            driver_dir = contents_path/'$WinPEDriver$'
-            driver_dir.mkdir()
-            for driver_file in wconfig.driver_files:
-                await sh.rsync('-a', driver_file, driver_dir)
-            with oem_setup.joinpath('specialize.ps1').open('wt') as specialize:
-                for scriptlet in wconfig.specialize_powershell:
-                    specialize.write(scriptlet+'\n')
-                specialize.write('\n')
-            with oem_setup.joinpath('firstlogon.ps1').open('wt') as firstlogon:
-                for scriptlet in wconfig.firstlogon_powershell:
-                    firstlogon.write(scriptlet+'\n')
-                firstlogon.write('\n')
-                    
-            shutil.copy2(self.stamp_path/'autounattend.xml',
-                         contents_path)
+        await self.asset_cache.fetch(
+            await self.fingerprint(), self.build_cd,
+            self.stamp_path/'autounattend.iso')
+
+    @create_autounattend_cd.hash()
+    async def create_autounattend_cd(self):
+        return await self.fingerprint()
+
+    @create_autounattend_cd.invalidator()
+    def create_autounattend_cd(self, **kwargs):
+        return self.stamp_path.joinpath('autounattend.iso').exists()
+
+    async def payload_fingerprint(self):
+        wconfig = self.prepare_config(
+            await self.ainjector.get_instance_async(WindowsConfig))
+        fp = Fingerprint()
+        for oem_file in wconfig.oem_files:
+            if not self.on_cd(oem_file):
+                await fp.add_path('payload', oem_file)
+        return fp.hexdigest()
+
+    async def build_payloads(self, output:Path):
+        wconfig = self.prepare_config(
+            await self.ainjector.get_instance_async(WindowsConfig))
+        output.mkdir()
+        output.joinpath(payload_marker).touch()
+        async with self.build_profile.stage('link_payloads') as stage:
+            # The share is a cache artifact, so it must not share inodes with the payloads themselves.
+            stats = await bulk_copy(
+                [(oem_file, output) for oem_file in wconfig.oem_files if not self.on_cd(oem_file)],
+                link=False)
+            stage.bytes, stage.files = stats.bytes, stats.files
+            stage.attrs['shared'] = stats.shared
+
+    @setup_task("Create virtiofs payload share")
+    async def create_payload_share(self):
+        '''
+        With *windows.payload_transport* ``virtiofs``, place the payloads in :attr:`payload_path`.  The share is content addressed through the :class:`~carthage_windows.cache.AssetCache`; payloads are reflinked into it where the filesystem allows.
+        '''
+        if not self.virtiofs_payloads: return
+        await self.asset_cache.fetch(
+            await self.payload_fingerprint(), self.build_payloads,
+            self.payload_path)
+
+    @create_payload_share.hash()
+    async def create_payload_share(self):
+        if not self.virtiofs_payloads: return ''
+        return await self.payload_fingerprint()
+
+    @create_payload_share.invalidator()
+    def create_payload_share(self, **kwargs):
+        if not self.virtiofs_payloads: return True
+        return self.payload_path.joinpath(payload_marker).exists()
+
+    def virtiofs_mount(self):
+        '''
+        :returns: The :class:`carthage.vm.VirtiofsMount` of the payload share, or None unless payloads are served over virtiofs.
+        '''
+        if not self.virtiofs_payloads: return None
+        return carthage.vm.VirtiofsMount(
+            destination=payload_marker, source=str(self.payload_path), readonly=True)
 
     def qemu_config(self, disk_config):
         return dict(
@@ -206,13 +719,81 @@ class AutoUnattendCd(SetupTaskMixin):
 
 __all__ += ['AutoUnattendCd']
 
+def fsync_path(path:Path):
+    '''
+    Flush *path* and the directory containing it to stable storage.
+    '''
+    for p, flags in ((path, os.O_RDONLY), (path.parent, os.O_RDONLY|os.O_DIRECTORY)):
+        fd = os.open(p, flags)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def set_disk_io(config_path:Path, io:str):
+    '''
+    Set the ``io`` mode (for example ``io_uring``) of every disk in the libvirt domain XML at *config_path*.
+    '''
+    parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
+    tree = ET.parse(config_path, parser)
+    for driver in tree.getroot().iterfind('devices/disk/driver'):
+        driver.set('io', io)
+    tree.write(config_path, encoding='unicode')
+
+__all__ += ['set_disk_io']
+
+class WindowsBuildVm(carthage.vm.Vm):
+
+    '''
+    The VM that installs a :class:`LibvirtWindowsBaseImage`.  With *windows.build_io*, its disks use ``io_uring``.
+    '''
+
+    async def write_config(self):
+        await super().write_config()
+        if self.config_layout.windows.build_io:
+            await asyncio.to_thread(set_disk_io, Path(self.config_path), 'io_uring')
+
+    async def start_machine(self):
+        '''
+        Start the VM, or if the model is resuming an install, restore it from its checkpoint rather than booting it.
+        '''
+        resume = getattr(self.model, 'resume_from', None)
+        if resume is None:
+            return await super().start_machine()
+        async with self._operation_lock:
+            if self.running is True:
+                return
+            await self.start_dependencies()
+            await self.write_config()
+            await self.model.install_checkpoints.restore(self, resume)
+            self.model.resume_from = None
+            self.running = True
+
+__all__ += ['WindowsBuildVm']
+
+@inject_autokwargs(install_scheduler=InstallScheduler)
 class LibvirtWindowsBaseImage(LibvirtImageModel):
     self_provider(InjectionKey(carthage.image.ImageVolume))
     name = 'windows_base'
     size = 128*1024
+    #: The install VM's memory and cpus; also what the :class:`~carthage_windows.scheduler.InstallScheduler` reserves on the host.
     memory_mb = 16*1024
     cpus = 4
+    #: I/O units the install uses; see *windows.install_io_capacity*
+    install_io = 1
+    #: Installs with higher priority are admitted first when the host is busy.
+    install_priority = 0
     console_needed = True
+    #: Every disk of the install VM already uses ``cache=unsafe`` (see :class:`carthage.modeling.LibvirtImageModel`) and ``discard=unmap``, so guest flushes are ignored; :meth:`populate` makes the image durable once the install finishes.  The CDs stay on sata: Windows PE has no virtio-scsi driver until it loads ``$WinPEDriver$`` from the autounattend CD.
+    machine_type = WindowsBuildVm
+    #: The install disk while *windows.build_scratch_dir* is in use
+    build_path = None
+    #: The :class:`~carthage_windows.checkpoint.InstallCheckpoints` of the running install, if *windows.install_checkpoints* is set
+    install_checkpoints = None
+    #: The checkpoint the running install resumes from
+    resume_from = None
+    #: If True, the install VM writes directly to :attr:`path`, and neither *windows.build_scratch_dir* nor *windows.install_checkpoints* apply.  Layers set this because their disk is an overlay backed by their base, and :meth:`checkpoint_keys` expects the media of a base install.
+    direct_install = False
     disk_config = [
         dict(
             volume=InjectionKey(carthage.image.ImageVolume, _ready=False),),
@@ -227,12 +808,356 @@ class LibvirtWindowsBaseImage(LibvirtImageModel):
             bus='sata',
             )]
 
+    #: The install media.  These are brought to ready concurrently: the noprompt repack has no dependency on the autounattend CD, which in turn waits on the virtio driver extraction through :class:`WindowsConfig`.  Heavy I/O within these stages is limited by *windows.io_concurrency*.
+    install_media = (NoPromptInstallImage, AutoUnattendCd)
+
+    async def prepare_install_media(self):
+        '''
+        :returns: The ready instances of :attr:`install_media`
+        '''
+        return await asyncio.gather(*(
+            self.ainjector.get_instance_async(m) for m in self.install_media))
+
+    async def fingerprint(self):
+        '''
+        Combine the fingerprints of the install media.  If these change, the image needs to be reinstalled.
+        '''
+        fp = Fingerprint()
+        for media in await self.prepare_install_media():
+            fp.add(media.__class__.__name__, await media.fingerprint())
+        return fp.hexdigest()
+
+    async def input_stamp(self):
+        '''
+        Combine the :meth:`~AutoUnattendCd.input_stamp` of the install media, or None if that of any media is None.  The media are not brought ready.
+        '''
+        fp = Fingerprint()
+        for media in self.install_media:
+            instance = await self.ainjector.get_instance_async(InjectionKey(media, _ready=False))
+            stamp = await instance.input_stamp()
+            if stamp is None: return None
+            fp.add(media.__name__, stamp)
+        return fp.hexdigest()
+
+    @staticmethod
+    def payload_stamp(inputs:str, payloads:list) -> str:
+        '''
+        Combine *inputs*, the :meth:`input_stamp`, with the names, sizes and modification times of *payloads*, the :meth:`~AutoUnattendCd.payload_files` of the install media.
+        '''
+        fp = Fingerprint()
+        fp.add('inputs', inputs)
+        for payload in payloads:
+            fp.add('payload', payload, stat_digest(payload))
+        return fp.hexdigest()
+
+    async def create_volume(self, fingerprint):
+        '''
+        Install the image.  *fingerprint* is the result of :meth:`fingerprint`.
+
+        :returns: The :meth:`install_id` of the new volume.
+        '''
+        await self.install()
+        return uuid.uuid4().hex
+
+    def install_id(self) -> str:
+        '''
+        Identifies the bytes of this image: it changes whenever the volume is created again, even from unchanged install media.  Images backed by this one (see :class:`~carthage_windows.layers.LibvirtWindowsLayerImage`) are keyed by it rather than by :meth:`fingerprint`.  An image that was not installed here is identified by the inode and modification time of its file.
+        '''
+        last_run, install_id = self.check_stamp('windows_install')
+        if last_run:
+            return install_id
+        stat = os.stat(self.path)
+        return f'{stat.st_dev}:{stat.st_ino}:{stat.st_mtime_ns}'
+
+    async def install(self):
+        '''
+        Run :meth:`do_create` once the :class:`~carthage_windows.scheduler.InstallScheduler` admits it.  The install media should already be ready, so time spent in the queue is not spent holding resources that other installs need.
+        '''
+        for media in await self.prepare_install_media():
+            if mount := getattr(media, 'virtiofs_mount', lambda: None)():
+                self.injector.add_provider(mount, replace=True)
+        async with self.install_scheduler.admit(
+                self.name, memory_mb=self.memory_mb, cpus=self.cpus,
+                io=self.install_io, priority=self.install_priority):
+            await self.do_create()
+
+    def qemu_config(self, disk_config):
+        result = super().qemu_config(disk_config)
+        if self.install_checkpoints:
+            result.update(path=self.install_checkpoints.top, driver='qcow2')
+        elif self.build_path:
+            result['path'] = self.build_path
+        return result
+
+    @memoproperty
+    def checkpoint_path(self):
+        windows = self.config_layout.windows
+        return Path(windows.build_scratch_dir or windows.image_dir)/'checkpoints'/self.name
+
+    async def checkpoint_keys(self) -> dict[str, str]:
+        '''
+        The :meth:`AutoUnattendCd.checkpoint_keys`, combined with the install image and the VM's resources.
+        '''
+        noprompt, autounattend = await self.prepare_install_media()
+        fp = Fingerprint()
+        fp.add('install', await noprompt.fingerprint(), self.memory_mb, self.cpus, self.size)
+        keys = {}
+        for phase, key in (await autounattend.checkpoint_keys()).items():
+            fp.add(phase, key)
+            keys[phase] = fp.hexdigest()
+        return keys
+
+    async def take_checkpoint(self, vm, phase):
+        '''
+        Called when the guest requests the *phase* checkpoint.
+        '''
+        if self.install_checkpoints:
+            await self.install_checkpoints.take(vm, phase, self._checkpoint_keys[phase])
+
+    async def persist(self, source:Path, source_format:str):
+        '''
+        Convert the install disk *source* into the image and flush it to stable storage.
+        '''
+        async with self.injector.get_instance(BuildProfile).stage('persist_image', image=self.name) as stage:
+            tmp = Path(self.path).with_name(Path(self.path).name+'.tmp')
+            await sh.qemu_img(
+                'convert', '-f'+source_format, '-O'+self.qemu_format, '-S4k',
+                str(source), str(tmp))
+            await asyncio.to_thread(fsync_path, tmp)
+            tmp.rename(self.path)
+            stage.bytes = Path(self.path).stat().st_blocks*512
+
+    async def populate(self):
+        '''
+        Run the install.  With *windows.install_checkpoints*, the install disk is a qcow2 chain that may resume from a checkpoint (see :mod:`carthage_windows.checkpoint`).  Otherwise, with *windows.build_scratch_dir*, the install disk is created there (for example on tmpfs).  In both cases the disk is converted into the image afterward; either way, the image is flushed to stable storage before it is used.  Neither applies with :attr:`direct_install`.
+        '''
+        windows = self.config_layout.windows
+        if self.direct_install:
+            await super().populate()
+            await asyncio.to_thread(fsync_path, Path(self.path))
+            return
+        if windows.install_checkpoints:
+            if windows.payload_transport == 'virtiofs':
+                raise ValueError('install_checkpoints cannot be combined with virtiofs payloads; qemu cannot save the memory of a VM with virtiofs devices')
+            self._checkpoint_keys = await self.checkpoint_keys()
+            checkpoints = InstallCheckpoints(self.checkpoint_path)
+            self.resume_from = await checkpoints.prepare(self._checkpoint_keys, self.size)
+            self.install_checkpoints = checkpoints
+            self.disk_config = [*type(self).disk_config, checkpoint_drive]
+            try:
+                await super().populate()
+                await self.persist(checkpoints.top, 'qcow2')
+            finally:
+                self.install_checkpoints = self.resume_from = None
+                del self.disk_config
+                checkpoints.top.unlink(missing_ok=True)
+            return
+        scratch = windows.build_scratch_dir
+        if not scratch:
+            await super().populate()
+            await asyncio.to_thread(fsync_path, Path(self.path))
+            return
+        scratch = Path(scratch)
+        scratch.mkdir(parents=True, exist_ok=True)
+        build_path = scratch/Path(self.path).name
+        await sh.qemu_img('create', '-f'+self.qemu_format, str(build_path), self.size*1024**2)
+        self.build_path = build_path
+        try:
+            await super().populate()
+            await self.persist(build_path, self.qemu_format)
+        finally:
+            self.build_path = None
+            build_path.unlink(missing_ok=True)
+
+    @setup_task("Find or Create Volume")
+    async def find_or_create(self):
+        inputs = await self.input_stamp()
+        fingerprint = await self.fingerprint()
+        if await self.find():
+            last_run, stamp_fingerprint = self.check_stamp('windows_fingerprint')
+            if not last_run:
+                logger.info('Recording the install media of %s, which was not installed here', self.name)
+            elif stamp_fingerprint != fingerprint:
+                logger.info('Reinstalling %s because its install media changed', self.name)
+                self._delete_volume()
+                await self.find()
+        if not await self.find():
+            install_id = await self.create_volume(fingerprint)
+            self.create_stamp('windows_install', install_id)
+        if self.size:
+            await self.resize(self.size)
+        payloads = []
+        for media in await self.prepare_install_media():
+            if payload_files := getattr(media, 'payload_files', None):
+                payloads.extend(str(p) for p in await payload_files())
+        self.create_stamp('windows_fingerprint', fingerprint)
+        self.create_stamp('windows_payloads', json.dumps(payloads))
+        if inputs is None:
+            self.delete_stamp('windows_inputs')
+        else:
+            self.create_stamp('windows_inputs', self.payload_stamp(inputs, payloads))
+
+    @find_or_create.check_completed()
+    async def find_or_create(self):
+        '''
+        Only the :meth:`input_stamp` and the sizes and modification times of the files placed on the install media are compared, so validating an existing image never builds install media.  If they may have changed, the task compares the full :meth:`fingerprint` and reinstalls only if that differs.  The full fingerprint is also compared if a :class:`WinConfigPlugin` does not report its inputs, and once for an image that has no fingerprint recorded (for example one that was :func:`pulled <carthage_windows.distribution.pull>` or installed by an older version); such an image is not reinstalled, but its fingerprint is recorded.  An image whose install ISO is not present is used as is.
+        '''
+        if not await self.find():
+            return False
+        last_run, stamp_fingerprint = self.check_stamp('windows_fingerprint')
+        try:
+            inputs = await self.input_stamp()
+        except FileNotFoundError as e:
+            logger.debug('Using %s without checking its install media: %s', self.name, e)
+            return last_run or True
+        if not last_run or inputs is None:
+            return False
+        payloads = json.loads(self.check_stamp('windows_payloads')[1] or '[]')
+        if self.check_stamp('windows_inputs')[1] != self.payload_stamp(inputs, payloads):
+            return False
+        return last_run
+
+    @memoproperty
+    def export_path(self):
+        return Path(self.config_layout.windows.image_dir)/'exports'/self.name
+
+    @setup_task("Export image")
+    async def export(self):
+        '''
+        Export the image in *windows.export_formats*; see :func:`~carthage_windows.export.export_image`.
+        '''
+        windows = self.config_layout.windows
+        formats = [f.strip() for f in windows.export_formats.split(',') if f.strip()]
+        if not formats: return
+        compression = windows.export_compression
+        await export_image(
+            self, self.export_path, self.injector.get_instance(BuildProfile),
+            formats=formats,
+            compression=None if compression == 'none' else compression)
+
+    @export.hash()
+    def export(self):
+        windows = self.config_layout.windows
+        last_run, fingerprint = self.check_stamp('windows_fingerprint')
+        return f'{fingerprint} {windows.export_formats} {windows.export_compression}'
+
+    @export.invalidator()
+    def export(self, **kwargs):
+        if not self.config_layout.windows.export_formats:
+            return True
+        return self.export_path.joinpath('manifest.json').exists()
+
+    @setup_task("Publish image chunks")
+    async def publish_chunks(self):
+        '''
+        Publish the image and its install media to *windows.chunk_store*; see :func:`~carthage_windows.distribution.publish`.
+        '''
+        store = self.config_layout.windows.chunk_store
+        if not store: return
+        paths = [Path(self.path)]
+        for media in await self.prepare_install_media():
+            paths.append(Path(media.qemu_config({})['path']))
+        async with self.injector.get_instance(BuildProfile).stage('publish_chunks', image=self.name):
+            await asyncio.gather(*(
+                asyncio.to_thread(publish, path, Path(store), self.name) for path in paths))
+
+    @publish_chunks.hash()
+    def publish_chunks(self):
+        last_run, fingerprint = self.check_stamp('windows_fingerprint')
+        return f'{fingerprint} {self.config_layout.windows.chunk_store}'
+
+    @inject_autokwargs(build_profile=BuildProfile)
     class WaitForInstall(carthage.machine.BaseCustomization):
 
         description = "Wait for install to complete"
 
+        #: Seconds to wait for the whole install
+        install_timeout = 30*60
+
+        #: Seconds any single specialize or firstlogon step may take
+        step_timeout = 20*60
+
+        #: Step statuses that count as success; msiexec uses 3010 and 1641 to request a reboot
+        success_exit_codes = frozenset({'0', '3010', '1641'})
+
+        #: If True, a failed or hung step aborts the install immediately; otherwise it is only logged.
+        fail_fast = True
+
+        def step_failed(self, message):
+            if self.fail_fast:
+                raise InstallFailed(message)
+            logger.warning('%s: %s', self.host.name, message)
+
+        async def monitor_guest(self, channel, open_phases):
+            '''
+            Record guest phases and steps in the build profile and enforce :attr:`step_timeout`.  Steps run in parallel (see :class:`~carthage_windows.guest_channel.Scriptlet`) may be outstanding at once.
+            '''
+            #: (phase, index) -> (description, deadline, guest start time)
+            steps = {}
+            while True:
+                timeout = None
+                if steps:
+                    timeout = max(min(s[1] for s in steps.values())-time.time(), 0)
+                try:
+                    event = await asyncio.wait_for(anext(channel), timeout)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    now = time.time()
+                    for key, (description, deadline, _) in list(steps.items()):
+                        if deadline <= now:
+                            del steps[key]
+                            self.step_failed(f'{key[0]} step {description} did not finish within {self.step_timeout} seconds')
+                    continue
+                if event.event == 'start':
+                    open_phases[event.phase] = event.timestamp
+                elif event.event == 'finish' and event.phase in open_phases:
+                    self.build_profile.record(Stage(
+                        name=event.phase, category='guest',
+                        start=open_phases.pop(event.phase), end=event.timestamp))
+                elif event.event == 'checkpoint':
+                    if take_checkpoint := getattr(self.host.model, 'take_checkpoint', None):
+                        await take_checkpoint(self.host, event.phase)
+                elif event.event == 'step-start':
+                    index, _, description = event.detail.partition(' ')
+                    steps[(event.phase, index)] = (description, time.time()+self.step_timeout, event.timestamp)
+                    logger.info('%s: %s step %s', self.host.name, event.phase, event.detail)
+                elif event.event == 'step-finish':
+                    index, _, status = event.detail.partition(' ')
+                    description, _, start = steps.pop((event.phase, index), (index, None, event.timestamp))
+                    self.build_profile.record(Stage(
+                        name=f'{event.phase} step {index}', category='guest-step',
+                        start=start, end=event.timestamp,
+                        attrs=dict(description=description, status=status.strip())))
+                    if status.strip() not in self.success_exit_codes:
+                        self.step_failed(f'{event.phase} step {description} failed with status {status}')
+
         @setup_task("Wait")
         async def wait_for_install(self):
-            await self.host.wait_for_shutdown()
+            open_phases = {}
+            async with self.build_profile.stage('wait_for_install'):
+                async with contextlib.AsyncExitStack() as stack:
+                    waiters = [asyncio.ensure_future(
+                        self.host.wait_for_shutdown(timeout=self.install_timeout))]
+                    try:
+                        channel = await stack.enter_async_context(GuestChannel(self.host))
+                        waiters.append(asyncio.ensure_future(self.monitor_guest(channel, open_phases)))
+                    except Exception:
+                        logger.warning('Unable to read guest events from %s', self.host.name, exc_info=True)
+                    try:
+                        while True:
+                            done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                            for future in done:
+                                # Raises if the install failed or timed out
+                                future.result()
+                            if waiters[0] in done: break
+                            waiters = list(pending)
+                    finally:
+                        for future in waiters: future.cancel()
+            # Phases such as sysprep end when the guest shuts down
+            for phase, start in open_phases.items():
+                self.build_profile.record(Stage(
+                    name=phase, category='guest', start=start, end=time.time()))
+            self.build_profile.write(self.host.log_path/'build_profile')
 
 __all__ += ['LibvirtWindowsBaseImage']
@@ -0,0 +1,217 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Checkpoint a Windows install at phase boundaries so a rebuild can resume rather than start over.
+
+With *windows.install_checkpoints*, the install disk is a chain of qcow2 files in :attr:`InstallCheckpoints.path`, the install VM has an empty CD drive (:data:`checkpoint_drive`), and the guest pauses at each of :data:`phases` after sending a ``checkpoint`` event over the :mod:`guest channel <carthage_windows.guest_channel>`:
+
+* ``setup``: Setup has copied files and rebooted; specialize is about to run.
+* ``specialize``: specialize and OOBE are done; the first logon scripts are about to run.
+* ``sysprep``: the first logon scripts are done; sysprep is about to generalize the image.
+
+On the event the host takes a live external snapshot: guest memory is saved to ``<phase>.mem``, the current top of the disk chain becomes read-only and a new qcow2 overlay takes its place.  Each checkpoint is recorded in ``checkpoints.json`` with the key of the inputs that determined the guest's state at that point.  The guest waits until the host acknowledges the checkpoint by inserting a CD holding ``carthage-checkpoint-<phase>`` into the checkpoint drive, so it cannot run on before the snapshot is taken however long that takes.
+
+When an install starts, the latest checkpoint whose key, and the keys of all checkpoints before it, match the current inputs is restored with ``virsh restore`` onto a fresh overlay and acknowledged; later checkpoints are discarded.  The phase scripts in the guest are launchers (see :func:`phase_launcher`) that copy the script for their phase from the autounattend CD after the checkpoint, so a resumed install runs the current scripts.  Changing only the first logon scriptlets therefore resumes from ``specialize`` instead of running Windows Setup again.
+
+'''
+
+import json
+import logging
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from carthage import files, sh
+from .guest_channel import send_event, send_event_powershell
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+#: Checkpoints in the order the install reaches them
+phases = ('setup', 'specialize', 'sysprep')
+
+#: Seconds the guest waits for the host to acknowledge a checkpoint before failing the install
+checkpoint_timeout = 30*60
+
+__all__ += ['phases']
+
+#: The :ref:`disk_config <disk_config>` entry of the drive that acknowledgements are inserted into; it is empty when the install VM starts.
+checkpoint_drive = dict(target_type='cdrom', bus='sata', source_type='file', qemu_source='file', driver='raw')
+
+__all__ += ['checkpoint_drive']
+
+def ack_marker(phase):
+    '''
+    :returns: The name of the file on the CD acknowledging the *phase* checkpoint.
+    '''
+    return f'carthage-checkpoint-{phase}'
+
+def checkpoint_powershell(phase):
+    '''
+    :returns: Powershell requesting the *phase* checkpoint and waiting until the host acknowledges it.
+    '''
+    return f'''\
+{send_event(phase, 'checkpoint')}
+$deadline = (Get-Date).AddSeconds({checkpoint_timeout})
+while (-not ([System.IO.DriveInfo]::GetDrives() | Where-Object {{
+        $_.IsReady -and (Test-Path -LiteralPath (Join-Path $_.RootDirectory.FullName '{ack_marker(phase)}')) }})) {{
+    if ((Get-Date) -gt $deadline) {{ throw 'The {phase} checkpoint was not acknowledged' }}
+    Start-Sleep -Seconds 1
+}}'''
+
+__all__ += ['checkpoint_powershell']
+
+def phase_launcher(checkpoint, script):
+    '''
+    :returns: A script that requests the *checkpoint* checkpoint, then copies *script* from ``$OEM$\\$$\\Setup`` on the autounattend CD into ``c:\\windows\\setup`` and runs it.  The launcher is fixed when Setup copies files; *script* is read only once the checkpoint is taken, so a resumed install runs the current version.
+    '''
+    return f'''\
+{send_event_powershell}
+{checkpoint_powershell(checkpoint)}
+foreach ($drive in [System.IO.DriveInfo]::GetDrives()) {{
+    $source = Join-Path $drive.RootDirectory.FullName '$OEM$\\$$\\Setup\\{script}'
+    if (Test-Path -LiteralPath $source) {{
+        Copy-Item -LiteralPath $source -Destination c:\\windows\\setup\\{script} -Force
+        break
+    }}
+}}
+& c:\\windows\\setup\\{script}
+'''
+
+__all__ += ['phase_launcher']
+
+async def domain_disks(domain) -> list[tuple[str, str]]:
+    '''
+    :returns: ``(device, target)`` for each disk of *domain*, where device is ``disk`` or ``cdrom``.
+    '''
+    result = await sh.virsh('domblklist', domain, '--details', _bg=True, _bg_exc=False)
+    disks = []
+    for line in str(result.stdout, 'utf-8').splitlines()[2:]:
+        fields = line.split()
+        if len(fields) >= 3:
+            disks.append((fields[1], fields[2]))
+    return disks
+
+def checkpoint_target(config_path) -> str:
+    '''
+    :returns: The target of the :data:`checkpoint_drive` in the domain XML at *config_path*: the CD drive without a source.
+    '''
+    for disk in ET.parse(config_path).getroot().iterfind('devices/disk'):
+        if disk.get('device') == 'cdrom' and disk.find('source') is None:
+            return disk.find('target').get('dev')
+    raise ValueError(f'{config_path} has no checkpoint drive')
+
+__all__ += ['checkpoint_target']
+
+class InstallCheckpoints:
+
+    '''
+    The checkpoints of one install, kept in *path*.
+    '''
+
+    def __init__(self, path:Path):
+        self.path = Path(path)
+        self.index_path = self.path/'checkpoints.json'
+        try:
+            self.entries = json.loads(self.index_path.read_text())
+        except (FileNotFoundError, ValueError):
+            self.entries = []
+        #: The writable top of the disk chain
+        self.top = None
+
+    def save(self):
+        tmp = self.index_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.entries, indent=2))
+        tmp.rename(self.index_path)
+
+    def valid(self, keys:dict) -> list[dict]:
+        '''
+        :returns: The recorded checkpoints that match *keys*, a map from phase to key, in phase order.  A checkpoint is only valid if every earlier one is.
+        '''
+        result = []
+        for entry in self.entries:
+            if keys.get(entry['phase']) != entry['key']: break
+            if not (Path(entry['layer']).exists() and Path(entry['memory']).exists()): break
+            result.append(entry)
+        return result
+
+    async def prepare(self, keys:dict, size_mb:int) -> dict|None:
+        '''
+        Set up :attr:`top` for an install with inputs *keys*.
+
+        :returns: The checkpoint to resume from, or None to install from the start.
+        '''
+        self.path.mkdir(parents=True, exist_ok=True)
+        valid = self.valid(keys)
+        keep = {self.path/'checkpoints.json'}
+        for entry in valid:
+            keep.update({Path(entry['layer']), Path(entry['memory'])})
+        for f in self.path.iterdir():
+            if f not in keep: f.unlink()
+        self.entries = valid
+        self.save()
+        if valid:
+            resume = valid[-1]
+            self.top = self.path/f'{resume["phase"]}.qcow2'
+            await sh.qemu_img('create', '-fqcow2', '-b', resume['layer'], '-Fqcow2', str(self.top))
+            logger.info('Resuming install from the %s checkpoint', resume['phase'])
+            return resume
+        self.top = self.path/'base.qcow2'
+        await sh.qemu_img('create', '-fqcow2', str(self.top), size_mb*1024**2)
+        return None
+
+    async def take(self, vm, phase:str, key:str):
+        '''
+        Take the *phase* checkpoint of the running *vm*.
+        '''
+        if any(e['phase'] == phase for e in self.entries):
+            # Resumed from this checkpoint
+            return
+        memory = self.path/f'{phase}.mem'
+        overlay = self.path/f'{phase}.qcow2'
+        args = ['--memspec', f'file={memory},snapshot=external']
+        for device, target in await domain_disks(vm.full_name):
+            if device == 'disk':
+                args += ['--diskspec', f'{target},snapshot=external,file={overlay}']
+            else:
+                args += ['--diskspec', f'{target},snapshot=no']
+        await sh.virsh('snapshot-create-as', vm.full_name, f'carthage-{phase}',
+                       '--no-metadata', '--atomic', *args,
+                       _bg=True, _bg_exc=False)
+        self.entries.append(dict(phase=phase, key=key, layer=str(self.top), memory=str(memory)))
+        self.save()
+        self.top = overlay
+        logger.info('%s: took the %s checkpoint', vm.name, phase)
+        await self.acknowledge(vm, phase)
+
+    async def acknowledge(self, vm, phase:str):
+        '''
+        Let the guest of *vm*, which is waiting in :func:`checkpoint_powershell`, continue past the *phase* checkpoint.
+        '''
+        iso_path = self.path/f'ack-{phase}.iso'
+        if not iso_path.exists():
+            async with files.CdContext(self.path, iso_path.name) as contents:
+                contents.joinpath(ack_marker(phase)).write_text(phase)
+        await sh.virsh('change-media', vm.full_name, checkpoint_target(vm.config_path), str(iso_path),
+                       '--update', _bg=True, _bg_exc=False)
+
+    async def restore(self, vm, resume:dict):
+        '''
+        Start *vm* from the *resume* checkpoint.  The configuration of *vm* must already be written with :attr:`top` as its disk.
+        '''
+        await sh.virsh('restore', resume['memory'], '--xml', vm.config_path, _bg=True, _bg_exc=False)
+        # The CDs may have been rebuilt; a media change makes the guest drop what it has cached.
+        for disk in ET.parse(vm.config_path).getroot().iterfind('devices/disk'):
+            if disk.get('device') != 'cdrom' or disk.find('source') is None: continue
+            target = disk.find('target').get('dev')
+            await sh.virsh('change-media', vm.full_name, target, '--eject', _bg=True, _bg_exc=False)
+            await sh.virsh('change-media', vm.full_name, target, disk.find('source').get('file'), '--insert',
+                           _bg=True, _bg_exc=False)
+        await self.acknowledge(vm, resume['phase'])
+
+__all__ += ['InstallCheckpoints']
@@ -0,0 +1,223 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Provision Windows VMs as thin clones of a generalized image.
+
+A :class:`WindowsCloneModel` gets a :class:`WindowsCloneVolume` (a qcow2 overlay or reflink of *vm_image_key*, never a full copy) and a small per-machine :class:`MachineConfigCd`.  The CD is applied by the specialize hook of the generalized image, the same way a :class:`~carthage_windows.layers.LayerCd` is, but the machine is not generalized again.
+
+By the time the hook runs, Setup has already read the answer file that sysprep cached in the image, so per-machine settings cannot be delivered as an unattend file.  The hook applies them directly instead: it renames the computer after the machine model and, if the machine's config has its own product key, installs it (see :meth:`MachineConfigCd.machine_settings`).  Network settings and so on come from :class:`WinConfigPlugin` registered in the machine model::
+
+    class win_1(WindowsCloneModel):
+        add_provider(machine_implementation_key, dependency_quote(carthage.vm.Vm))
+        add_provider(StaticAddressPlugin)
+
+'''
+
+import logging
+import shutil
+import carthage
+from carthage import *
+from carthage.modeling import *
+from carthage import files
+from carthage import sh
+from .config import *
+from .bulkcopy import bulk_copy
+from .cd import AutoUnattendCd
+from .fingerprint import Fingerprint
+from .layers import LayerCd, layer_config, layer_dir
+from .profiling import BuildProfile
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+class WindowsCloneVolume(carthage.image.ImageVolume):
+
+    '''
+    The disk of a cloned machine.  Unlike the volume :class:`carthage.vm.Vm` creates by default, this volume never copies its base regardless of *libvirt.use_backing_file*.
+    '''
+
+    #: The generalized image to clone
+    base_key = carthage.vm.vm_image_key
+
+    #: ``overlay`` for a qcow2 overlay backed by the base; ``reflink`` for a reflinked copy of the base, which requires a filesystem with reflinks (btrfs, xfs).
+    clone_mode = 'overlay'
+
+    def __init__(self, *args, clone_mode=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if clone_mode:
+            self.clone_mode = clone_mode
+
+    async def base_volume(self):
+        return await self.ainjector.get_instance_async(self.base_key)
+
+    async def find(self):
+        found = await super().find()
+        if found: return found
+        if self.clone_mode == 'overlay':
+            qemu_format = 'qcow2'
+        else:
+            qemu_format = (await self.base_volume()).qemu_format
+        if self.qemu_format != qemu_format:
+            self.path = self.path.with_suffix('.'+qemu_format)
+            self.qemu_format = qemu_format
+            self.creating_path = self.path.with_suffix('.carthage-creating')
+        return False
+
+    async def do_create(self):
+        base = await self.base_volume()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.clear_stamps_and_cache()
+        try:
+            self.creating_path.touch()
+            if self.clone_mode == 'overlay':
+                await sh.qemu_img(
+                    'create',
+                    '-fqcow2',
+                    '-b'+str(base.path),
+                    '-F'+base.qemu_format,
+                    str(self.path))
+            elif self.clone_mode == 'reflink':
+                await sh.cp('--reflink=always', '-p', str(base.path), str(self.path))
+            else:
+                raise ValueError(f'Unknown clone_mode {self.clone_mode}')
+            shutil.rmtree(self.stamp_path, ignore_errors=True)
+            self.stamp_path.mkdir(parents=True, exist_ok=True)
+            self.creating_path.unlink()
+        except Exception:
+            self.path.unlink(missing_ok=True)
+            self.creating_path.unlink(missing_ok=True)
+            raise
+
+    def qemu_config(self, disk_config):
+        return dict(super().qemu_config(disk_config), driver=self.qemu_format)
+
+__all__ += ['WindowsCloneVolume']
+
+@inject_autokwargs(
+    model=InjectionKey(carthage.machine.AbstractMachineModel),
+    build_profile=BuildProfile,
+    )
+class MachineConfigCd(SetupTaskMixin):
+
+    '''
+    The per-machine CD attached to a :class:`WindowsCloneModel`.
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.injector.add_provider(InjectionKey(WindowsConfig), self.build_config)
+
+    @property
+    def stamp_subdir(self):
+        return 'carthage_windows/machine_config/'+self.model.name
+
+    async def build_config(self) -> WindowsConfig:
+        return await layer_config(self.ainjector, self.model.injector)
+
+    @property
+    def computer_name(self):
+        '''
+        The NetBIOS name of the machine, limited to 15 characters.
+        '''
+        return self.model.name.partition('.')[0].replace('_', '-')[:15]
+
+    async def base_config(self) -> WindowsConfig:
+        '''
+        The :class:`WindowsConfig` the generalized image was built with.
+        '''
+        base_cd = await self.ainjector.get_instance_async(AutoUnattendCd)
+        return await base_cd.ainjector.get_instance_async(WindowsConfig)
+
+    def machine_settings(self, wconfig, base_config) -> list[str]:
+        '''
+        :returns: Scriptlets run in specialize that apply the settings of this machine: the computer name, and the product key if *wconfig* sets one other than that of *base_config*.  The rename takes effect at the reboot that ends specialize.
+        '''
+        settings = [f"Rename-Computer -NewName '{self.computer_name}' -Force"]
+        if wconfig.product_key and wconfig.product_key != base_config.product_key:
+            settings.append(f'cscript //B c:\\windows\\system32\\slmgr.vbs /ipk {wconfig.product_key}')
+        return settings
+
+    async def machine_scripts(self, wconfig):
+        return LayerCd.layer_scripts(
+            wconfig, generalize=False,
+            prepare=self.machine_settings(wconfig, await self.base_config()))
+
+    async def fingerprint(self):
+        wconfig = await self.ainjector.get_instance_async(WindowsConfig)
+        fp = Fingerprint()
+        for name, contents in sorted((await self.machine_scripts(wconfig)).items()):
+            fp.add(name, contents)
+        for oem_file in wconfig.oem_files:
+            await fp.add_path('oem', oem_file)
+        for driver_file in wconfig.driver_files:
+            await fp.add_path('driver', driver_file)
+        return fp.hexdigest()
+
+    @setup_task("Create machine config CD")
+    async def create_config_cd(self):
+        wconfig = await self.ainjector.get_instance_async(WindowsConfig)
+        iso_builder = files.CdContext(self.stamp_path, 'config.iso')
+        async with self.build_profile.stage('master_machine_config', machine=self.model.name) as stage:
+            async with iso_builder as contents_path:
+                layer_path = contents_path/layer_dir
+                layer_path.mkdir()
+                items = [(oem_file, layer_path/'oem') for oem_file in wconfig.oem_files]
+                items += [(driver_file, layer_path/'drivers') for driver_file in wconfig.driver_files]
+                stats = await bulk_copy(items)
+                stage.files = stats.files
+                for name, contents in (await self.machine_scripts(wconfig)).items():
+                    layer_path.joinpath(name).write_text(contents)
+            stage.bytes = iso_builder.iso_path.stat().st_size
+
+    @create_config_cd.hash()
+    async def create_config_cd(self):
+        return await self.fingerprint()
+
+    @create_config_cd.invalidator()
+    def create_config_cd(self, **kwargs):
+        return self.stamp_path.joinpath('config.iso').exists()
+
+    def qemu_config(self, disk_config):
+        return dict(
+            path=self.stamp_path/'config.iso',
+            source_type='file',
+            driver='raw',
+            qemu_source='file'
+        )
+
+__all__ += ['MachineConfigCd']
+
+class WindowsCloneModel(MachineModel, template=True):
+
+    '''
+    A machine booted from a thin clone of *vm_image_key* with a :class:`MachineConfigCd`.  Many clones can be started in parallel; creating each one copies no disk data.
+    '''
+
+    #: Set to ``reflink`` to use reflinked copies rather than qcow2 overlays; see :attr:`WindowsCloneVolume.clone_mode`.
+    clone_mode = 'overlay'
+
+    add_provider(MachineConfigCd)
+
+    disk_config = [
+        dict(volume=InjectionKey(WindowsCloneVolume)),
+        dict(
+            volume=InjectionKey(MachineConfigCd),
+            target_type='cdrom',
+            bus='sata',
+            )]
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # The volume has the name of the machine so that Vm.find and Vm.delete operate on it.
+        self.injector.add_provider(
+            InjectionKey(WindowsCloneVolume),
+            when_needed(WindowsCloneVolume, name=self.name, clone_mode=self.clone_mode))
+
+__all__ += ['WindowsCloneModel']
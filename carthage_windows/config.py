@@ -6,10 +6,15 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
 # LICENSE for details.
 
+import asyncio
 import dataclasses
+import os
 from pathlib import Path
 from carthage import *
 import carthage.ssh
+from .assets import AssetCatalog
+from .fingerprint import Fingerprint
+from .guest_channel import Scriptlet
 
 __all__ = []
 
@@ -45,16 +50,41 @@ class WindowsConfig:
     #: Generalize the image (sysprep) after specialization pass
     generalize:bool = True
 
+    #: Retrim the system volume before generalizing so that freed blocks are discarded from the image; see :mod:`carthage_windows.export`.
+    trim_before_generalize: bool = True
+
+    #: How :attr:`driver_files` reach the installed OS.  ``setup``: Windows Setup picks them up from ``$WinPEDriver$`` as it ranks devices, and the virtio MSI installs them again at first logon.  ``offline``: they are added to the driver store of the applied image in the offlineServicing pass, so the OS boots with its storage and network drivers present and the virtio driver MSI is skipped.
+    driver_injection: str = 'setup'
+
+    #: :class:`~carthage_windows.servicing.OfflinePackage` entries slipstreamed into the install image and installed by Setup in the offlineServicing pass.  Filled in from *windows.offline_packages*.
+    offline_packages: list = dataclasses.field(default_factory=lambda: [])
+
 __all__ += ['WindowsConfig']
 
+#: Fields of :class:`WindowsConfig` that plugins add to rather than set
+list_fields = ('oem_files', 'driver_files', 'specialize_powershell', 'firstlogon_powershell')
+
+def blank_config(config:WindowsConfig) -> WindowsConfig:
+    '''
+    :returns: A copy of *config* with nothing in :data:`list_fields`.
+    '''
+    return dataclasses.replace(config, **{f: [] for f in list_fields})
+
+__all__ += ['blank_config']
+
 class WinConfigPlugin(AsyncInjectable):
 
     '''
     All the WinConfig plugins in a given injector context are run by the image generation machinery; they can modify the :class:`WindowsConfig` adding  files or powershell snipits.
+
+    Plugins are applied in order of *name*; see :class:`WindowsConfigBuilder`.
     '''
 
     name:str
 
+    #: If True, :meth:`apply` only adds to the config and never reads what other plugins have added.  Independent plugins are applied concurrently, and their contributions can be memoized by :meth:`inputs`.  Other plugins are applied one at a time after all independent plugins.
+    independent = False
+
     @classmethod
     def default_class_injection_key(cls):
         return InjectionKey(WinConfigPlugin, name=cls.name)
@@ -65,22 +95,168 @@ class WinConfigPlugin(AsyncInjectable):
         '''
         pass
 
+    async def inputs(self):
+        '''
+        :returns: Everything other than the base :class:`WindowsConfig` that the contribution of an independent plugin depends on, or None if the contribution should not be memoized.  Items are strings or :class:`~pathlib.Path`; for a path, the size and modification time are included so editing a file or adding a file to a directory invalidates the contribution.  Files the plugin reads must be listed as paths, not strings.
+        '''
+        return None
+
 __all__ += ['WinConfigPlugin']
 
+class WindowsConfigBuilder(Injectable):
+
+    '''
+    Assembles a :class:`WindowsConfig` from the :class:`WinConfigPlugin` in an injector.
+
+    Each independent plugin is applied to its own :func:`blank_config`; these run concurrently.  The contributions are merged in plugin name order, so the result does not depend on which plugin finishes first.  A contribution is memoized under the fingerprint of :meth:`WinConfigPlugin.inputs`, so rebuilding the config does not rerun plugins whose inputs are unchanged.
+
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.memo = {}
+
+    @staticmethod
+    def inputs_fingerprint(plugin, blank, inputs):
+        fp = Fingerprint()
+        fp.add('plugin', plugin.__class__.__module__, plugin.__class__.__qualname__, plugin.name)
+        fp.add('base', repr(blank))
+        for item in inputs:
+            if isinstance(item, Path):
+                try:
+                    stat = os.stat(item)
+                    fp.add('path', str(item), stat.st_size, stat.st_mtime_ns)
+                except FileNotFoundError:
+                    fp.add('path', str(item), 'missing')
+            else:
+                fp.add('value', str(item))
+        return fp.hexdigest()
+
+    async def contribution(self, plugin, blank) -> WindowsConfig:
+        inputs = await plugin.inputs()
+        key = None
+        if inputs is not None:
+            key = self.inputs_fingerprint(plugin, blank, inputs)
+            if key in self.memo:
+                return self.memo[key]
+        result = blank_config(blank)
+        await plugin.apply(result)
+        if key: self.memo[key] = result
+        return result
+
+    @staticmethod
+    def merge(config, contribution, blank):
+        for field in dataclasses.fields(WindowsConfig):
+            value = getattr(contribution, field.name)
+            if field.name in list_fields:
+                getattr(config, field.name).extend(value)
+            elif value != getattr(blank, field.name):
+                setattr(config, field.name, value)
+
+    async def input_stamp(self, ainjector, *, stop_at=None) -> str|None:
+        '''
+        :returns: A digest of the plugins found by *ainjector* (up to *stop_at*) and their :meth:`WinConfigPlugin.inputs`, or None if any plugin does not report its inputs, in which case only building the config shows what changed.  Plugins are not brought ready and not applied, so this is cheap.
+        '''
+        with instantiation_not_ready():
+            plugins = [p for _, p in await ainjector.filter_instantiate_async(
+                WinConfigPlugin, ['name'], stop_at=stop_at, ready=False)]
+        fp = Fingerprint()
+        for plugin in sorted(plugins, key=lambda p: p.name):
+            inputs = await plugin.inputs()
+            if inputs is None: return None
+            fp.add('plugin', self.inputs_fingerprint(plugin, None, inputs))
+        return fp.hexdigest()
+
+    async def build(self, config:WindowsConfig, ainjector, *, stop_at=None) -> WindowsConfig:
+        '''
+        Apply the plugins found by *ainjector* (up to *stop_at*) to *config*.
+        :returns: *config*
+        '''
+        plugins = [p for _, p in await ainjector.filter_instantiate_async(
+            WinConfigPlugin, ['name'], stop_at=stop_at)]
+        plugins.sort(key=lambda p: p.name)
+        blank = blank_config(config)
+        independent = [p for p in plugins if p.independent]
+        contributions = await asyncio.gather(*(
+            self.contribution(p, blank) for p in independent))
+        for contribution in contributions:
+            self.merge(config, contribution, blank)
+        for plugin in plugins:
+            if not plugin.independent:
+                await plugin.apply(config)
+        return config
+
+__all__ += ['WindowsConfigBuilder']
+
 #: A string representing the Windows version
 windows_version_key = InjectionKey('carthage-windows/windows_version')
 
 __all__ += ['windows_version_key']
+
+#: Generic keys that select an edition during setup; they do not activate Windows.
+generic_product_keys = {
+    ('w10', 'pro'): 'VK7JG-NPHTM-C97JM-9MPGT-3V66T',
+    ('w11', 'pro'): 'VK7JG-NPHTM-C97JM-9MPGT-3V66T',
+    ('w10', 'enterprise'): 'NPPR9-FWDCX-D2C8J-H872K-2YT43',
+    ('w11', 'enterprise'): 'NPPR9-FWDCX-D2C8J-H872K-2YT43',
+    ('2k19', 'standard'): 'N69G4-B89J2-4G8F4-WWYCC-J464C',
+    ('2k19', 'datacenter'): 'WMDGN-G9PQG-XVVXX-R3X43-63DFG',
+    ('2k22', 'standard'): 'VDYBN-27WPP-V4HQT-9VMD4-VMK7H',
+    ('2k22', 'datacenter'): 'WX4NM-KYWYW-QJJR4-XV3QB-6VM33',
+    ('2k25', 'standard'): 'TVRH6-WHNXV-R9WG3-9XRFY-MY832',
+    ('2k25', 'datacenter'): 'D764K-2NDRG-47T6Q-P8T8W-YP6DF',
+}
+
+__all__ += ['generic_product_keys']
+
+@dataclasses.dataclass(frozen=True)
+class MatrixEntry:
+
+    '''
+    One image built by a :class:`~carthage_windows.matrix.WindowsImageMatrix`.  Within the injector of the entry, this object is available as ``InjectionKey(MatrixEntry)``.
+    '''
+
+    #: w10, w11, 2k22
+    windows_version: str
+    edition: str = 'pro'
+    #: Defaults to the :data:`generic_product_keys` entry for the version and edition; required if there is none, since Setup cannot otherwise select an image.
+    product_key: str = None
+    #: Additional :class:`WinConfigPlugin` classes for this image
+    plugins: tuple = ()
+    #: Glob selecting the install ISO; defaults to :attr:`NoPromptInstallImage.base_cd_patterns <carthage_windows.cd.NoPromptInstallImage.base_cd_patterns>` for the version.
+    iso_pattern: str = None
+    #: Name of the image; defaults to ``windows_<version>_<edition>``
+    name: str = None
+    #: Install priority; see :attr:`LibvirtWindowsBaseImage.install_priority <carthage_windows.cd.LibvirtWindowsBaseImage.install_priority>`
+    priority: int = 0
+
+    def __post_init__(self):
+        if self.name is None:
+            object.__setattr__(self, 'name', f'windows_{self.windows_version}_{self.edition}')
+        if self.product_key is None:
+            try:
+                object.__setattr__(self, 'product_key', generic_product_keys[(self.windows_version, self.edition)])
+            except KeyError:
+                raise ValueError(f'No generic product key for {self.windows_version} {self.edition}; set product_key') from None
+
+__all__ += ['MatrixEntry']
 @inject_autokwargs(
     carthage_windows=InjectionKey(CarthagePlugin, name='carthage-windows'),
     )
 class WinRemotingPlugin(WinConfigPlugin):
 
     name = 'windows_remoting'
+    independent = True
+
+    @property
+    def script(self):
+        return self.carthage_windows.resource_dir/'assets/ConfigureRemotingForAnsible.ps1'
+
+    async def inputs(self):
+        return [self.script]
 
     async def apply(self, wconfig):
-        assets = self.carthage_windows.resource_dir/'assets'
-        wconfig.oem_files.append(assets/'ConfigureRemotingForAnsible.ps1')
+        wconfig.oem_files.append(self.script)
         wconfig.firstlogon_powershell.append('c:\\windows\\setup\\ConfigureRemotingForAnsible.ps1')
 
 __all__ += ['WinRemotingPlugin']
@@ -90,6 +266,10 @@ __all__ += ['WinRemotingPlugin']
 class AuthorizedKeysPlugin(WinConfigPlugin):
 
     name = 'authorized_keys'
+    independent = True
+
+    async def inputs(self):
+        return [Path(self.authorized_keys.path)]
 
     async def apply(self, wconfig:WindowsConfig):
         wconfig.oem_files.append(self.authorized_keys.path)
@@ -100,28 +280,25 @@ class AuthorizedKeysPlugin(WinConfigPlugin):
 
 __all__ += ['AuthorizedKeysPlugin']
 
-@inject(
-    carthage_windows=InjectionKey(CarthagePlugin, name='carthage-windows'),
-    injector=Injector)
-def find_asset(glob, *, carthage_windows, injector):
-    config = injector(ConfigLayout)
-    if assets_dir := config.windows.assets_dir:
-        assets = Path(assets_dir)/'windows'
-    else:
-        assets = carthage_windows.resource_dir/'assets'
-    results = list(assets.glob(glob))
-    if len(results) == 0:
-        return None
-    if len(results) == 1:
-        return results[0]
-    raise ValueError('too many results')
+@inject(catalog=AssetCatalog)
+def find_asset(glob, *, catalog):
+    '''
+    :returns: The path of the newest asset matching *glob*, or None.
+    '''
+    if asset := catalog.newest(glob):
+        return asset.path
+    return None
 
 __all__ += ['find_asset']
 
-def install_msi(wconfig, msi_path):
+def install_msi(wconfig, msi_path, *, after=()):
+    '''
+    Install *msi_path* at first logon.  The install runs in parallel with other parallel :class:`~carthage_windows.guest_channel.Scriptlet`, though only one MSI is installed at a time.  The scriptlet is named after the MSI, so other scriptlets can run *after* it.
+    '''
     wconfig.oem_files.append(msi_path)
-    wconfig.firstlogon_powershell.append(f'Write-Output "Installing {msi_path.name}"')
-    wconfig.firstlogon_powershell.append(f'msiexec /i c:\\windows\\setup\\{msi_path.name} /qn /norestart /L*+ c:\\windows\\setup\\{msi_path.name}.log |Out-Default')
+    wconfig.firstlogon_powershell.append(Scriptlet(
+        f'msiexec /i c:\\windows\\setup\\{msi_path.name} /qn /norestart /L*+ c:\\windows\\setup\\{msi_path.name}.log |Out-Default',
+        name=msi_path.name, after=after, parallel=True, lock='msiexec'))
 
 __all__ += ['install_msi']
     
@@ -0,0 +1,274 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Distribute images between build hosts as content defined chunks.
+
+:func:`publish` splits a file (a built disk image or install ISO) into chunks whose boundaries depend on the content, stores each chunk in a chunk store under its sha256 and writes a manifest listing the chunks.  Because boundaries follow content, a rebuild that changes part of an image leaves most chunks, and therefore most of the manifest, unchanged.
+
+:func:`pull` recreates a file from a manifest.  Chunks already present in the previous version of the destination are copied locally; only the rest are fetched, several at a time, from the store, which may be a directory or an HTTP URL.  Every chunk is verified against its sha256.  The ``windows-pull`` command wraps :func:`pull`.
+
+A chunk store looks like::
+
+    manifests/<image>/<file name>.json
+    chunks/<first two hex digits>/<sha256>
+
+Manifests are grouped by the image they were published with, because the install media of different images (every ``autounattend.iso`` for example) share file names.
+
+Chunk boundaries are chosen at :data:`block_size` granularity: a chunk ends after a block whose crc32 is divisible by :data:`average_blocks`.  Disk images and ISOs change in whole blocks, so this finds the same boundaries a byte-granular rolling hash would while doing far less work per byte.  Holes in sparse files and all-zero chunks are recorded without a digest and never stored.
+
+'''
+
+import asyncio
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import threading
+import urllib.request
+import zlib
+from pathlib import Path
+from carthage import *
+from carthage.console import CarthageRunnerCommand
+from .export import data_extents
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+#: Granularity of chunk boundaries
+block_size = 4096
+#: Chunks average this many blocks (1 MiB)
+average_blocks = 256
+min_blocks = 64
+max_blocks = 1024
+
+#: Bytes read at a time while chunking
+read_size = 16*1024**2
+
+def cdc_chunks(path):
+    '''
+    Yield ``(offset, data)`` for each content defined chunk of the data regions of *path*.
+    '''
+    with open(path, 'rb') as f:
+        for start, length in data_extents(path):
+            f.seek(start)
+            end = start+length
+            pos = chunk_start = start
+            chunk = bytearray()
+            while pos < end:
+                buf = f.read(min(read_size, end-pos))
+                if not buf: break
+                pos += len(buf)
+                for i in range(0, len(buf), block_size):
+                    block = buf[i:i+block_size]
+                    chunk += block
+                    blocks = len(chunk)//block_size
+                    if blocks >= max_blocks or (
+                            blocks >= min_blocks and zlib.crc32(block)%average_blocks == 0):
+                        yield chunk_start, bytes(chunk)
+                        chunk_start += len(chunk)
+                        chunk = bytearray()
+            if chunk:
+                yield chunk_start, bytes(chunk)
+
+__all__ += ['cdc_chunks']
+
+def chunk_digest(data):
+    '''
+    :returns: The sha256 of *data*, or None if *data* is all zeros.
+    '''
+    if data == bytes(len(data)): return None
+    return hashlib.sha256(data).hexdigest()
+
+def chunk_path(store, digest):
+    return f'{store}/chunks/{digest[:2]}/{digest}'
+
+def manifest_path(path:Path) -> Path:
+    '''
+    :returns: Where the manifest of the local file *path* is kept; used by :func:`pull` to find chunks in the previous version of a file.
+    '''
+    return path.with_name(path.name+'.chunks.json')
+
+__all__ += ['manifest_path']
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+def chunk_file(path:Path, store:Path=None) -> dict:
+    '''
+    :returns: The manifest of *path*.  If *store* is given, chunks not already in it are added.
+    '''
+    chunks = []
+    for offset, data in cdc_chunks(path):
+        digest = chunk_digest(data)
+        chunks.append([offset, len(data), digest])
+        if store and digest:
+            dest = Path(chunk_path(store, digest))
+            if not dest.exists():
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                tmp = dest.with_suffix('.tmp')
+                tmp.write_bytes(data)
+                tmp.rename(dest)
+    manifest = dict(
+        name=path.name,
+        size=os.stat(path).st_size,
+        chunks=chunks,
+        stat=_stat_key(path),
+        )
+    manifest_path(path).write_text(json.dumps(manifest))
+    return manifest
+
+def store_manifest(store, image:str, name:str) -> str:
+    '''
+    :returns: Where the manifest of the file *name* published with *image* is kept in *store*.
+    '''
+    if '/' in image or image in ('', '.', '..'):
+        raise ValueError(f'Invalid image name {image!r}')
+    return f'{str(store).rstrip("/")}/manifests/{image}/{name}.json'
+
+__all__ += ['store_manifest']
+
+def publish(path:Path, store:Path, image:str) -> dict:
+    '''
+    Chunk *path* into the chunk store directory *store* and write its manifest to the :func:`store_manifest` of *image*.
+
+    :returns: The manifest.
+    '''
+    manifest = chunk_file(path, store)
+    destination = Path(store_manifest(store, image, path.name))
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    tmp = destination.with_name(destination.name+'.tmp')
+    tmp.write_text(json.dumps(manifest))
+    tmp.rename(destination)
+    stored = len({c[2] for c in manifest['chunks'] if c[2]})
+    logger.info('Published %s of %s as %d chunks', path.name, image, stored)
+    return manifest
+
+__all__ += ['publish']
+
+def _read(location:str) -> bytes:
+    if location.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(location) as response:
+            return response.read()
+    return Path(location).read_bytes()
+
+def local_chunks(path:Path) -> dict:
+    '''
+    :returns: A map from digest to ``(offset, length)`` of the chunks in the local file *path*, using its manifest if it is current.
+    '''
+    if not path.exists(): return {}
+    try:
+        manifest = json.loads(manifest_path(path).read_text())
+        if manifest['stat'] != _stat_key(path): raise ValueError
+    except (OSError, ValueError, KeyError):
+        manifest = chunk_file(path)
+    return {digest: (offset, length) for offset, length, digest in manifest['chunks'] if digest}
+
+@dataclasses.dataclass
+class PullStats:
+
+    #: Bytes fetched from the store
+    fetched: int = 0
+    #: Bytes copied from the previous version of the file
+    reused: int = 0
+
+__all__ += ['PullStats']
+
+async def pull(manifest:str, dest:Path, store:str=None, *, jobs=8) -> PullStats:
+    '''
+    Recreate the file described by *manifest* at *dest*.
+
+    :param manifest: Path or URL of the manifest, ``<store>/manifests/<image>/<file name>.json``; see :func:`store_manifest`.
+
+    :param store: Path or URL of the chunk store; defaults to the store containing *manifest*.
+
+    :param jobs: How many chunks to fetch at once.
+    '''
+    dest = Path(dest)
+    if store is None:
+        head, sep, tail = str(manifest).rpartition('/manifests/')
+        if not sep:
+            raise ValueError(f'{manifest} is not in a chunk store; specify the store')
+        store = head
+    store = store.rstrip('/')
+    contents = json.loads(await asyncio.to_thread(_read, manifest))
+    seed = await asyncio.to_thread(local_chunks, dest)
+    stats = PullStats()
+    tmp = dest.with_name(dest.name+'.pulling')
+    stop = threading.Event()
+
+    def get_chunk(offset, length, digest, out_fd, seed_fd):
+        if stop.is_set(): return None
+        if digest in seed:
+            seed_offset, seed_length = seed[digest]
+            data = os.pread(seed_fd, seed_length, seed_offset)
+            if hashlib.sha256(data).hexdigest() == digest:
+                os.pwrite(out_fd, data, offset)
+                return False
+        data = _read(chunk_path(store, digest))
+        if len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f'Chunk {digest} from {store} does not match its digest')
+        os.pwrite(out_fd, data, offset)
+        return True
+
+    chunks = [c for c in contents['chunks'] if c[2]]
+    loop = asyncio.get_running_loop()
+    pool = concurrent.futures.ThreadPoolExecutor(jobs, thread_name_prefix='pull')
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    out_fd = os.open(tmp, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+    seed_fd = os.open(dest, os.O_RDONLY) if seed else None
+    complete = False
+    try:
+        os.ftruncate(out_fd, contents['size'])
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool, get_chunk, offset, length, digest, out_fd, seed_fd)
+            for offset, length, digest in chunks), return_exceptions=True)
+        for (offset, length, digest), result in zip(chunks, results):
+            if isinstance(result, BaseException): raise result
+            if result:
+                stats.fetched += length
+            else:
+                stats.reused += length
+        complete = True
+    finally:
+        # Chunks still being copied write through the descriptors, so wait for them before closing them, even if the pull is cancelled.
+        stop.set()
+        await asyncio.to_thread(pool.shutdown, wait=True, cancel_futures=True)
+        os.close(out_fd)
+        if seed_fd is not None: os.close(seed_fd)
+        if not complete: tmp.unlink(missing_ok=True)
+    tmp.rename(dest)
+    contents['stat'] = _stat_key(dest)
+    manifest_path(dest).write_text(json.dumps(contents))
+    logger.info('Pulled %s: %d MiB fetched, %d MiB reused',
+                dest.name, stats.fetched//1024**2, stats.reused//1024**2)
+    return stats
+
+__all__ += ['pull']
+
+class PullCommand(CarthageRunnerCommand):
+
+    name = 'windows-pull'
+
+    subparser_kwargs = dict(help='Fetch an image published to a chunk store, reusing chunks already present locally')
+
+    def setup_subparser(self, parser):
+        parser.add_argument('manifest', help='Path or URL of the manifest')
+        parser.add_argument('dest', help='File to create or update')
+        parser.add_argument('--store', help='Path or URL of the chunk store; defaults to the store containing the manifest')
+        parser.add_argument('--jobs', type=int, default=8, help='Chunks to fetch at once')
+
+    async def run(self, args):
+        stats = await pull(args.manifest, Path(args.dest), args.store, jobs=args.jobs)
+        print(f'{args.dest}: fetched {stats.fetched} bytes, reused {stats.reused} bytes')
+
+__all__ += ['PullCommand']
@@ -11,7 +11,9 @@ from carthage import *
 import carthage.sh
 from carthage.modeling import *
 from .cd import extract_cd
+from .assets import AssetCatalog, assets_path
 from .config import *
+from .guest_channel import Scriptlet
 
 '''
 Some example plugins that are useful to Carthage developers to demonstrate usage.
@@ -21,6 +23,7 @@ __all__ = []
 
 @inject_autokwargs(
     carthage_windows=InjectionKey(CarthagePlugin, name='carthage-windows'),
+    asset_catalog=AssetCatalog,
     )
 class NvdaInstall( WinConfigPlugin):
 
@@ -30,8 +33,18 @@ class NvdaInstall( WinConfigPlugin):
     '''
 
     name = 'nvda_screenreader_install'
+    independent = True
+
+    async def inputs(self):
+        return [self.injector(assets_path), self.carthage_windows.resource_dir/'assets']
+
     @property
     def nvda_path(self):
+        '''
+        The newest nvda installer in the assets directory.  If *windows.assets_dir* is configured and has none, the installer bundled with the plugin, of which there must be at most one.
+        '''
+        if nvda := self.asset_catalog.newest('nvda_*.exe'):
+            return nvda.path
         assets = self.carthage_windows.resource_dir/'assets'
         nvda_exe = list(assets.glob('nvda_*.exe'))
         if not nvda_exe: return None
@@ -40,10 +53,13 @@ class NvdaInstall( WinConfigPlugin):
         return nvda_exe[0]
     
     async def apply(self, wconfig):
-        if not self.nvda_path:
+        nvda_path = self.nvda_path
+        if not nvda_path:
             return
-        wconfig.oem_files.append(self.nvda_path)
-        nvda_name = self.nvda_path.name
-        wconfig.firstlogon_powershell.append(f'c:\\windows\\setup\\{nvda_name} --install-silent --enable-start-on-logon=true')
+        wconfig.oem_files.append(nvda_path)
+        nvda_name = nvda_path.name
+        wconfig.firstlogon_powershell.append(Scriptlet(
+            f'c:\\windows\\setup\\{nvda_name} --install-silent --enable-start-on-logon=true',
+            name='nvda', parallel=True))
 
 __all__ += ['NvdaInstall']
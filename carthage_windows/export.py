@@ -0,0 +1,126 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Export built images for distribution to other build hosts.
+
+Before an image is generalized, the guest retrims its system volume (see :data:`~carthage_windows.cd.trim_command`); the install disk is attached with ``discard='unmap'``, so freed blocks become holes in the image.  :func:`export_image` then writes, into *windows.image_dir*/exports/<image>:
+
+* ``<image>.qcow2``: a compacted qcow2 (no backing file, zero clusters omitted), optionally compressed with zstd or zlib.
+
+* ``<image>.raw``: a sparse raw image.
+
+* ``manifest.json``: the size and sha256 of each export plus, for the raw image, the sha256 of every :data:`chunk_size` chunk containing data.  All-zero chunks are omitted, and chunks with identical contents share one hash, so a consumer only needs to fetch each distinct chunk once.
+
+'''
+
+import asyncio
+import errno
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from carthage import sh
+from .fingerprint import file_digest
+from .profiling import BuildProfile
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+#: Chunk size of the raw manifest
+chunk_size = 4*1024**2
+
+#: Formats :func:`export_image` understands
+export_formats = ('qcow2', 'raw')
+
+__all__ += ['chunk_size', 'export_formats']
+
+def data_extents(path):
+    '''
+    Yield ``(offset, length)`` for each region of *path* that may contain data, skipping holes.  On filesystems without ``SEEK_DATA`` the whole file is one extent.
+    '''
+    size = os.stat(path).st_size
+    with open(path, 'rb') as f:
+        fd = f.fileno()
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                # ENXIO: only a hole remains
+                if e.errno != errno.ENXIO: yield (offset, size-offset)
+                return
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            yield (start, end-start)
+            offset = end
+
+__all__ += ['data_extents']
+
+def raw_manifest(path) -> dict:
+    '''
+    :returns: The chunk manifest of the raw image at *path*: a list of ``[offset, sha256]`` for each chunk with data, and the number of distinct chunks.
+    '''
+    chunks = []
+    offsets = set()
+    with open(path, 'rb') as f:
+        for start, length in data_extents(path):
+            first = start - start%chunk_size
+            for offset in range(first, start+length, chunk_size):
+                if offset in offsets: continue
+                offsets.add(offset)
+                f.seek(offset)
+                data = f.read(chunk_size)
+                if data == bytes(len(data)): continue
+                chunks.append([offset, hashlib.sha256(data).hexdigest()])
+    return dict(
+        size=os.stat(path).st_size,
+        chunk_size=chunk_size,
+        chunks=chunks,
+        distinct_chunks=len({d for _, d in chunks}),
+        )
+
+__all__ += ['raw_manifest']
+
+async def export_image(volume, output:Path, build_profile:BuildProfile, *, formats=export_formats, compression='zstd'):
+    '''
+    Export the :class:`carthage.image.ImageVolume` *volume* into the directory *output*.
+
+    :param compression: ``zstd``, ``zlib`` or None for an uncompressed (but still compacted) qcow2.
+
+    :returns: The manifest, which is also written to *output*/manifest.json.
+    '''
+    output.mkdir(parents=True, exist_ok=True)
+    manifest = dict(image=volume.name, source_format=volume.qemu_format, files={})
+    for format in formats:
+        if format not in export_formats:
+            raise ValueError(f'Unknown export format {format}')
+        dest = output/f'{volume.name}.{format}'
+        tmp = dest.with_name(dest.name+'.tmp')
+        args = ['convert', '-f'+volume.qemu_format, '-O'+format]
+        if format == 'qcow2' and compression:
+            args += ['-c', '-o', f'compression_type={compression}']
+        elif format == 'raw':
+            args.append('-S4k')
+        async with build_profile.stage('export', image=volume.name, format=format) as stage:
+            await sh.qemu_img(*args, str(volume.path), str(tmp))
+            tmp.rename(dest)
+            stage.bytes = dest.stat().st_blocks*512
+        entry = dict(
+            size=dest.stat().st_size,
+            allocated=dest.stat().st_blocks*512,
+            sha256=await asyncio.to_thread(file_digest, dest))
+        if format == 'raw':
+            entry.update(await asyncio.to_thread(raw_manifest, dest))
+        manifest['files'][dest.name] = entry
+        logger.info('Exported %s: %d MiB allocated', dest.name, entry['allocated']//1024**2)
+    output.joinpath('manifest.json').write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+__all__ += ['export_image']
@@ -0,0 +1,130 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Content fingerprints used to decide whether Windows build artifacts are stale.
+
+Hashing a multi-gigabyte ISO is not free, so :func:`file_digest` remembers digests keyed by the file's size and mtime both in memory and (where the filesystem allows) in an extended attribute on the file itself.  Touching a file forces the digest to be recomputed once, but does not change the digest.
+'''
+
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+
+__all__ = []
+
+#: Extended attribute used to persist digests between runs
+digest_xattr = 'user.carthage_windows.sha256'
+
+_digest_cache: dict = {}
+
+def _stat_key(stat):
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+def file_digest(path) -> str:
+    '''
+    :returns: The hex sha256 of the contents of *path*.
+    '''
+    path = Path(path)
+    stat = path.stat()
+    key = _stat_key(stat)
+    cache_key = (stat.st_dev, stat.st_ino)
+    try:
+        cached_key, digest = _digest_cache[cache_key]
+        if cached_key == key: return digest
+    except KeyError: pass
+    try:
+        cached_key, digest = os.getxattr(path, digest_xattr).decode().rsplit('/', 1)
+        if cached_key == key:
+            _digest_cache[cache_key] = (key, digest)
+            return digest
+    except (OSError, ValueError): pass
+    hasher = hashlib.sha256()
+    with path.open('rb') as f:
+        while chunk := f.read(1<<20):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+    _digest_cache[cache_key] = (key, digest)
+    try:
+        os.setxattr(path, digest_xattr, f'{key}/{digest}'.encode())
+    except OSError: pass
+    return digest
+
+__all__ += ['file_digest']
+
+def path_digest(path) -> str:
+    '''
+    Like :func:`file_digest` but also handles directories. A directory digest covers the relative names and contents of every file underneath it.
+    '''
+    path = Path(path)
+    if not path.is_dir():
+        return file_digest(path)
+    hasher = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            full = Path(root)/f
+            hasher.update(str(full.relative_to(path)).encode()+b'\0')
+            hasher.update(file_digest(full).encode())
+    return hasher.hexdigest()
+
+__all__ += ['path_digest']
+
+def stat_digest(path) -> str:
+    '''
+    Like :func:`path_digest` but covers only the names, sizes and modification times of files; nothing is read.  A missing *path* has a digest too.
+    '''
+    path = Path(path)
+    hasher = hashlib.sha256()
+    if not path.exists():
+        return hasher.hexdigest()
+    paths = [path]
+    if path.is_dir():
+        paths = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            paths.extend(Path(root)/f for f in sorted(files))
+    for full in paths:
+        stat = full.stat()
+        hasher.update(f'{full.relative_to(path)}\0{_stat_key(stat)}\n'.encode())
+    return hasher.hexdigest()
+
+__all__ += ['stat_digest']
+
+class Fingerprint:
+
+    '''
+    Accumulate the inputs of a build step into a single digest::
+
+        fp = Fingerprint()
+        fp.add('options', *options)
+        await fp.add_path('iso', iso_path)
+        fp.hexdigest()
+
+    Each item is labeled so that moving a value from one input to another changes the fingerprint.
+    '''
+
+    def __init__(self):
+        self.hasher = hashlib.sha256()
+
+    def add(self, label, *values):
+        self.hasher.update(label.encode()+b'\0')
+        for v in values:
+            self.hasher.update(str(v).encode()+b'\0')
+        self.hasher.update(b'\n')
+
+    async def add_path(self, label, path):
+        '''Add the contents of *path* (file or directory).  Hashing happens in a thread so large files do not stall the event loop.
+        '''
+        self.add(label, Path(path).name, await asyncio.to_thread(path_digest, path))
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+__all__ += ['Fingerprint']
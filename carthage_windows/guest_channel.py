@@ -0,0 +1,243 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+A channel from the installing Windows guest to the host.
+
+The generated setup scripts call ``Send-CarthageEvent``, which writes a line to the guest's first serial port.  Libvirt connects that port to a pty on the host; :class:`GuestChannel` reads it and parses the lines into :class:`GuestEvent`.  Nothing needs to be installed in the guest, so the channel works from the specialize pass onward.
+
+'''
+
+import asyncio
+import dataclasses
+import logging
+import os
+import time
+import tty
+from carthage import sh
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+#: Marker beginning every line sent by the guest
+event_marker = 'CARTHAGE-EVENT'
+
+#: Powershell prologue defining Send-CarthageEvent.  Steps may run in parallel jobs, each its own process, so the port is opened under a named mutex.
+send_event_powershell = f'''\
+function Send-CarthageEvent([string]$Phase, [string]$Event, [string]$Detail = '') {{
+    $mutex = New-Object System.Threading.Mutex $false, 'Global\\CarthageEventPort'
+    try {{
+        [void]$mutex.WaitOne(10000)
+        $port = New-Object System.IO.Ports.SerialPort COM1,115200,None,8,One
+        $port.Open()
+        $port.WriteLine("{event_marker} $([DateTimeOffset]::UtcNow.ToUnixTimeMilliseconds()) $Phase $Event $Detail")
+        $port.Close()
+    }} catch {{ }} finally {{ try {{ $mutex.ReleaseMutex() }} catch {{ }} }}
+}}'''
+
+__all__ += ['send_event_powershell']
+
+def send_event(phase, event, detail='', *, expand=False):
+    '''
+    :returns: Powershell to send an event from the guest.
+    :param expand: If true, *detail* is placed in double quotes so powershell variables in it are expanded.
+    '''
+    if expand:
+        return f'Send-CarthageEvent {phase} {event} "{detail}"'
+    detail = detail.replace("'", "''")
+    return f"Send-CarthageEvent {phase} {event} '{detail}'"
+
+__all__ += ['send_event']
+
+def step_description(scriptlet:str):
+    lines = scriptlet.strip().splitlines()
+    description = lines[0] if lines else ''
+    if len(description) > 60 or len(lines) > 1:
+        description = description[:57]+'...'
+    return description
+
+class Scriptlet(str):
+
+    '''
+    A scriptlet that may run concurrently with others.  Plain strings in :class:`~carthage_windows.config.WindowsConfig` scriptlet lists run alone: each waits for every earlier scriptlet to finish.  A :class:`Scriptlet` with *parallel* set runs as a background job as soon as the scriptlets named in *after* have finished, alongside whatever else is running::
+
+        Scriptlet('c:\\windows\\setup\\tool.exe /S', name='tool', parallel=True)
+
+    :param after: Names of earlier scriptlets this one depends on.
+
+    :param lock: Parallel scriptlets with the same lock run one at a time.  Windows Installer runs one installation at a time and fails others with status 1618, so :func:`~carthage_windows.config.install_msi` uses the ``msiexec`` lock.
+
+    A parallel scriptlet runs in its own powershell process with the directory containing the script as its working directory; it cannot use ``$PSScriptRoot`` or variables set by other scriptlets.
+    '''
+
+    def __new__(cls, code, *, name=None, after=(), parallel=False, lock=None):
+        self = super().__new__(cls, code)
+        self.name = name
+        self.after = tuple(after)
+        self.parallel = parallel
+        self.lock = lock
+        return self
+
+__all__ += ['Scriptlet']
+
+def _step(phase, index, scriptlet):
+    return [
+        send_event(phase, 'step-start', f'{index} {step_description(scriptlet)}'),
+        '$global:LASTEXITCODE = 0',
+        "$CarthageStatus = 'exception'",
+        'try {',
+        scriptlet,
+        '$CarthageStatus = $LASTEXITCODE',
+        '} catch { Write-Output $_ }',
+        ]
+
+def monitored_script(phase, scriptlets):
+    '''
+    :returns: A powershell script running *scriptlets* in order, except that :class:`Scriptlet` marked parallel run as background jobs (see :class:`Scriptlet`).  The script reports the start and finish of *phase*, and the start, finish and status of each scriptlet (a step).  The status of a step is the value of ``$LASTEXITCODE`` after it runs, or ``exception`` if it throws.
+
+    The whole phase is one uncompressed script.  Scriptlets are not bundled or compressed separately: the scripts are a few kilobytes read from a local CD, and decompressing them would need another step in the guest before the phase can run.
+    '''
+    names = {}
+    for index, scriptlet in enumerate(scriptlets):
+        for dependency in getattr(scriptlet, 'after', ()):
+            if dependency not in names:
+                raise ValueError(f'{phase} step {index} runs after {dependency}, which is not an earlier step')
+        if name := getattr(scriptlet, 'name', None):
+            names[name] = index
+    parallel = any(getattr(s, 'parallel', False) for s in scriptlets)
+    result = [send_event_powershell, send_event(phase, 'start')]
+    if parallel:
+        result.extend([
+            f"$CarthageSteps = 'c:\\windows\\setup\\carthage-steps\\{phase}'",
+            'Remove-Item -Recurse -Force $CarthageSteps -ErrorAction SilentlyContinue',
+            'New-Item -ItemType Directory -Force $CarthageSteps | Out-Null',
+            'function Wait-CarthageJobs { Get-Job | Wait-Job | Receive-Job; Get-Job | Remove-Job }',
+            ])
+    for index, scriptlet in enumerate(scriptlets):
+        finish = send_event(phase, 'step-finish', f'{index} $CarthageStatus', expand=True)
+        if not getattr(scriptlet, 'parallel', False):
+            if parallel:
+                result.append('Wait-CarthageJobs')
+            result.extend(_step(phase, index, scriptlet))
+            result.append(finish)
+            if parallel:
+                result.append(f'New-Item -ItemType File -Force "$CarthageSteps\\{index}" | Out-Null')
+            continue
+        job = ['param($CarthageSteps, $CarthageRoot)', send_event_powershell, 'Set-Location $CarthageRoot']
+        for dependency in scriptlet.after:
+            job.append(f'while (-not (Test-Path "$CarthageSteps\\{names[dependency]}")) {{ Start-Sleep -Milliseconds 250 }}')
+        if scriptlet.lock:
+            job.extend([
+                f"$CarthageLock = New-Object System.Threading.Mutex $false, 'Global\\Carthage-{scriptlet.lock}'",
+                '[void]$CarthageLock.WaitOne()'])
+        job.extend(_step(phase, index, scriptlet))
+        if scriptlet.lock:
+            job.append('$CarthageLock.ReleaseMutex()')
+        job.extend([
+            f'New-Item -ItemType File -Force "$CarthageSteps\\{index}" | Out-Null',
+            finish])
+        result.extend([
+            f'Start-Job -Name carthage-{index} -ArgumentList $CarthageSteps, $PSScriptRoot -ScriptBlock {{',
+            *job,
+            '} | Out-Null'])
+    if parallel:
+        result.append('Wait-CarthageJobs')
+    result.append(send_event(phase, 'finish'))
+    return ''.join(s+'\n' for s in result)+'\n'
+
+__all__ += ['monitored_script']
+
+class InstallFailed(RuntimeError):
+
+    '''
+    The guest reported a failed step, or a step did not finish in time.
+    '''
+    pass
+
+__all__ += ['InstallFailed']
+
+@dataclasses.dataclass
+class GuestEvent:
+
+    #: Guest clock, seconds since the epoch
+    timestamp: float
+    phase: str
+    event: str
+    detail: str = ''
+    #: Host clock when the event was received
+    received: float = 0.0
+
+    @classmethod
+    def parse(cls, line:str):
+        '''
+        :returns: a GuestEvent or None if *line* is not an event.
+        '''
+        line = line.strip()
+        start = line.find(event_marker)
+        if start < 0: return None
+        parts = line[start:].split(None, 4)
+        if len(parts) < 4: return None
+        try:
+            timestamp = int(parts[1])/1000
+        except ValueError:
+            return None
+        return cls(timestamp=timestamp, phase=parts[2], event=parts[3],
+                   detail=parts[4] if len(parts) > 4 else '')
+
+__all__ += ['GuestEvent']
+
+class GuestChannel:
+
+    '''
+    Read :class:`GuestEvent` from the serial console of a running :class:`carthage.vm.Vm`::
+
+        async with GuestChannel(vm) as channel:
+            async for event in channel:
+                ...
+
+    '''
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.fd = None
+        self.reader = None
+
+    async def __aenter__(self):
+        result = await sh.virsh('ttyconsole', self.vm.full_name, _bg=True, _bg_exc=False)
+        pty = str(result.stdout, 'utf-8').strip()
+        self.fd = os.open(pty, os.O_RDONLY|os.O_NOCTTY|os.O_NONBLOCK)
+        tty.setraw(self.fd)
+        loop = asyncio.get_running_loop()
+        self.reader = asyncio.StreamReader()
+        self.transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self.reader),
+            os.fdopen(self.fd, 'rb', buffering=0))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.transport.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            try:
+                line = await self.reader.readline()
+            except OSError:
+                # The pty goes away when the VM shuts down
+                line = b''
+            if not line: raise StopAsyncIteration
+            event = GuestEvent.parse(str(line, 'utf-8', 'replace'))
+            if event:
+                event.received = time.time()
+                logger.debug('Guest event: %s', event)
+                return event
+
+__all__ += ['GuestChannel']
@@ -0,0 +1,298 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Layer images: thin images built on top of a generalized Windows image by running only the changes from additional :class:`WinConfigPlugin`.
+
+A layer is a qcow2 overlay whose backing file is the base image.  The layer VM boots the base with a :class:`LayerCd` attached.  In the specialize pass, the hook installed by :class:`~carthage_windows.cd.AutoUnattendCd` runs the specialize scriptlets of the layer and arranges for the firstlogon scriptlets to run at the next logon; those finish by generalizing the image again, so layers can themselves be used as bases.
+
+Plugins registered directly in the layer model are the delta::
+
+    class office(LibvirtWindowsLayerImage):
+        name = 'windows_office'
+        add_provider(OfficeInstall)
+
+'''
+
+import asyncio
+import logging
+import shutil
+import uuid
+from pathlib import Path
+import carthage
+from carthage import *
+from carthage.modeling import *
+from carthage import files
+from carthage import sh
+from .config import *
+from .bulkcopy import bulk_copy, clone_file
+from .cache import AssetCache, link_out
+from .cd import AutoUnattendCd, LibvirtWindowsBaseImage, send_event, sysprep_command, trim_command
+from .fingerprint import Fingerprint
+from .guest_channel import monitored_script
+from .profiling import BuildProfile
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+#: Directory on a layer CD holding the layer
+layer_dir = 'carthage-layer'
+
+winlogon_key = 'HKLM:\\SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion\\Winlogon'
+
+async def layer_config(ainjector, stop_at) -> WindowsConfig:
+    '''
+    :returns: A :class:`WindowsConfig` with the settings of the base image but only the files and scriptlets added by the :class:`WinConfigPlugin` registered between *ainjector* and *stop_at*.
+    '''
+    base_cd = await ainjector.get_instance_async(AutoUnattendCd)
+    base_config = await base_cd.ainjector.get_instance_async(WindowsConfig)
+    builder = await ainjector.get_instance_async(WindowsConfigBuilder)
+    return await builder.build(blank_config(base_config), ainjector, stop_at=stop_at)
+
+__all__ += ['layer_config']
+
+@inject_autokwargs(
+    image=InjectionKey(carthage.image.ImageVolume, _ready=False),
+    asset_cache=AssetCache,
+    build_profile=BuildProfile,
+    )
+class LayerCd(SetupTaskMixin):
+
+    '''
+    The CD attached while building a :class:`LibvirtWindowsLayerImage`.  It contains the oem and driver files of the layer's :class:`WindowsConfig` along with ``layer.ps1`` (run in specialize) and ``firstlogon.ps1``.
+    '''
+
+    @property
+    def stamp_subdir(self):
+        return 'carthage_windows/layer_cd/'+self.image.name
+
+    @staticmethod
+    def layer_scripts(wconfig:WindowsConfig, *, generalize=True, prepare=()) -> dict[str, str]:
+        '''
+        :returns: The contents of ``layer.ps1`` and ``firstlogon.ps1`` for *wconfig*.
+
+        :param generalize: Finish with sysprep.  If False and *wconfig* has no firstlogon scriptlets, there is no ``firstlogon.ps1``.
+
+        :param prepare: Scriptlets run in specialize before those of *wconfig*.
+        '''
+        password = (wconfig.admin_password or 'admin').replace("'", "''")
+        firstlogon_command = 'powershell.exe -NoProfile -ExecutionPolicy Unrestricted -Command "& c:\\windows\\setup\\layer_firstlogon.ps1 *> c:\\windows\\setup\\layer_firstlogon.log"'
+        specialize = [
+            *prepare,
+            f'if (Test-Path "$PSScriptRoot\\oem") {{ Copy-Item -Recurse -Force "$PSScriptRoot\\oem\\*" c:\\windows\\setup\\ }}',
+            f'if (Test-Path "$PSScriptRoot\\drivers") {{ pnputil /add-driver "$PSScriptRoot\\drivers\\*.inf" /subdirs /install }}',
+            *wconfig.specialize_powershell,
+        ]
+        if not (generalize or wconfig.firstlogon_powershell):
+            return {'layer.ps1': monitored_script('specialize', specialize)}
+        specialize.append(
+            '\n'.join([
+                'Copy-Item -Force "$PSScriptRoot\\firstlogon.ps1" c:\\windows\\setup\\layer_firstlogon.ps1',
+                f"Set-ItemProperty '{winlogon_key}' AutoAdminLogon '1'",
+                f"Set-ItemProperty '{winlogon_key}' DefaultUserName 'Admin'",
+                f"Set-ItemProperty '{winlogon_key}' DefaultPassword '{password}'",
+                f"Set-ItemProperty '{winlogon_key}' AutoLogonCount 1 -Type DWord",
+                f"New-ItemProperty 'HKLM:\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\RunOnce' -Name CarthageLayer -Force -Value '{firstlogon_command}'",
+                ]))
+        firstlogon = [
+            '\n'.join([
+                f"Remove-ItemProperty '{winlogon_key}' DefaultPassword -ErrorAction SilentlyContinue",
+                f"Set-ItemProperty '{winlogon_key}' AutoAdminLogon '0'",
+                ]),
+            *wconfig.firstlogon_powershell,
+        ]
+        if generalize:
+            if wconfig.trim_before_generalize:
+                firstlogon.append(trim_command)
+            firstlogon.extend([send_event('sysprep', 'start'), sysprep_command])
+        return {
+            'layer.ps1': monitored_script('specialize', specialize),
+            'firstlogon.ps1': monitored_script('firstlogon', firstlogon),
+        }
+
+    async def fingerprint(self):
+        wconfig = await self.ainjector.get_instance_async(WindowsConfig)
+        fp = Fingerprint()
+        for name, contents in sorted(self.layer_scripts(wconfig).items()):
+            fp.add(name, contents)
+        for oem_file in wconfig.oem_files:
+            await fp.add_path('oem', oem_file)
+        for driver_file in wconfig.driver_files:
+            await fp.add_path('driver', driver_file)
+        return fp.hexdigest()
+
+    async def input_stamp(self):
+        '''
+        A digest of the layer's plugins and their inputs, or None if a plugin does not report its inputs; see :meth:`WindowsConfigBuilder.input_stamp`.
+        '''
+        builder = await self.ainjector.get_instance_async(WindowsConfigBuilder)
+        return await builder.input_stamp(self.image.ainjector, stop_at=self.image.injector)
+
+    async def payload_files(self) -> list[Path]:
+        '''
+        :returns: The OEM and driver files placed on the CD.
+        '''
+        wconfig = await self.ainjector.get_instance_async(WindowsConfig)
+        return [*map(Path, wconfig.oem_files), *map(Path, wconfig.driver_files)]
+
+    async def build_cd(self, output:Path):
+        '''
+        Master the layer CD into *output*.
+        '''
+        wconfig = await self.ainjector.get_instance_async(WindowsConfig)
+        iso_builder = files.CdContext(output.parent, output.name)
+        async with self.build_profile.stage('master_layer', layer=self.image.name) as stage:
+            async with iso_builder as contents_path:
+                layer_path = contents_path/layer_dir
+                layer_path.mkdir()
+                items = [(oem_file, layer_path/'oem') for oem_file in wconfig.oem_files]
+                items += [(driver_file, layer_path/'drivers') for driver_file in wconfig.driver_files]
+                stats = await bulk_copy(items)
+                stage.files = stats.files
+                for name, contents in self.layer_scripts(wconfig).items():
+                    layer_path.joinpath(name).write_text(contents)
+            stage.bytes = output.stat().st_size
+
+    @setup_task("Create layer CD")
+    async def create_layer_cd(self):
+        await self.asset_cache.fetch(
+            await self.fingerprint(), self.build_cd,
+            self.stamp_path/'layer.iso')
+
+    @create_layer_cd.hash()
+    async def create_layer_cd(self):
+        return await self.fingerprint()
+
+    @create_layer_cd.invalidator()
+    def create_layer_cd(self, **kwargs):
+        return self.stamp_path.joinpath('layer.iso').exists()
+
+    def qemu_config(self, disk_config):
+        return dict(
+            path=self.stamp_path/'layer.iso',
+            source_type='file',
+            driver='raw',
+            qemu_source='file'
+        )
+
+__all__ += ['LayerCd']
+
+@inject_autokwargs(asset_cache=AssetCache)
+class LibvirtWindowsLayerImage(LibvirtWindowsBaseImage):
+
+    '''
+    A thin image containing the changes made by the :class:`WinConfigPlugin` registered in this model on top of :attr:`base_key`.
+
+    Layers are stored in the :class:`~carthage_windows.cache.AssetCache` keyed by the :meth:`~LibvirtWindowsBaseImage.install_id` of the base and the fingerprint of the layer's plugins, so rebuilding a layer that has been built before (for example after reverting a plugin change) only needs a copy.  The base's install id rather than its fingerprint is used because the layer is an overlay on the base's bytes: reinstalling the base from unchanged media invalidates its layers.  Like any other image, a layer should be cloned rather than booted directly.
+
+    '''
+
+    name = 'windows_layer'
+
+    #: The image this layer is built on: a :class:`LibvirtWindowsBaseImage` or another layer.
+    base_key = InjectionKey(carthage.vm.LibvirtCreatedImage, name='windows_base')
+
+    #: The overlay has the size of its base.
+    size = 0
+
+    #: The install runs on the overlay :meth:`do_create` makes over the base, so it can neither move to *windows.build_scratch_dir* nor be checkpointed.
+    direct_install = True
+
+    add_provider(LayerCd)
+    disk_config = [
+        dict(
+            volume=InjectionKey(carthage.image.ImageVolume, _ready=False),),
+        dict(
+            volume=InjectionKey(LayerCd),
+            target_type='cdrom',
+            bus='sata',
+            )]
+
+    install_media = (LayerCd,)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.injector.add_provider(InjectionKey(WindowsConfig), self.build_config)
+
+    async def base_volume(self):
+        return await self.ainjector.get_instance_async(self.base_key)
+
+    async def build_config(self) -> WindowsConfig:
+        '''
+        The settings of the base with only the files and scriptlets from plugins registered directly in this model.
+        '''
+        return await layer_config(self.ainjector, self.injector)
+
+    async def fingerprint(self):
+        base = await self.base_volume()
+        fp = Fingerprint()
+        fp.add('base', base.install_id())
+        fp.add('layer', await super().fingerprint())
+        return fp.hexdigest()
+
+    async def input_stamp(self):
+        layer = await super().input_stamp()
+        if layer is None: return None
+        base = await self.base_volume()
+        fp = Fingerprint()
+        fp.add('base', base.install_id())
+        fp.add('layer', layer)
+        return fp.hexdigest()
+
+    async def find(self):
+        found = await super().find()
+        if not found and self.qemu_format != 'qcow2':
+            # Layers are always qcow2 so they can have a backing file.
+            self.path = self.path.with_suffix('.qcow2')
+            self.qemu_format = 'qcow2'
+            self.creating_path = self.path.with_suffix('.carthage-creating')
+            return self.path.exists() and not self.creating_path.exists()
+        return found
+
+    async def do_create(self):
+        base = await self.base_volume()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.clear_stamps_and_cache()
+        try:
+            self.creating_path.touch()
+            await sh.qemu_img(
+                'create',
+                '-fqcow2',
+                '-b'+str(base.path),
+                '-F'+base.qemu_format,
+                str(self.path))
+            shutil.rmtree(self.stamp_path, ignore_errors=True)
+            self.stamp_path.mkdir(parents=True, exist_ok=True)
+            await self.populate()
+            self.creating_path.unlink()
+        except Exception:
+            self.path.unlink(missing_ok=True)
+            self.creating_path.unlink(missing_ok=True)
+            raise
+
+    async def build_layer(self, output:Path):
+        '''
+        Install the layer and store it in *output* as ``layer.qcow2`` along with its install id.
+        '''
+        await self.install()
+        output.mkdir()
+        await asyncio.to_thread(clone_file, self.path, output/'layer.qcow2', link=False)
+        output.joinpath('install_id').write_text(uuid.uuid4().hex)
+
+    async def create_volume(self, fingerprint):
+        cached = await self.asset_cache.fetch(
+            fingerprint, self.build_layer, limit_io=False)
+        await asyncio.to_thread(link_out, cached/'layer.qcow2', self.path, writable=True)
+        # Layers built on this one are keyed by the cached install, not this copy of it.
+        return cached.joinpath('install_id').read_text()
+
+    def qemu_config(self, disk_config):
+        return dict(super().qemu_config(disk_config), driver='qcow2')
+
+__all__ += ['LibvirtWindowsLayerImage']
@@ -0,0 +1,98 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Build several Windows images (versions, editions and plugin sets) in one run::
+
+    class layout(carthage_windows.layout.layout):
+
+        class images(WindowsImageMatrix):
+            entries = [
+                MatrixEntry('w10'),
+                MatrixEntry('w11'),
+                MatrixEntry('w11', 'enterprise', plugins=(OfficeInstall,)),
+                MatrixEntry('2k22', 'standard'),
+            ]
+
+    await layout.images.build_all()
+
+Each entry gets its own injector with its own :data:`windows_version_key`, install media and plugins; plugins in the layout apply to every entry.  Stages that entries share are done once: the virtio CD is extracted once for every version in the matrix (see :meth:`QemuDrivers.windows_versions <carthage_windows.qemu.QemuDrivers.windows_versions>`), and entries using the same install ISO share one repack through the :class:`~carthage_windows.cache.AssetCache`.
+
+'''
+
+import asyncio
+import logging
+from carthage import *
+from carthage.modeling import *
+from .config import *
+from .cd import AutoUnattendCd, LibvirtWindowsBaseImage, NoPromptInstallImage
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+class WindowsImageMatrix(AsyncInjectable):
+
+    '''
+    A set of :class:`MatrixEntry` built together.  Subclass and set :attr:`entries`.
+    '''
+
+    entries: list[MatrixEntry] = []
+
+    #: The class of each image; instantiated with the name of the entry.
+    image_class = LibvirtWindowsBaseImage
+
+    @classmethod
+    def default_class_injection_key(cls):
+        return InjectionKey(WindowsImageMatrix)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._images = {}
+
+    @property
+    def windows_versions(self):
+        return sorted({e.windows_version for e in self.entries})
+
+    def entry_injector(self, entry:MatrixEntry) -> Injector:
+        injector = self.injector(Injector)
+        injector.add_provider(InjectionKey(MatrixEntry), entry)
+        injector.add_provider(windows_version_key, entry.windows_version)
+        injector.add_provider(NoPromptInstallImage)
+        injector.add_provider(AutoUnattendCd)
+        for plugin in entry.plugins:
+            injector.add_provider(plugin)
+        return injector
+
+    async def image(self, entry:MatrixEntry):
+        '''
+        :returns: The image for *entry*, not yet ready.
+        '''
+        try:
+            return self._images[entry.name]
+        except KeyError: pass
+        ainjector = self.entry_injector(entry)(AsyncInjector)
+        with instantiation_not_ready():
+            image = await ainjector(self.image_class, name=entry.name)
+        image.install_priority = entry.priority
+        self._images[entry.name] = image
+        return image
+
+    async def build_all(self):
+        '''
+        Build every entry.  Install media are prepared concurrently; the installs themselves are admitted by the :class:`~carthage_windows.scheduler.InstallScheduler` as the host has room for them.
+        '''
+        async def build(entry):
+            image = await self.image(entry)
+            await image.prepare_install_media()
+            logger.info('Building %s', entry.name)
+            await image.async_become_ready()
+            return image
+        return await asyncio.gather(*(build(e) for e in self.entries))
+
+__all__ += ['WindowsImageMatrix']
@@ -0,0 +1,264 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+A pool of Windows VMs that have already booted, for short lived test workloads::
+
+    class layout(carthage_windows.layout.layout):
+
+        class test_vm(WindowsCloneModel):
+            add_provider(machine_implementation_key, dependency_quote(carthage.vm.Vm))
+
+        class pool(WindowsVmPool):
+            slot_model = test_vm
+            size = 4
+
+    async with layout.pool.lease() as vm:
+        await vm.ssh('powershell ls')
+
+Each slot is a clone of :attr:`WindowsVmPool.slot_model` named ``<model>-<n>``.  A slot is booted once, through specialize and OOBE until ssh answers, and then a live external snapshot is taken into ``warm`` under the stamp path of the machine: guest memory is saved to ``warm.mem``, the clone becomes read-only and ``work.qcow2`` takes its place.  Leasing a slot resumes it; returning it recreates ``work.qcow2`` empty and restores ``warm.mem`` with ``virsh restore``, discarding whatever the workload changed.  Libvirt refuses internal snapshots with memory for the UEFI and TPM machines Carthage creates, so internal snapshots are not used.  Slots must use ``overlay`` clones so their disks are qcow2.
+
+'''
+
+import asyncio
+import contextlib
+import dataclasses
+import logging
+import shutil
+import time
+import types
+import xml.etree.ElementTree as ET
+from pathlib import Path
+import carthage
+from carthage import *
+from carthage.modeling import *
+from carthage import sh
+from .checkpoint import domain_disks
+from .clone import WindowsCloneModel
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+@dataclasses.dataclass
+class PoolMetrics:
+
+    #: Leases satisfied by an idle slot
+    hits: int = 0
+    #: Leases that had to wait for a slot
+    misses: int = 0
+    #: Seconds from each lease request until a VM was handed out
+    lease_latency: list = dataclasses.field(default_factory=lambda: [])
+
+    def summary(self) -> dict:
+        latency = sorted(self.lease_latency)
+        def percentile(p):
+            return latency[min(len(latency)-1, int(len(latency)*p))] if latency else 0.0
+        return dict(
+            leases=len(latency),
+            hits=self.hits,
+            misses=self.misses,
+            latency_p50=percentile(0.5),
+            latency_p95=percentile(0.95),
+            latency_max=latency[-1] if latency else 0.0)
+
+__all__ += ['PoolMetrics']
+
+class WindowsVmPool(AsyncInjectable):
+
+    #: The :class:`WindowsCloneModel` each slot is cloned from
+    slot_model: type[WindowsCloneModel]
+
+    #: Number of slots
+    size = 2
+
+    #: ``paused``: idle slots are restored but paused, and a lease only resumes the VM, but each idle slot holds its memory.  ``saved``: idle slots are shut off and a lease restores the warm state, which takes a few seconds to load memory.
+    idle_mode = 'paused'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = PoolMetrics()
+        self.slots = []
+        self.idle = asyncio.Queue()
+        self._started = None
+        #: Slots being returned to :attr:`idle`
+        self._returning = set()
+        #: ``(machine, exception)`` for each slot that could not be returned; such a slot is not leased again.
+        self.failures = []
+
+    async def make_slot(self, index):
+        base = self.slot_model
+        model_class = types.new_class(
+            f'{base.__name__}_{index}', (base,), {},
+            lambda ns: ns.update(name=f'{base.name}-{index}'))
+        model = await self.ainjector(model_class)
+        machine = await model.ainjector.get_instance_async(carthage.machine.Machine)
+        return machine
+
+    @staticmethod
+    def warm_path(machine) -> Path:
+        '''
+        The directory holding the warm state of *machine*.
+        '''
+        return Path(machine.stamp_path)/'warm'
+
+    async def warm_slot(self, machine):
+        '''
+        Boot *machine* until ssh answers and take its warm state.  The machine is left shut off.
+        '''
+        start = time.time()
+        warm = self.warm_path(machine)
+        shutil.rmtree(warm, ignore_errors=True)
+        await machine.start_machine()
+        await machine.ssh_online()
+        warm.mkdir(parents=True)
+        disks = await domain_disks(machine.full_name)
+        if [device for device, _ in disks].count('disk') != 1:
+            raise ValueError(f'{machine.name}: a pool slot must have exactly one disk')
+        args = ['--memspec', f'file={warm/"warm.mem"},snapshot=external']
+        for device, target in disks:
+            if device == 'disk':
+                args += ['--diskspec', f'{target},snapshot=external,file={warm/"work.qcow2"}']
+            else:
+                args += ['--diskspec', f'{target},snapshot=no']
+        await sh.virsh('snapshot-create-as', machine.full_name, 'carthage-warm',
+                       '--no-metadata', '--atomic', '--halt', *args,
+                       _bg=True, _bg_exc=False)
+        xml = await sh.virsh('save-image-dumpxml', str(warm/'warm.mem'), '--security-info',
+                             _bg=True, _bg_exc=False)
+        warm.joinpath('warm.xml').write_text(self.restore_xml(str(xml.stdout, 'utf-8'), warm/'work.qcow2'))
+        logger.info('Warmed %s in %.0f seconds', machine.name, time.time()-start)
+
+    @staticmethod
+    def restore_xml(xml:str, work:Path) -> str:
+        '''
+        :returns: The domain *xml* saved with the warm state, with *work* as the source of its disk.  The backing chain is read from *work* when the domain is restored.
+        '''
+        root = ET.fromstring(xml)
+        for disk in root.iterfind('devices/disk'):
+            if disk.get('device') != 'disk': continue
+            disk.set('type', 'file')
+            for element in disk.findall('backingStore'):
+                disk.remove(element)
+            source = disk.find('source')
+            source.attrib.clear()
+            source.set('file', str(work))
+            disk.find('driver').set('type', 'qcow2')
+        return ET.tostring(root, encoding='unicode')
+
+    async def reset(self, machine):
+        '''
+        Shut off *machine* and recreate its ``work.qcow2`` empty on top of the clone.
+        '''
+        await sh.virsh('destroy', machine.full_name, _ok_code=[0, 1])
+        work = self.warm_path(machine)/'work.qcow2'
+        work.unlink(missing_ok=True)
+        await sh.qemu_img('create', '-fqcow2', '-b', str(machine.volume.path), '-Fqcow2', str(work))
+
+    async def restore(self, machine, *, paused:bool):
+        warm = self.warm_path(machine)
+        await sh.virsh('restore', str(warm/'warm.mem'), '--xml', str(warm/'warm.xml'),
+                       '--paused' if paused else '--running',
+                       _bg=True, _bg_exc=False)
+
+    async def make_idle(self, machine):
+        '''
+        Reset *machine* to its warm state and add it to :attr:`idle`.
+        '''
+        if self.idle_mode not in ('paused', 'saved'):
+            raise ValueError(f'Unknown idle_mode {self.idle_mode}')
+        await self.reset(machine)
+        if self.idle_mode == 'paused':
+            await self.restore(machine, paused=True)
+        self.idle.put_nowait(machine)
+
+    def return_slot(self, machine):
+        '''
+        Return *machine* to :attr:`idle` in the background.  If that fails the slot is recorded in :attr:`failures`; once no slot is left, every waiting and future :meth:`lease` raises.
+        '''
+        def done(future):
+            self._returning.discard(future)
+            if not future.cancelled() and (exc := future.exception()):
+                logger.error('Unable to return %s to the pool', machine.name, exc_info=exc)
+                self.failures.append((machine, exc))
+                if len(self.failures) == len(self.slots):
+                    # Wake leases waiting for a slot
+                    self.idle.put_nowait(None)
+        future = asyncio.ensure_future(self.make_idle(machine))
+        self._returning.add(future)
+        future.add_done_callback(done)
+
+    async def activate(self, machine):
+        if self.idle_mode == 'paused':
+            await sh.virsh('resume', machine.full_name)
+        else:
+            await self.restore(machine, paused=False)
+        # The guest clock stopped when the snapshot was taken
+        try:
+            await sh.virsh('domtime', machine.full_name, '--sync')
+        except sh.ErrorReturnCode:
+            logger.debug('Unable to set the time of %s', machine.name)
+
+    async def start(self):
+        '''
+        Create and warm every slot.  Called by the first :meth:`lease` if not called explicitly.
+        '''
+        if not self._started:
+            async def start():
+                self.slots = await asyncio.gather(*(
+                    self.make_slot(i) for i in range(self.size)))
+                await asyncio.gather(*(self.warm_slot(m) for m in self.slots))
+                await asyncio.gather(*(self.make_idle(m) for m in self.slots))
+            self._started = asyncio.ensure_future(start())
+        await self._started
+
+    @contextlib.asynccontextmanager
+    async def lease(self):
+        '''
+        An asynchronous context manager yielding a running :class:`carthage.machine.Machine`.  The machine is reset to its warm state when the context exits.
+        '''
+        requested = time.time()
+        warm = self._started is not None and self._started.done()
+        await self.start()
+        hit = warm and not self.idle.empty()
+        machine = await self.idle.get()
+        if machine is None:
+            # Left for the next waiting lease
+            self.idle.put_nowait(None)
+            raise RuntimeError(f'No slot of the pool is usable: {self.failures[-1][1]}')
+        if hit:
+            self.metrics.hits += 1
+        else:
+            self.metrics.misses += 1
+        try:
+            await self.activate(machine)
+        except Exception:
+            self.return_slot(machine)
+            raise
+        self.metrics.lease_latency.append(time.time()-requested)
+        try:
+            yield machine
+        finally:
+            # Resetting does not delay the caller
+            self.return_slot(machine)
+
+    async def delete(self):
+        '''
+        Destroy every slot.
+        '''
+        await asyncio.gather(*self._returning, return_exceptions=True)
+        for machine in self.slots:
+            await sh.virsh('destroy', machine.full_name, _ok_code=[0, 1])
+            shutil.rmtree(self.warm_path(machine), ignore_errors=True)
+            await machine.delete()
+        self.slots = []
+        self.idle = asyncio.Queue()
+        self.failures = []
+        self._started = None
+
+__all__ += ['WindowsVmPool']
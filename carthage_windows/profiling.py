@@ -0,0 +1,149 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Timing and byte counts for the stages of a Windows image build.
+
+Stages are recorded in a :class:`BuildProfile`, which can be written as JSON or as a Chrome trace (load it in ``chrome://tracing`` or https://ui.perfetto.dev).  Each completed stage is also emitted as a ``stage_complete`` event on ``InjectionKey(BuildProfile)``.
+
+'''
+
+import contextlib
+import dataclasses
+import json
+import os
+import time
+from pathlib import Path
+from carthage import *
+from carthage.setup_tasks import mako_task
+
+__all__ = []
+
+@dataclasses.dataclass
+class Stage:
+
+    name: str
+    #: ``host`` for work done by Carthage, ``guest`` for phases reported by the installing VM, ``guest-step`` for the steps within those phases
+    category: str = 'host'
+    start: float = 0.0
+    end: float = 0.0
+    bytes: int = 0
+    files: int = 0
+    #: Anything else worth recording, such as the ISO involved
+    attrs: dict = dataclasses.field(default_factory=lambda: {})
+
+    @property
+    def duration(self):
+        return self.end-self.start
+
+__all__ += ['Stage']
+
+@inject_autokwargs(injector=Injector)
+class BuildProfile(Injectable):
+
+    '''
+    Collects :class:`Stage` records.  Typical usage in a setup task::
+
+        async with self.build_profile.stage('extract_cd', iso=image.name) as stage:
+            # do the work
+            stage.bytes = bytes_written
+
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.stages: list[Stage] = []
+
+    def record(self, stage:Stage):
+        self.stages.append(stage)
+        self.injector.emit_event(
+            InjectionKey(BuildProfile), 'stage_complete', self,
+            stage=stage)
+
+    @contextlib.asynccontextmanager
+    async def stage(self, name, category='host', **attrs):
+        stage = Stage(name=name, category=category, attrs=attrs)
+        stage.start = time.time()
+        try:
+            yield stage
+        except Exception as e:
+            stage.attrs['error'] = repr(e)
+            raise
+        finally:
+            stage.end = time.time()
+            self.record(stage)
+
+    def to_json(self):
+        return [dict(dataclasses.asdict(s), duration=s.duration) for s in self.stages]
+
+    def to_chrome_trace(self):
+        '''
+        :returns: The stages in the Chrome trace event format.  Host and guest stages appear as separate threads.
+        '''
+        if not self.stages: return dict(traceEvents=[])
+        origin = min(s.start for s in self.stages)
+        threads = {'host': 1, 'guest': 2}
+        events = []
+        for s in self.stages:
+            events.append(dict(
+                name=s.name,
+                cat=s.category,
+                ph='X',
+                ts=int((s.start-origin)*1e6),
+                dur=int(s.duration*1e6),
+                pid=os.getpid(),
+                tid=threads.setdefault(s.category, len(threads)+1),
+                args=dict(s.attrs, bytes=s.bytes, files=s.files)))
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def write(self, path:Path):
+        '''
+        Write *path*.json and *path*.trace.json.
+        '''
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.with_name(path.name+'.json').write_text(json.dumps(self.to_json(), indent=2))
+        path.with_name(path.name+'.trace.json').write_text(json.dumps(self.to_chrome_trace()))
+
+__all__ += ['BuildProfile']
+
+def tree_size(path:Path):
+    '''
+    :returns: (bytes, files) under *path*, which may be a file.
+    '''
+    path = Path(path)
+    if not path.is_dir():
+        return path.stat().st_size, 1
+    size = files = 0
+    for root, dirs, filenames in os.walk(path):
+        for f in filenames:
+            size += os.stat(os.path.join(root, f)).st_size
+            files += 1
+    return size, files
+
+__all__ += ['tree_size']
+
+class profiled_mako_task(mako_task):
+
+    '''
+    A :class:`carthage.setup_tasks.mako_task` that records its rendering time in the :class:`BuildProfile` of the instance.
+    '''
+
+    def render(task, instance, **kwargs):
+        stage = Stage(name=f'render {task.output}')
+        stage.start = time.time()
+        try:
+            return super().render(instance, **kwargs)
+        finally:
+            stage.end = time.time()
+            output = Path(instance.stamp_path)/task.output
+            if output.exists():
+                stage.bytes, stage.files = tree_size(output)
+            instance.injector.get_instance(BuildProfile).record(stage)
+
+__all__ += ['profiled_mako_task']
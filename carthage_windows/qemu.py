@@ -13,30 +13,47 @@ import carthage.sh
 from carthage.modeling import *
 from .cd import extract_cd
 from .config import *
+from .assets import AssetCatalog, assets_path
+from .cache import AssetCache, link_out
+from .matrix import WindowsImageMatrix
+from .fingerprint import Fingerprint
+from .profiling import BuildProfile, tree_size
 
 __all__ = []
 
+#: Directory names used on the virtio CD for each windows version
+driver_versions = {
+    'w10': 'w10',
+    'w11': 'w11',
+    '2k19': '2k19',
+    '2k22': '2k22',
+    '2k25': '2k25',
+}
+
 def driver_version_str(windows_version):
-    if windows_version == 'w11':
-        return 'w11'
-    raise NotImplementedError
+    try:
+        return driver_versions[windows_version]
+    except KeyError:
+        raise NotImplementedError(f'No virtio drivers known for {windows_version}') from None
 
 @inject_autokwargs(
     carthage_windows=InjectionKey(CarthagePlugin, name='carthage-windows'),
+    windows_version=windows_version_key,
+    asset_cache=AssetCache,
+    asset_catalog=AssetCatalog,
+    build_profile=BuildProfile,
+    matrix=InjectionKey(WindowsImageMatrix, _optional=True, _ready=False),
     )
 class QemuDrivers(ModelTasks, WinConfigPlugin):
 
     name = 'qemu_windows_config'
+    independent = True
     
     def find_base_cd(self):
-        if assets_dir := self.config_layout.windows.assets_dir:
-            assets_path = Path(assets_dir)/'windows'
-        else:
-            assets_path = self.carthage_windows.resource_dir/'assets'
-        images = assets_path.glob('virtio-*.iso')
-        images_list = list(images)
-        assert len(images_list) == 1
-        return images_list[0]
+        image = self.asset_catalog.newest('virtio-*.iso')
+        if image is None:
+            raise FileNotFoundError(f'No virtio-*.iso in {self.injector(assets_path)}')
+        return image.path
 
     #: Things to grab from cd
     drivers = (
@@ -49,42 +66,97 @@ class QemuDrivers(ModelTasks, WinConfigPlugin):
         'virtio-win-gt-x64.msi',
         'guest-agent/qemu-ga-x86_64.msi',
     )
+
+    #: The MSI that installs the virtio drivers and services.  With ``offline`` :attr:`~carthage_windows.config.WindowsConfig.driver_injection` the drivers are already present, so it is only installed when a service it provides (virtiofs) is needed.
+    driver_msi = 'virtio-win-gt-x64.msi'
+
+    #: Architecture of drivers to extract
+    driver_arch = 'amd64'
+
+    #: If True, only extract the drivers for our windows version and :attr:`driver_arch`; otherwise extract every version of each driver.
+    narrow_drivers = True
+
+    def windows_versions(self):
+        '''
+        The windows versions drivers are needed for: ours, and every version in the :class:`~carthage_windows.matrix.WindowsImageMatrix` if there is one.  Every version is extracted at once so a matrix build reads the virtio CD once.
+        '''
+        versions = {self.windows_version}
+        if self.matrix:
+            versions.update(self.matrix.windows_versions)
+        return sorted(versions)
+
+    def extract_members(self):
+        '''
+        The paths on the virtio CD that :meth:`grab_virtio_drivers` needs.
+        '''
+        if self.narrow_drivers:
+            for version in self.windows_versions():
+                v = driver_version_str(version)
+                for d in self.drivers:
+                    yield f'{d}/{v}/{self.driver_arch}'
+            yield f'qxldod/w10/{self.driver_arch}' #For some reason no w11 build of qxl
+        else:
+            yield from self.drivers
+        yield from self.oem_msis
     
-    @setup_task("Pull out virtio drivers")
-    async def grab_virtio_drivers(self):
+    async def fingerprint(self):
+        fp = Fingerprint()
+        await fp.add_path('source', self.find_base_cd())
+        fp.add('members', *self.extract_members())
+        return fp.hexdigest()
+
+    async def extract_drivers(self, output:Path):
+        '''
+        Extract the drivers and MSIs into *output*/drivers and *output*/oem.
+        '''
         image = self.find_base_cd()
-        iso_out = self.stamp_path/'extract'
-        async with extract_cd(image, iso_out):
-            drivers = self.stamp_path/'drivers'
-            try:
-                shutil.rmtree(drivers)
-            except FileNotFoundError: pass
-            drivers.mkdir()
+        iso_out = output.parent/'extract'
+        async with self.build_profile.stage('extract_virtio_drivers', iso=image.name) as stage, \
+                   extract_cd(image, iso_out, members=list(self.extract_members())):
+            stage.bytes, stage.files = tree_size(iso_out)
+            # Everything extracted is on the same filesystem, so rename rather than copy.
+            drivers = output/'drivers'
+            drivers.mkdir(parents=True)
             for d in self.drivers:
-                await carthage.sh.rsync('-a',
-                                  iso_out/d, drivers)
-            oem = self.stamp_path/'oem'
-            try:
-                shutil.rmtree(oem)
-            except FileNotFoundError: pass
+                if iso_out.joinpath(d).exists():
+                    iso_out.joinpath(d).rename(drivers/d)
+            oem = output/'oem'
             oem.mkdir()
             for f in self.oem_msis:
-                await carthage.sh.rsync('-a', iso_out/f, str(oem))
+                iso_out.joinpath(f).rename(oem/Path(f).name)
+
+    @setup_task("Pull out virtio drivers")
+    async def grab_virtio_drivers(self):
+        cached = await self.asset_cache.fetch(
+            await self.fingerprint(),
+            self.extract_drivers)
+        for d in ('drivers', 'oem'):
+            link_out(cached/d, self.stamp_path/d)
+
+    @grab_virtio_drivers.hash()
+    async def grab_virtio_drivers(self):
+        return await self.fingerprint()
+
+    async def inputs(self):
+        return [self.stamp_path/'drivers', self.stamp_path/'oem', self.injector(assets_path)]
 
     async def apply(self, wconfig):
         oem = self.stamp_path/'oem'
         drivers = self.stamp_path/'drivers'
+        winfsp = self.injector(find_asset, 'winfsp*msi')
         for o in map(lambda p: Path(p), self.oem_msis):
+            if o.name == self.driver_msi and wconfig.driver_injection == 'offline' and not winfsp:
+                continue
             install_msi(wconfig, oem/(o.name))
         if result := self.injector(find_asset, 'spice-vdagent-x64*msi'):
             install_msi(wconfig, result)
-        if result := self.injector(find_asset, 'winfsp*msi'):
-            install_msi(wconfig, result)
+        if winfsp:
+            install_msi(wconfig, winfsp)
             wconfig.firstlogon_powershell.append('Set-Service VirtioFsSvc -StartupType Automatic -Status Running')
         v = driver_version_str(wconfig.windows_version)
         for d in self.drivers:
-            if list(drivers.glob(f'{d}/{v}/amd64')):
-                wconfig.driver_files.append(f'{drivers}/{d}/{v}/amd64/')
-            wconfig.driver_files.append(f'{drivers}/qxldod/w10/amd64/') #For some reason no w11 build of qxl
+            if list(drivers.glob(f'{d}/{v}/{self.driver_arch}')):
+                wconfig.driver_files.append(f'{drivers}/{d}/{v}/{self.driver_arch}/')
+            wconfig.driver_files.append(f'{drivers}/qxldod/w10/{self.driver_arch}/') #For some reason no w11 build of qxl
             
 __all__ += ['QemuDrivers']
@@ -0,0 +1,334 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Long lived PowerShell sessions for customizing running Windows machines.
+
+Each ``machine.ssh('powershell ...')`` pays for an ssh connection and a PowerShell start, which together take seconds on Windows.  A :class:`PowerShellSession` instead starts one PowerShell over :meth:`machine.ssh <carthage.machine.Machine.ssh>` running :data:`server_powershell`, which reads one JSON request per line and answers each with one result line.  Requests may be written before earlier ones finish; the guest runs them in order.  Scripts are dot sourced, so variables and functions persist for the life of the session.
+
+:func:`powershell_pool` returns the :class:`PowerShellPool` of a machine, which hands sessions to concurrent tasks::
+
+    pool = powershell_pool(vm)
+    result = await pool.run('Get-Service sshd | Select-Object Name, Status')
+    results = await pool.run_batch(['Set-Location c:\\\\', 'Get-ChildItem'])
+    await pool.put(Path('tool.msi'), 'c:\\\\windows\\\\temp\\\\tool.msi')
+
+'''
+
+import asyncio
+import base64
+import contextlib
+import dataclasses
+import itertools
+import json
+import logging
+import queue
+import weakref
+from pathlib import Path
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+#: Marker beginning each result line; anything else written to stdout (for example by Write-Host) is logged and ignored.
+result_marker = 'CARTHAGE-RESULT'
+
+#: Bytes of a file sent in each put request
+transfer_chunk = 4*1024**2
+
+#: The request loop run in the guest
+server_powershell = f'''\
+$ProgressPreference = 'SilentlyContinue'
+[Console]::OutputEncoding = New-Object System.Text.UTF8Encoding $false
+while ($null -ne ($CarthageLine = [Console]::In.ReadLine())) {{
+    $CarthageRequest = $CarthageLine | ConvertFrom-Json
+    $CarthageResponse = @{{id = $CarthageRequest.id; success = $true; output = @(); errors = @(); exit_code = $null}}
+    try {{
+        switch ($CarthageRequest.op) {{
+            'run' {{
+                $global:LASTEXITCODE = $null
+                $CarthageScript = [Text.Encoding]::UTF8.GetString([Convert]::FromBase64String($CarthageRequest.script))
+                foreach ($CarthageItem in @(. ([ScriptBlock]::Create($CarthageScript)) 2>&1)) {{
+                    if ($CarthageItem -is [Management.Automation.ErrorRecord]) {{
+                        $CarthageResponse.errors += $CarthageItem.ToString()
+                        $CarthageResponse.success = $false
+                    }} else {{
+                        $CarthageResponse.output += ,$CarthageItem
+                    }}
+                }}
+                $CarthageResponse.exit_code = $global:LASTEXITCODE
+                if ($global:LASTEXITCODE) {{ $CarthageResponse.success = $false }}
+            }}
+            'put' {{
+                $CarthageBytes = [Convert]::FromBase64String($CarthageRequest.data)
+                $CarthageMode = if ($CarthageRequest.offset) {{ 'Append' }} else {{ 'Create' }}
+                $CarthageFile = New-Object System.IO.FileStream $CarthageRequest.path, $CarthageMode
+                try {{ $CarthageFile.Write($CarthageBytes, 0, $CarthageBytes.Length) }} finally {{ $CarthageFile.Close() }}
+            }}
+            'get' {{
+                $CarthageResponse.output = @([Convert]::ToBase64String([IO.File]::ReadAllBytes($CarthageRequest.path)))
+            }}
+        }}
+    }} catch {{
+        $CarthageResponse.success = $false
+        $CarthageResponse.errors += $_.ToString()
+    }}
+    [Console]::Out.WriteLine('{result_marker} ' + (ConvertTo-Json $CarthageResponse -Compress -Depth 4))
+    [Console]::Out.Flush()
+}}
+'''
+
+__all__ += ['server_powershell']
+
+class RemoteCommandFailed(RuntimeError):
+
+    '''
+    A script run by :meth:`PowerShellSession.run` wrote an error or set a nonzero ``$LASTEXITCODE``.
+    '''
+
+    def __init__(self, script, result):
+        self.result = result
+        lines = script.strip().splitlines()
+        super().__init__(f'{lines[0] if lines else repr(script)}: '
+                         + '; '.join(result.errors or [f'exit code {result.exit_code}']))
+
+__all__ += ['RemoteCommandFailed']
+
+@dataclasses.dataclass
+class RemoteResult:
+
+    #: Objects the script output, converted with ConvertTo-Json
+    output: list
+    #: Each error record as a string
+    errors: list
+    #: ``$LASTEXITCODE`` after the script, or None if it ran no native command
+    exit_code: int|None
+    success: bool
+
+    @property
+    def text(self):
+        '''The output as lines of text, as a native command would print it.'''
+        return '\n'.join(o if isinstance(o, str) else json.dumps(o) for o in self.output)
+
+__all__ += ['RemoteResult']
+
+def encode_command(script:str) -> str:
+    '''
+    :returns: *script* encoded for ``powershell -EncodedCommand``, which avoids quoting it through ssh and cmd.
+    '''
+    return base64.b64encode(script.encode('utf-16-le')).decode('ascii')
+
+class PowerShellSession:
+
+    '''
+    One PowerShell process on *machine*, started by :meth:`start`.
+    '''
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.ids = itertools.count()
+        self.pending: dict[int, asyncio.Future] = {}
+        self.requests = queue.Queue()
+        self.process = None
+        self.closed = False
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        def on_line(line):
+            loop.call_soon_threadsafe(self._dispatch, line)
+        self.process = self.machine.ssh(
+            'powershell', '-NoProfile', '-NonInteractive', '-EncodedCommand', encode_command(server_powershell),
+            _in=self.requests, _out=on_line, _bg=True, _bg_exc=False)
+        self.waiter = asyncio.ensure_future(self._wait())
+        # Fail fast if PowerShell does not start
+        await self.run('$null')
+        return self
+
+    async def _wait(self):
+        try:
+            await self.process
+            error = ConnectionError(f'PowerShell session on {self.machine.name} exited')
+        except Exception as e:
+            error = ConnectionError(f'PowerShell session on {self.machine.name} failed: {e}')
+        self.closed = True
+        for future in self.pending.values():
+            if not future.done(): future.set_exception(error)
+        self.pending.clear()
+
+    def _dispatch(self, line):
+        if not line.startswith(result_marker):
+            logger.debug('%s: %s', self.machine.name, line.rstrip())
+            return
+        response = json.loads(line[len(result_marker):])
+        future = self.pending.pop(response['id'], None)
+        output = response['output']
+        if output is None:
+            output = []
+        elif not isinstance(output, list):
+            # ConvertTo-Json unrolls single element arrays
+            output = [output]
+        if future and not future.done():
+            future.set_result(RemoteResult(
+                output=output,
+                errors=response['errors'] or [],
+                exit_code=response['exit_code'],
+                success=response['success']))
+
+    def _send(self, op, **request) -> asyncio.Future:
+        if self.closed:
+            raise ConnectionError(f'PowerShell session on {self.machine.name} is closed')
+        id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[id] = future
+        self.requests.put(json.dumps(dict(id=id, op=op, **request))+'\n')
+        return future
+
+    def _send_script(self, script):
+        return self._send('run', script=base64.b64encode(script.encode()).decode('ascii'))
+
+    async def run(self, script:str, *, check=True, timeout=None) -> RemoteResult:
+        '''
+        Run *script*.
+
+        :param check: Raise :class:`RemoteCommandFailed` unless the script succeeds.
+        '''
+        result = await asyncio.wait_for(self._send_script(script), timeout)
+        if check and not result.success:
+            raise RemoteCommandFailed(script, result)
+        return result
+
+    async def run_batch(self, scripts, *, check=True, timeout=None) -> list[RemoteResult]:
+        '''
+        Send every script in *scripts* without waiting for results, then collect them.  One round trip is paid for the whole batch.  With *check*, the first failure is raised once all have finished.
+        '''
+        futures = [self._send_script(s) for s in scripts]
+        results = await asyncio.wait_for(asyncio.gather(*futures), timeout)
+        if check:
+            for script, result in zip(scripts, results):
+                if not result.success: raise RemoteCommandFailed(script, result)
+        return results
+
+    async def put(self, local:Path, remote:str):
+        '''
+        Copy the file *local* to *remote* in the guest.
+        '''
+        futures = []
+        with open(local, 'rb') as f:
+            offset = 0
+            while data := f.read(transfer_chunk):
+                futures.append(self._send(
+                    'put', path=remote, offset=offset, data=base64.b64encode(data).decode('ascii')))
+                offset += len(data)
+            if not futures:
+                futures.append(self._send('put', path=remote, offset=0, data=''))
+        for result in await asyncio.gather(*futures):
+            if not result.success: raise RemoteCommandFailed(f'put {remote}', result)
+
+    async def get(self, remote:str, local:Path):
+        '''
+        Copy the file *remote* in the guest to *local*.
+        '''
+        result = await self._send('get', path=remote)
+        if not result.success: raise RemoteCommandFailed(f'get {remote}', result)
+        Path(local).write_bytes(base64.b64decode(result.output[0]))
+
+    async def close(self):
+        self.closed = True
+        if self.process is None: return
+        self.requests.put(None)
+        await self.waiter
+
+__all__ += ['PowerShellSession']
+
+class PowerShellPool:
+
+    '''
+    Up to *size* :class:`PowerShellSession` on *machine*, shared by concurrent tasks.  Sessions are started when first needed and reused; a session whose connection fails is discarded.
+    '''
+
+    def __init__(self, machine, size=2):
+        self.machine = machine
+        self.size = size
+        self.idle = []
+        self.sessions = 0
+        self.available = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        '''
+        An asynchronous context manager yielding a :class:`PowerShellSession` for the exclusive use of the caller.
+        '''
+        async with self.available:
+            await self.available.wait_for(lambda: self.idle or self.sessions < self.size)
+            if self.idle:
+                session = self.idle.pop()
+            else:
+                session = None
+                self.sessions += 1
+        try:
+            if session is None:
+                session = PowerShellSession(self.machine)
+                try:
+                    await session.start()
+                except BaseException:
+                    await session.close()
+                    raise
+            yield session
+        finally:
+            self._return(session)
+
+    def _return(self, session):
+        async def return_session():
+            async with self.available:
+                if session.closed:
+                    self.sessions -= 1
+                else:
+                    self.idle.append(session)
+                self.available.notify()
+        asyncio.ensure_future(return_session())
+
+    async def run(self, script, **kwargs) -> RemoteResult:
+        async with self.session() as session:
+            return await session.run(script, **kwargs)
+
+    async def run_batch(self, scripts, **kwargs) -> list[RemoteResult]:
+        '''
+        Run *scripts* in order in one session; see :meth:`PowerShellSession.run_batch`.
+        '''
+        async with self.session() as session:
+            return await session.run_batch(scripts, **kwargs)
+
+    async def put(self, local, remote):
+        async with self.session() as session:
+            return await session.put(local, remote)
+
+    async def get(self, remote, local):
+        async with self.session() as session:
+            return await session.get(remote, local)
+
+    async def close(self):
+        async with self.available:
+            idle, self.idle = self.idle, []
+            self.sessions -= len(idle)
+        await asyncio.gather(*(s.close() for s in idle))
+
+__all__ += ['PowerShellPool']
+
+_pools = weakref.WeakKeyDictionary()
+
+def powershell_pool(machine, size=2) -> PowerShellPool:
+    '''
+    :returns: The :class:`PowerShellPool` of *machine*, created with *size* sessions on first use.
+    '''
+    try:
+        return _pools[machine]
+    except KeyError:
+        pool = _pools[machine] = PowerShellPool(machine, size)
+        return pool
+
+__all__ += ['powershell_pool']
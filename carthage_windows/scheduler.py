@@ -0,0 +1,168 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Admission control for Windows installs on a build host.
+
+Every Carthage process using the same *windows.image_dir* shares one ledger (``scheduler/ledger.json``, protected by ``flock``) of running and waiting installs.  An install is admitted when the memory, cpus and I/O units it asks for fit in what the host has left, when no better waiting install also fits, and when at least *windows.install_stagger* seconds have passed since the last install started.  Smaller installs may start ahead of a better install that does not fit, but only until the best waiting install has waited :attr:`InstallScheduler.backfill_limit` seconds; then nothing else is admitted until it fits, so it cannot be starved.  Entries left behind by processes that have exited are ignored.
+
+Time spent waiting is recorded as an ``install_queue`` stage in the :class:`~carthage_windows.profiling.BuildProfile`, separately from the ``install`` stage.
+
+'''
+
+import asyncio
+import contextlib
+import dataclasses
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from carthage import *
+from .profiling import BuildProfile
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+@dataclasses.dataclass
+class Reservation:
+
+    name: str
+    memory_mb: int
+    cpus: int
+    #: I/O units; see *windows.install_io_capacity*
+    io: int = 1
+    #: Higher priorities are admitted first; a lower priority install only starts ahead of one that does not fit yet within :attr:`InstallScheduler.backfill_limit`.
+    priority: int = 0
+    pid: int = dataclasses.field(default_factory=os.getpid)
+    queued: float = dataclasses.field(default_factory=time.time)
+    token: str = dataclasses.field(default_factory=lambda: uuid.uuid4().hex)
+
+__all__ += ['Reservation']
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+@inject_autokwargs(
+    config_layout=ConfigLayout,
+    build_profile=BuildProfile,
+    )
+class InstallScheduler(Injectable):
+
+    '''
+    Typical usage::
+
+        async with scheduler.admit(name, memory_mb=16*1024, cpus=4):
+            # run the install
+
+    '''
+
+    #: Seconds between checks while waiting
+    poll_interval = 5
+
+    #: Seconds the best waiting install may wait for capacity while other installs start ahead of it
+    backfill_limit = 10*60
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        windows = self.config_layout.windows
+        self.path = Path(windows.image_dir)/'scheduler'
+        self.path.mkdir(parents=True, exist_ok=True)
+        host_memory_mb = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')//1024**2
+        #: Memory available to installs: the host's, less a fifth for the host itself.
+        self.memory_mb = int(host_memory_mb*0.8)
+        self.cpus = os.cpu_count() or 1
+        self.io = windows.install_io_capacity
+        self.max_installs = windows.max_concurrent_installs
+        self.stagger = windows.install_stagger
+
+    @contextlib.contextmanager
+    def _ledger(self):
+        with open(self.path/'ledger.lock', 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            ledger_path = self.path/'ledger.json'
+            try:
+                state = json.loads(ledger_path.read_text())
+            except (FileNotFoundError, ValueError):
+                state = {}
+            state.setdefault('running', [])
+            state.setdefault('waiting', [])
+            state.setdefault('last_start', 0.0)
+            for k in ('running', 'waiting'):
+                state[k] = [r for r in state[k] if _pid_alive(r['pid'])]
+            yield state
+            tmp = ledger_path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(state, indent=2))
+            tmp.rename(ledger_path)
+
+    def _fits(self, running, r):
+        if not running: return True
+        if self.max_installs and len(running) >= self.max_installs: return False
+        return (sum(x['memory_mb'] for x in running)+r['memory_mb'] <= self.memory_mb
+                and sum(x['cpus'] for x in running)+r['cpus'] <= self.cpus
+                and sum(x['io'] for x in running)+r['io'] <= self.io)
+
+    def _try_admit(self, reservation:Reservation) -> bool:
+        r = dataclasses.asdict(reservation)
+        with self._ledger() as state:
+            if not any(w['token'] == r['token'] for w in state['waiting']):
+                state['waiting'].append(r)
+            running = state['running']
+            if running and time.time()-state['last_start'] < self.stagger:
+                return False
+            def rank(w): return (w['priority'], -w['queued'])
+            head = max(state['waiting'], key=rank)
+            if time.time()-head['queued'] > self.backfill_limit:
+                # Let capacity drain until the head fits
+                candidates = [head] if self._fits(running, head) else []
+            else:
+                candidates = [w for w in state['waiting'] if self._fits(running, w)]
+            if not candidates: return False
+            best = max(candidates, key=rank)
+            if best['token'] != r['token']: return False
+            state['waiting'] = [w for w in state['waiting'] if w['token'] != r['token']]
+            running.append(r)
+            state['last_start'] = time.time()
+            return True
+
+    def _release(self, reservation:Reservation):
+        with self._ledger() as state:
+            for k in ('running', 'waiting'):
+                state[k] = [x for x in state[k] if x['token'] != reservation.token]
+
+    def status(self):
+        '''
+        :returns: The running and waiting reservations on this host.
+        '''
+        with self._ledger() as state:
+            return dict(running=state['running'], waiting=state['waiting'])
+
+    @contextlib.asynccontextmanager
+    async def admit(self, name, *, memory_mb, cpus, io=1, priority=0):
+        reservation = Reservation(name=name, memory_mb=memory_mb, cpus=cpus, io=io, priority=priority)
+        try:
+            async with self.build_profile.stage('install_queue', image=name) as stage:
+                while not await asyncio.to_thread(self._try_admit, reservation):
+                    await asyncio.sleep(self.poll_interval)
+            if stage.duration > self.poll_interval:
+                logger.info('%s waited %.0f seconds to install', name, stage.duration)
+            async with self.build_profile.stage('install', image=name):
+                yield reservation
+        finally:
+            await asyncio.to_thread(self._release, reservation)
+
+__all__ += ['InstallScheduler']
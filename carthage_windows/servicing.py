@@ -0,0 +1,179 @@
+# Copyright (C) 2025, Hadron Industries.
+# Carthage is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# as published by the Free Software Foundation. It is distributed
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the file
+# LICENSE for details.
+
+'''
+Slipstream updates and capability packages into the install image.
+
+*windows.offline_packages* lists globs (which may contain ``{version}``) of ``.msu`` and ``.cab`` files in the assets directory, for example cumulative updates or the ``OpenSSH-Server-Package`` cab from the Features on Demand media.  Each package is prepared once and kept in the :class:`~carthage_windows.cache.AssetCache`: the cab (for an ``.msu``, the cab within it) and the package identity from its ``update.mum``.
+
+:class:`~carthage_windows.cd.NoPromptInstallImage` adds the prepared cabs to every image of ``sources/install.wim`` with ``wimlib-imagex``, under :data:`package_dir`, and the result is cached by the install ISO and the package set.  The autounattend file lists the packages in its ``servicing`` section, so Windows Setup installs them into the applied image in the offlineServicing pass, before the first boot and without network access.  DISM is not available on Linux, so the packages cannot be committed into the component store of the WIM itself.
+
+'''
+
+import asyncio
+import dataclasses
+import json
+import logging
+import tempfile
+import xml.etree.ElementTree as ET
+from pathlib import Path
+import carthage
+from carthage import *
+from carthage import sh
+from .assets import AssetCatalog
+from .bulkcopy import clone_file
+from .cache import AssetCache
+from .fingerprint import Fingerprint
+
+__all__ = []
+
+logger = logging.getLogger('carthage_windows')
+
+#: Where prepared packages are placed within the install image
+package_dir = 'Windows/Setup/Packages'
+
+#: Attributes of ``assemblyIdentity`` carried into the autounattend file
+identity_attributes = ('name', 'version', 'processorArchitecture', 'publicKeyToken', 'language')
+
+@dataclasses.dataclass
+class OfflinePackage:
+
+    #: The ``.msu`` or ``.cab`` in the assets directory
+    source: Path
+    #: Directory holding ``package.cab`` and ``identity.json``
+    prepared: Path
+    #: digest of *source*
+    digest: str
+    identity: dict
+
+    @property
+    def cab_name(self):
+        return self.source.stem+'.cab'
+
+    @property
+    def guest_path(self):
+        '''The package's path in the applied image while Setup runs offlineServicing.'''
+        return 'C:\\'+package_dir.replace('/', '\\')+'\\'+self.cab_name
+
+__all__ += ['OfflinePackage']
+
+async def _extract(archive:Path, member:str, out_dir:Path) -> Path:
+    sevenzip = getattr(carthage.sh, '7z')
+    await sevenzip('e', '-y', '-o'+str(out_dir), '--', str(archive), member, _bg=True, _bg_exc=False)
+    result = out_dir/member
+    if not result.exists():
+        raise ValueError(f'{archive.name} does not contain {member}')
+    return result
+
+async def _members(archive:Path) -> list[str]:
+    sevenzip = getattr(carthage.sh, '7z')
+    result = await sevenzip('l', '-slt', '--', str(archive), _bg=True, _bg_exc=False)
+    return [line[7:] for line in str(result.stdout, 'utf-8').splitlines()[1:]
+            if line.startswith('Path = ')]
+
+def parse_identity(update_mum:str) -> dict:
+    '''
+    :returns: The package identity from the contents of an ``update.mum``.
+    '''
+    root = ET.fromstring(update_mum)
+    for element in root.iter():
+        if element.tag.rpartition('}')[2] == 'assemblyIdentity':
+            return {k: element.get(k) for k in identity_attributes if element.get(k) is not None}
+    raise ValueError('update.mum has no assemblyIdentity')
+
+__all__ += ['parse_identity']
+
+async def prepare_package(source:Path, output:Path):
+    '''
+    Write ``package.cab`` and ``identity.json`` for the ``.msu`` or ``.cab`` *source* into the new directory *output*.
+    '''
+    output.mkdir()
+    with tempfile.TemporaryDirectory(dir=output.parent, prefix='package_') as tmp:
+        tmp = Path(tmp)
+        if source.suffix.lower() == '.msu':
+            cabs = [m for m in await _members(source)
+                    if m.lower().endswith('.cab') and m.lower() != 'wsusscan.cab']
+            if len(cabs) != 1:
+                raise ValueError(f'{source.name} does not contain exactly one package cab; checkpoint updates are not supported')
+            cab = await _extract(source, cabs[0], tmp)
+            cab.rename(output/'package.cab')
+        else:
+            clone_file(source, output/'package.cab', link=False)
+        update_mum = await _extract(output/'package.cab', 'update.mum', tmp)
+        identity = parse_identity(update_mum.read_text(encoding='utf-8-sig'))
+    output.joinpath('identity.json').write_text(json.dumps(identity))
+
+@inject(
+    injector=Injector,
+    asset_catalog=AssetCatalog,
+    )
+def offline_package_assets(windows_version, *, injector, asset_catalog) -> list:
+    '''
+    :returns: The :class:`~carthage_windows.assets.Asset` selected by *windows.offline_packages* for *windows_version*, in the order the globs list them.  Nothing is read or prepared.
+    '''
+    config = injector(ConfigLayout)
+    results = []
+    for pattern in config.windows.offline_packages.split(','):
+        pattern = pattern.strip().format(version=windows_version)
+        if not pattern: continue
+        assets = asset_catalog.find(pattern)
+        if not assets:
+            raise FileNotFoundError(f'No offline package matches {pattern}')
+        for asset in sorted(assets, key=lambda a: a.name):
+            if asset not in results: results.append(asset)
+    return results
+
+__all__ += ['offline_package_assets']
+
+@inject(
+    injector=Injector,
+    asset_cache=AssetCache,
+    )
+async def find_offline_packages(windows_version, *, injector, asset_cache) -> list[OfflinePackage]:
+    '''
+    :returns: The prepared packages selected by *windows.offline_packages* for *windows_version*, in the order the globs list them.
+    '''
+    packages = []
+    for asset in injector(offline_package_assets, windows_version):
+        digest = await asyncio.to_thread(asset.digest)
+        fp = Fingerprint()
+        fp.add('offline_package', digest)
+        prepared = await asset_cache.fetch(
+            fp.hexdigest(), lambda out, source=asset.path: prepare_package(source, out))
+        packages.append(OfflinePackage(
+            source=asset.path, prepared=prepared, digest=digest,
+            identity=json.loads(prepared.joinpath('identity.json').read_text())))
+    return packages
+
+__all__ += ['find_offline_packages']
+
+async def slipstream(wim:Path, packages:list[OfflinePackage]):
+    '''
+    Add *packages* under :data:`package_dir` to every image in *wim*, which is modified in place.
+    '''
+    if wim.suffix.lower() == '.esd':
+        raise ValueError('Cannot slipstream into install.esd; use media with install.wim')
+    info = await sh.wimlib_imagex('info', str(wim), '--header', _bg=True, _bg_exc=False)
+    images = 1
+    for line in str(info.stdout, 'utf-8').splitlines():
+        key, _, value = line.partition('=')
+        if key.strip() == 'Image Count':
+            images = int(value)
+    with tempfile.TemporaryDirectory(dir=wim.parent, prefix='packages_') as staging:
+        staging = Path(staging)
+        for package in packages:
+            clone_file(package.prepared/'package.cab', staging/package.cab_name)
+        for index in range(1, images+1):
+            # Identical contents are stored once in the WIM however many images reference them.
+            await sh.wimlib_imagex(
+                'update', str(wim), str(index),
+                '--command', f'add {staging} /{package_dir}',
+                _bg=True, _bg_exc=False)
+    logger.info('Slipstreamed %d packages into %d images of %s', len(packages), images, wim.name)
+
+__all__ += ['slipstream']
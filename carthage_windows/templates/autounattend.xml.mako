@@ -2,7 +2,30 @@
 <unattend xmlns="urn:schemas-microsoft-com:unattend" xmlns:wcm="http://schemas.microsoft.com/WMIConfig/2002/State">
   <!--https://schneegans.de/windows/unattend-generator/?LanguageMode=Unattended&UILanguage=en-US&Locale=en-US&Keyboard=00000409&GeoLocation=244&ProcessorArchitecture=amd64&BypassRequirementsCheck=true&ComputerNameMode=Custom&ComputerName=windows-base&TimeZoneMode=Implicit&PartitionMode=Unattended&PartitionLayout=GPT&EspSize=300&RecoveryMode=Partition&RecoverySize=1000&WindowsEditionMode=Unattended&WindowsEdition=pro&UserAccountMode=Unattended&AccountName0=Admin&AccountPassword0=blueteam1&AccountGroup0=Administrators&AccountName1=&AccountName2=&AccountName3=&AccountName4=&AutoLogonMode=Own&PasswordExpirationMode=Unlimited&LockoutMode=Default&HideFiles=Hidden&DisableWidgets=true&ClassicContextMenu=true&DisableAppSuggestions=true&VirtIoGuestTools=true&WifiMode=Interactive&ExpressSettings=DisableAll&KeysMode=Skip&WdacMode=Skip-->
   <!-- This configuration has been manually modified since it was auto-generated. to update from the auto generator it is probably best to use those initial settings and diff. -->
-	<settings pass="offlineServicing"></settings>
+        %if not sysprep and wconfig.offline_packages:
+	<!-- Packages slipstreamed into install.wim; see carthage_windows.servicing -->
+	<servicing>
+          %for package in wconfig.offline_packages:
+		<package action="install">
+			<assemblyIdentity ${' '.join(f'{k}="{v}"' for k, v in package.identity.items())} />
+			<source>${package.guest_path}</source>
+		</package>
+          %endfor
+	</servicing>
+        %endif
+	<settings pass="offlineServicing">
+        %if not sysprep and wconfig.driver_injection == 'offline':
+		<component name="Microsoft-Windows-PnpCustomizationsNonWinPE" processorArchitecture="amd64" publicKeyToken="31bf3856ad364e35" language="neutral" versionScope="nonSxS">
+			<DriverPaths>
+                          %for i, path in enumerate(instance.offline_driver_paths, 1):
+				<PathAndCredentials wcm:action="add" wcm:keyValue="${i}">
+					<Path>${path}</Path>
+				</PathAndCredentials>
+                          %endfor
+			</DriverPaths>
+		</component>
+        %endif
+	</settings>
         %if not sysprep:
 	<settings pass="windowsPE">
 		<component name="Microsoft-Windows-International-Core-WinPE" processorArchitecture="amd64" publicKeyToken="31bf3856ad364e35" language="neutral" versionScope="nonSxS">
@@ -201,6 +224,18 @@
 			<ComputerName>windows-base</ComputerName>
 		</component>
 	</settings>
+        %else:
+	<settings pass="specialize">
+		<component name="Microsoft-Windows-Deployment" processorArchitecture="amd64" publicKeyToken="31bf3856ad364e35" language="neutral" versionScope="nonSxS">
+			<RunSynchronous>
+				<!-- Apply a layer if a layer CD is attached; see carthage_windows.layers -->
+				<RunSynchronousCommand wcm:action="add">
+					<Order>1</Order>
+					<Path>powershell.exe -NoProfile -ExecutionPolicy Unrestricted C:\Windows\Setup\layer_hook.ps1 &gt;c:\windows\setup\layer_hook.log *&gt;&amp;1</Path>
+				</RunSynchronousCommand>
+			</RunSynchronous>
+		</component>
+	</settings>
         %endif
 	<settings pass="auditSystem"></settings>
 	<settings pass="auditUser"></settings>
@@ -9,6 +9,7 @@
 import carthage.pytest_plugin
 import pytest
 from pathlib import Path
+import xml.etree.ElementTree as ET
 from carthage import *
 from carthage.modeling import *
 from carthage_windows import *
@@ -40,6 +41,10 @@ class layout(carthage_windows.layout.layout):
     class vm_1(MachineModel):
         add_provider(machine_implementation_key, dependency_quote(carthage.vm.Vm))
         ssh_login_user = 'admin'
+
+    class vm_clone(WindowsCloneModel):
+        add_provider(machine_implementation_key, dependency_quote(carthage.vm.Vm))
+        ssh_login_user = 'admin'
         
 
 
@@ -65,4 +70,581 @@ async def test_use_image(ainjector):
                 await vm.ssh('powershell ls')
         finally:
             await vm.delete()
-            
+
+@async_test
+async def test_clone_image(ainjector):
+    l = await ainjector(layout)
+    ainjector = l.ainjector
+    with TestTiming(32*60):
+        await l.image.async_become_ready()
+    with TestTiming(10*60):
+        vm =l.vm_clone.machine
+        try:
+            async with vm.machine_running():
+                await vm.ssh('hostname')
+        finally:
+            await vm.delete()
+
+
+def test_file_digest_ignores_mtime(tmp_path):
+    from carthage_windows.fingerprint import file_digest, path_digest
+    import os
+    f = tmp_path/'a'
+    f.write_text('contents')
+    digest = file_digest(f)
+    os.utime(f, (1, 1))
+    assert file_digest(f) == digest
+    f.write_text('changed')
+    assert file_digest(f) != digest
+    assert path_digest(tmp_path) != digest
+
+def test_member_selected():
+    from carthage_windows.cd import member_selected
+    patterns = ['NetKVM/w11/amd64', 'guest-agent/*.msi']
+    assert member_selected('NetKVM/w11/amd64/netkvm.sys', patterns)
+    assert not member_selected('NetKVM/w10/amd64/netkvm.sys', patterns)
+    assert member_selected('guest-agent/qemu-ga-x86_64.msi', patterns)
+    assert not member_selected('virtio-win-gt-x64.msi', patterns)
+
+@async_test
+async def test_asset_cache_builds_once(ainjector, tmp_path):
+    from carthage_windows.cache import AssetCache
+    config = ainjector.get_instance(ConfigLayout)
+    image_dir = config.windows.image_dir
+    config.windows.image_dir = str(tmp_path/'images')
+    try:
+        cache = await ainjector(AssetCache)
+    finally:
+        config.windows.image_dir = image_dir
+    builds = 0
+    async def build(output):
+        nonlocal builds
+        builds += 1
+        output.write_text('artifact')
+    for dest in ('a', 'b'):
+        await cache.fetch('key', build, tmp_path/dest)
+    assert builds == 1
+    assert (tmp_path/'a').stat().st_ino == (tmp_path/'b').stat().st_ino
+    assert (tmp_path/'a').stat().st_mode & 0o222 == 0
+    obj = await cache.fetch('key', build, tmp_path/'c', writable=True)
+    assert (tmp_path/'c').stat().st_ino != obj.stat().st_ino
+    (tmp_path/'c').write_text('changed')
+    assert obj.read_text() == 'artifact'
+
+@async_test
+async def test_bulk_copy(tmp_path):
+    from carthage_windows.bulkcopy import bulk_copy
+    src = tmp_path/'src'
+    src.joinpath('amd64').mkdir(parents=True)
+    src.joinpath('amd64/netkvm.inf').write_text('inf')
+    src.joinpath('setup.msi').write_text('msi')
+    dest = tmp_path/'dest'
+    stats = await bulk_copy([
+        (src/'setup.msi', dest/'oem'),
+        (f'{src}/amd64/', dest/'drivers'),
+        (src/'amd64', dest/'tree'),
+        ])
+    assert stats.files == 3
+    assert dest.joinpath('oem/setup.msi').read_text() == 'msi'
+    assert dest.joinpath('drivers/netkvm.inf').exists()
+    assert dest.joinpath('tree/amd64/netkvm.inf').exists()
+    stats = await bulk_copy([(src/'setup.msi', tmp_path/'unlinked')], link=False)
+    assert tmp_path.joinpath('unlinked/setup.msi').stat().st_ino != src.joinpath('setup.msi').stat().st_ino
+
+def test_guest_event_parse():
+    from carthage_windows.guest_channel import GuestEvent
+    event = GuestEvent.parse('\x1b[0mCARTHAGE-EVENT 1700000000500 firstlogon finish exit 0\r\n')
+    assert event.timestamp == 1700000000.5
+    assert (event.phase, event.event, event.detail) == ('firstlogon', 'finish', 'exit 0')
+    assert GuestEvent.parse('Windows Boot Manager') is None
+
+@async_test
+async def test_build_profile_trace(ainjector):
+    from carthage_windows.profiling import BuildProfile
+    profile = await ainjector(BuildProfile)
+    async with profile.stage('extract_cd') as stage:
+        stage.bytes = 10
+    trace = profile.to_chrome_trace()
+    assert trace['traceEvents'][0]['name'] == 'extract_cd'
+    assert trace['traceEvents'][0]['args']['bytes'] == 10
+
+def test_monitored_script_reports_steps():
+    from carthage_windows.guest_channel import monitored_script
+    script = monitored_script('firstlogon', ['msiexec /i foo.msi /qn', 'Write-Output done'])
+    assert "Send-CarthageEvent firstlogon step-start '0 msiexec /i foo.msi /qn'" in script
+    assert 'Send-CarthageEvent firstlogon step-finish "1 $CarthageStatus"' in script
+    assert script.index('step-start') < script.index('msiexec') < script.index('step-finish')
+
+def test_layer_scripts_resysprep():
+    from carthage_windows.layers import LayerCd
+    wconfig = WindowsConfig('w11')
+    install_msi(wconfig, Path('/assets/app.msi'))
+    scripts = LayerCd.layer_scripts(wconfig)
+    assert 'AutoAdminLogon' in scripts['layer.ps1']
+    firstlogon = scripts['firstlogon.ps1']
+    assert firstlogon.index('app.msi') < firstlogon.index('sysprep /generalize')
+
+def test_machine_scripts_do_not_generalize():
+    from carthage_windows.layers import LayerCd
+    scripts = LayerCd.layer_scripts(WindowsConfig('w11'), generalize=False, prepare=["Rename-Computer -NewName 'vm-1' -Force"])
+    assert list(scripts) == ['layer.ps1']
+    assert 'Rename-Computer' in scripts['layer.ps1']
+    assert 'sysprep' not in scripts['layer.ps1']
+
+def test_machine_settings():
+    from types import SimpleNamespace
+    from carthage_windows.clone import MachineConfigCd
+    cd = SimpleNamespace(computer_name='win-1')
+    base = WindowsConfig('w11')
+    settings = MachineConfigCd.machine_settings(cd, WindowsConfig('w11'), base)
+    assert settings == ["Rename-Computer -NewName 'win-1' -Force"]
+    machine = WindowsConfig('w11', product_key=generic_product_keys[('w11', 'enterprise')])
+    settings = MachineConfigCd.machine_settings(cd, machine, base)
+    assert settings[-1].endswith('/ipk '+machine.product_key)
+
+@async_test
+async def test_config_builder_order_and_memo(ainjector):
+    import asyncio
+    applied = []
+    class slow(WinConfigPlugin):
+        name = 'b_slow'
+        independent = True
+        async def inputs(self): return []
+        async def apply(self, wconfig):
+            applied.append(self.name)
+            await asyncio.sleep(0.01)
+            wconfig.firstlogon_powershell.append('b')
+    class fast(WinConfigPlugin):
+        name = 'a_fast'
+        independent = True
+        async def inputs(self): return []
+        async def apply(self, wconfig):
+            applied.append(self.name)
+            wconfig.firstlogon_powershell.append('a')
+            wconfig.enable_sshd = False
+    injector = ainjector.injector(Injector)
+    injector.add_provider(slow)
+    injector.add_provider(fast)
+    builder = await ainjector.get_instance_async(WindowsConfigBuilder)
+    for i in range(2):
+        config = await builder.build(WindowsConfig('w11'), injector(AsyncInjector), stop_at=injector)
+        assert config.firstlogon_powershell == ['a', 'b']
+        assert config.enable_sshd is False
+    assert sorted(applied) == ['a_fast', 'b_slow']
+
+@async_test
+async def test_config_builder_input_stamp(ainjector, tmp_path):
+    applied = []
+    class watched(WinConfigPlugin):
+        name = 'watched'
+        independent = True
+        async def inputs(self): return [tmp_path/'input']
+        async def apply(self, wconfig):
+            applied.append(self.name)
+    injector = ainjector.injector(Injector)
+    injector.add_provider(watched)
+    builder = await ainjector.get_instance_async(WindowsConfigBuilder)
+    before = await builder.input_stamp(injector(AsyncInjector), stop_at=injector)
+    assert before == await builder.input_stamp(injector(AsyncInjector), stop_at=injector)
+    tmp_path.joinpath('input').write_text('changed')
+    assert before != await builder.input_stamp(injector(AsyncInjector), stop_at=injector)
+    assert applied == []
+    class unreported(WinConfigPlugin):
+        name = 'unreported'
+    injector.add_provider(unreported)
+    assert await builder.input_stamp(injector(AsyncInjector), stop_at=injector) is None
+
+def test_payload_stamp(tmp_path):
+    oem = tmp_path/'oem.ps1'
+    oem.write_text('first')
+    drivers = tmp_path/'drivers'
+    drivers.mkdir()
+    payloads = [str(oem), str(drivers)]
+    before = LibvirtWindowsBaseImage.payload_stamp('inputs', payloads)
+    assert before == LibvirtWindowsBaseImage.payload_stamp('inputs', payloads)
+    assert before != LibvirtWindowsBaseImage.payload_stamp('other', payloads)
+    drivers.joinpath('viostor.inf').write_text('driver')
+    after_driver = LibvirtWindowsBaseImage.payload_stamp('inputs', payloads)
+    assert after_driver != before
+    oem.write_text('second edit')
+    assert LibvirtWindowsBaseImage.payload_stamp('inputs', payloads) != after_driver
+
+@async_test
+async def test_asset_catalog_newest(ainjector, tmp_path):
+    import os
+    config = ainjector.get_instance(ConfigLayout)
+    assets_dir = config.windows.assets_dir
+    config.windows.assets_dir = str(tmp_path)
+    try:
+        windows = tmp_path/'windows'
+        windows.mkdir()
+        for name in ('virtio-win-0.1.96.iso', 'virtio-win-0.1.262.iso'):
+            windows.joinpath(name).write_text(name)
+        catalog = await ainjector(AssetCatalog)
+        assert catalog.newest('virtio-*.iso').name == 'virtio-win-0.1.262.iso'
+        windows.joinpath('virtio-win-0.1.271.iso').write_text('new')
+        # Make sure the directory mtime changes even on coarse timestamp filesystems
+        os.utime(windows, ns=(0, catalog.root_mtime+1))
+        assert catalog.newest('virtio-*.iso').name == 'virtio-win-0.1.271.iso'
+        assert find_asset('nvda_*.exe', catalog=catalog) is None
+    finally:
+        config.windows.assets_dir = assets_dir
+
+@async_test
+async def test_matrix_entry_injectors(ainjector, tmp_path):
+    config = ainjector.get_instance(ConfigLayout)
+    image_dir = config.windows.image_dir
+    config.windows.image_dir = str(tmp_path)
+    class images(WindowsImageMatrix):
+        entries = [
+            MatrixEntry('w11'),
+            MatrixEntry('w11', 'enterprise'),
+            MatrixEntry('2k25', 'standard'),
+            MatrixEntry('2k19', 'standard', iso_pattern='en-us_server_2019*.iso'),
+            MatrixEntry('w12', product_key='XXXXX-XXXXX-XXXXX-XXXXX-XXXXX'),
+        ]
+    try:
+        matrix = await ainjector(images)
+        assert matrix.windows_versions == ['2k19', '2k25', 'w11', 'w12']
+        patterns = {}
+        for entry in images.entries:
+            injector = matrix.entry_injector(entry)
+            assert injector.get_instance(InjectionKey(MatrixEntry)) is entry
+            assert injector.get_instance(windows_version_key) == entry.windows_version
+            noprompt = await injector(AsyncInjector).get_instance_async(
+                InjectionKey(NoPromptInstallImage, _ready=False))
+            assert noprompt.stamp_subdir.endswith('/'+entry.name)
+            try:
+                patterns[entry.name] = noprompt.base_cd_pattern
+            except ValueError:
+                patterns[entry.name] = None
+    finally:
+        config.windows.image_dir = image_dir
+    assert patterns == {
+        'windows_w11_pro': 'Win11*.iso',
+        'windows_w11_enterprise': 'Win11*.iso',
+        'windows_2k25_standard': '*[Ss]erver*2025*.iso',
+        'windows_2k19_standard': 'en-us_server_2019*.iso',
+        'windows_w12_pro': None,
+    }
+
+def test_matrix_entry_defaults():
+    from carthage_windows.qemu import driver_version_str
+    entry = MatrixEntry('2k22', 'standard')
+    assert entry.name == 'windows_2k22_standard'
+    assert entry.product_key == generic_product_keys[('2k22', 'standard')]
+    assert MatrixEntry('2k25', 'datacenter').product_key == 'D764K-2NDRG-47T6Q-P8T8W-YP6DF'
+    # Server versions have no pro edition
+    with pytest.raises(ValueError):
+        MatrixEntry('2k22')
+    assert driver_version_str('2k22') == '2k22'
+
+@async_test
+async def test_install_scheduler_admission(ainjector, tmp_path):
+    import asyncio
+    config = await ainjector.get_instance_async(ConfigLayout)
+    image_dir = config.windows.image_dir
+    config.windows.image_dir = str(tmp_path)
+    try:
+        scheduler = await ainjector(InstallScheduler)
+        scheduler.memory_mb, scheduler.cpus, scheduler.stagger = 1024, 8, 0
+        scheduler.poll_interval = 0.01
+        order = []
+        async def install(name, priority=0):
+            async with scheduler.admit(name, memory_mb=1024, cpus=1, priority=priority):
+                order.append(name)
+                await asyncio.sleep(0.05)
+        first = asyncio.ensure_future(install('first'))
+        await asyncio.sleep(0.02)
+        await asyncio.gather(first, install('low'), install('high', priority=1))
+        assert order == ['first', 'high', 'low']
+        assert scheduler.status() == dict(running=[], waiting=[])
+        # A large install that has waited past backfill_limit is not starved by smaller ones
+        scheduler.memory_mb, scheduler.backfill_limit = 2048, 0
+        small = Reservation('small', memory_mb=1024, cpus=1)
+        large = Reservation('large', memory_mb=2048, cpus=1, priority=1)
+        later = Reservation('later', memory_mb=1024, cpus=1)
+        assert scheduler._try_admit(small)
+        assert not scheduler._try_admit(large)
+        assert not scheduler._try_admit(later)
+        scheduler._release(small)
+        assert not scheduler._try_admit(later)
+        assert scheduler._try_admit(large)
+        scheduler._release(large)
+        scheduler._release(later)
+    finally:
+        config.windows.image_dir = image_dir
+
+def test_offline_driver_injection_template():
+    import types
+    from carthage_windows.cd import AutoUnattendCd
+    template = AutoUnattendCd.autounattend_xml.lookup.get_template('autounattend.xml.mako')
+    instance = types.SimpleNamespace(offline_driver_paths=['E:\\$WinPEDriver$'])
+    wconfig = WindowsConfig('w11')
+    assert 'PnpCustomizationsNonWinPE' not in template.render(instance=instance, wconfig=wconfig, sysprep=False)
+    wconfig.driver_injection = 'offline'
+    rendered = template.render(instance=instance, wconfig=wconfig, sysprep=False)
+    assert '<Path>E:\\$WinPEDriver$</Path>' in rendered
+    assert 'PnpCustomizationsNonWinPE' not in template.render(instance=instance, wconfig=wconfig, sysprep=True)
+
+def test_raw_manifest_skips_holes_and_zeros(tmp_path):
+    from carthage_windows.export import chunk_size, raw_manifest
+    image = tmp_path/'image.raw'
+    with image.open('wb') as f:
+        f.truncate(8*chunk_size)
+        for chunk in (1, 5):
+            f.seek(chunk*chunk_size)
+            f.write(b'windows')
+        f.seek(3*chunk_size)
+        f.write(bytes(chunk_size))
+    manifest = raw_manifest(image)
+    assert manifest['size'] == 8*chunk_size
+    assert [offset for offset, _ in manifest['chunks']] == [chunk_size, 5*chunk_size]
+    assert manifest['distinct_chunks'] == 1
+
+@async_test
+async def test_pull_reuses_local_chunks(tmp_path):
+    import random
+    from carthage_windows.distribution import manifest_path
+    rand = random.Random(1)
+    image = tmp_path/'build/image.raw'
+    image.parent.mkdir()
+    data = bytearray(rand.randbytes(32*1024**2))
+    image.write_bytes(data)
+    store = tmp_path/'store'
+    publish(image, store, 'windows_base')
+    dest = tmp_path/'node/image.raw'
+    stats = await pull(store_manifest(store, 'windows_base', 'image.raw'), dest)
+    assert dest.read_bytes() == data and stats.reused == 0
+    # Change a little in the middle and pull again
+    data[16*1024**2:16*1024**2+10] = b'0123456789'
+    image.write_bytes(data)
+    publish(image, store, 'windows_base')
+    # Another image's file of the same name does not replace the manifest
+    other = tmp_path/'other/image.raw'
+    other.parent.mkdir()
+    other.write_bytes(bytes(4096))
+    publish(other, store, 'windows_other')
+    stats = await pull(store_manifest(store, 'windows_base', 'image.raw'), dest)
+    assert dest.read_bytes() == data
+    assert stats.fetched <= 8*1024**2 and stats.reused >= 24*1024**2
+    assert manifest_path(dest).exists()
+    # A corrupt chunk fails the pull and leaves nothing behind
+    for chunk in store.glob('chunks/*/*'):
+        chunk.write_bytes(b'corrupt')
+    with pytest.raises(ValueError):
+        await pull(store_manifest(store, 'windows_base', 'image.raw'), tmp_path/'fresh/image.raw')
+    assert list(tmp_path.joinpath('fresh').iterdir()) == []
+
+def test_pool_restore_xml():
+    xml = """<domain type='kvm'><name>test-0</name><devices>
+<disk type='file' device='disk'><driver name='qemu' type='raw'/><source file='/vm/test-0.qcow2' index='1'/>
+<backingStore type='file'><source file='/vm/base.raw'/></backingStore><target dev='vda'/></disk>
+<disk type='file' device='cdrom'><source file='/vm/config.iso'/><target dev='sda'/></disk>
+</devices></domain>"""
+    root = ET.fromstring(WindowsVmPool.restore_xml(xml, Path('/vm/warm/work.qcow2')))
+    disk, cdrom = root.iterfind('devices/disk')
+    assert disk.find('source').attrib == {'file': '/vm/warm/work.qcow2'}
+    assert disk.find('backingStore') is None
+    assert disk.find('driver').get('type') == 'qcow2'
+    assert cdrom.find('source').get('file') == '/vm/config.iso'
+
+@async_test
+async def test_pool_lease_failures(ainjector):
+    import asyncio, types
+    class pool(WindowsVmPool):
+        size = 1
+        broken = False
+        async def make_slot(self, index):
+            return types.SimpleNamespace(name=f'slot-{index}')
+        async def warm_slot(self, machine): pass
+        async def reset(self, machine):
+            if self.broken: raise RuntimeError('reset failed')
+        async def restore(self, machine, *, paused): pass
+        async def activate(self, machine): pass
+    instance = await ainjector(pool)
+    await instance.start()
+    async with instance.lease() as machine:
+        assert machine.name == 'slot-0'
+        instance.broken = True
+        waiting = asyncio.ensure_future(instance.lease().__aenter__())
+        await asyncio.sleep(0)
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(waiting, 5)
+    with pytest.raises(RuntimeError):
+        async with instance.lease(): pass
+    assert (instance.metrics.hits, instance.metrics.misses) == (1, 0)
+    assert len(instance.failures) == 1
+
+def test_pool_metrics_summary():
+    metrics = PoolMetrics(hits=3, misses=1, lease_latency=[0.5, 0.1, 0.2, 30.0])
+    summary = metrics.summary()
+    assert summary['leases'] == 4
+    assert summary['latency_p50'] == 0.5
+    assert summary['latency_max'] == 30.0
+    assert PoolMetrics().summary()['latency_p95'] == 0.0
+
+def test_benchmark_compare(tmp_path):
+    import random
+    from carthage_windows.benchmark import compare, make_tree
+    make_tree(tmp_path, 4*1024**2, 10, random.Random(0))
+    assert len(list(tmp_path.rglob('*.dll'))) == 9
+    baseline = dict(wall_time=10.0, peak_disk_bytes=100, stages=dict(repack_noprompt=dict(duration=4.0)))
+    result = dict(wall_time=10.5, peak_disk_bytes=100, stages=dict(
+        repack_noprompt=dict(duration=6.0), plugin_apply=dict(duration=1.0)))
+    regressions = compare(result, baseline)
+    assert len(regressions) == 1 and regressions[0].startswith('repack_noprompt')
+
+def test_parallel_scriptlets_run_as_jobs():
+    from carthage_windows.guest_channel import monitored_script
+    wconfig = WindowsConfig('w11')
+    install_msi(wconfig, Path('/assets/a.msi'))
+    wconfig.firstlogon_powershell.append(Scriptlet('tool.exe /S', name='tool', after=['a.msi'], parallel=True))
+    wconfig.firstlogon_powershell.append('Write-Output done')
+    script = monitored_script('firstlogon', wconfig.firstlogon_powershell)
+    assert script.count('Start-Job') == 2
+    assert "Mutex $false, 'Global\\Carthage-msiexec'" in script
+    # tool waits for step 0 (a.msi); the plain step waits for every job
+    assert 'Test-Path "$CarthageSteps\\0"' in script
+    assert script.rindex('Wait-CarthageJobs', 0, script.index('Write-Output done')) > script.index('tool.exe')
+    with pytest.raises(ValueError):
+        monitored_script('firstlogon', [Scriptlet('x', after=['missing'], parallel=True)])
+
+def test_virtiofs_payloads_bootstrap_first(tmp_path):
+    import functools, types
+    from carthage_windows.cd import AutoUnattendCd
+    cd = types.SimpleNamespace(virtiofs_payloads=True, checkpoints=False, stamp_path=tmp_path,
+                               virtiofs_bootstrap=AutoUnattendCd.virtiofs_bootstrap)
+    cd.on_cd = functools.partial(AutoUnattendCd.on_cd, cd)
+    wconfig = WindowsConfig('w11')
+    install_msi(wconfig, Path('/oem/spice-vdagent-x64.msi'))
+    install_msi(wconfig, Path('/oem/virtio-win-gt-x64.msi'))
+    install_msi(wconfig, Path('/assets/winfsp-2.0.msi'))
+    prepared = AutoUnattendCd.prepare_config(cd, wconfig)
+    names = [getattr(s, 'name', None) for s in prepared.firstlogon_powershell]
+    assert names[:4] == ['virtio-win-gt-x64.msi', 'winfsp-2.0.msi', 'payloads', 'spice-vdagent-x64.msi']
+    assert [f.name for f in prepared.oem_files if not cd.on_cd(f)] == ['spice-vdagent-x64.msi']
+    del wconfig.firstlogon_powershell[-1]
+    with pytest.raises(ValueError):
+        AutoUnattendCd.prepare_config(cd, wconfig)
+
+def test_offline_packages_in_servicing_section(tmp_path):
+    import types
+    from carthage_windows.cd import AutoUnattendCd
+    identity = parse_identity('''<?xml version="1.0" encoding="UTF-8"?>
+<assembly xmlns="urn:schemas-microsoft-com:asm.v3" manifestVersion="1.0">
+  <assemblyIdentity name="OpenSSH-Server-Package" version="10.0.22621.1" processorArchitecture="amd64" language="neutral" publicKeyToken="31bf3856ad364e35" buildType="release"/>
+</assembly>''')
+    assert identity == dict(name='OpenSSH-Server-Package', version='10.0.22621.1', processorArchitecture='amd64',
+                            publicKeyToken='31bf3856ad364e35', language='neutral')
+    package = OfflinePackage(source=Path('/assets/OpenSSH-Server-Package~amd64.cab'),
+                             prepared=tmp_path, digest='0', identity=identity)
+    wconfig = WindowsConfig('w11', offline_packages=[package])
+    template = AutoUnattendCd.autounattend_xml.lookup.get_template('autounattend.xml.mako')
+    instance = types.SimpleNamespace(offline_driver_paths=[])
+    rendered = template.render(instance=instance, wconfig=wconfig, sysprep=False)
+    assert '<source>C:\\Windows\\Setup\\Packages\\OpenSSH-Server-Package~amd64.cab</source>' in rendered
+    assert '<servicing>' not in template.render(instance=instance, wconfig=wconfig, sysprep=True)
+
+@async_test
+async def test_powershell_session_matches_results():
+    import asyncio, base64, json, types
+    from carthage_windows.remoting import result_marker
+    session = PowerShellSession(types.SimpleNamespace(name='vm'))
+    futures = [session._send_script('Get-Date'), session._send_script('cmd /c exit 3')]
+    requests = [json.loads(session.requests.get()) for _ in futures]
+    assert base64.b64decode(requests[0]['script']).decode() == 'Get-Date'
+    session._dispatch('Write-Host noise\n')
+    session._dispatch(result_marker+' '+json.dumps(dict(
+        id=requests[1]['id'], output=None, errors=[], exit_code=3, success=False)))
+    session._dispatch(result_marker+' '+json.dumps(dict(
+        id=requests[0]['id'], output='today', errors=[], exit_code=None, success=True)))
+    first, second = await asyncio.gather(*futures)
+    assert first.output == ['today'] and first.success
+    assert second.exit_code == 3 and not second.success
+    assert str(RemoteCommandFailed('cmd /c exit 3', second)) == 'cmd /c exit 3: exit code 3'
+
+def test_set_disk_io(tmp_path):
+    from carthage_windows.cd import set_disk_io
+    config = tmp_path/'vm.xml'
+    config.write_text('''<domain><!-- layout --><devices>
+<disk type='file' device='disk'><driver name='qemu' type='raw' cache='unsafe' discard='unmap'/></disk>
+<disk type='file' device='cdrom'><driver name='qemu' type='raw' cache='unsafe' discard='unmap'/></disk>
+<filesystem type='mount'><driver type='virtiofs'/></filesystem>
+</devices></domain>''')
+    set_disk_io(config, 'io_uring')
+    result = config.read_text()
+    assert result.count("io=\"io_uring\"") == 2 and '<!-- layout -->' in result
+    assert '<driver type="virtiofs" />' in result
+
+def test_install_checkpoints_valid_prefix(tmp_path):
+    checkpoints = InstallCheckpoints(tmp_path)
+    layer = tmp_path/'base.qcow2'
+    for phase in phases:
+        layer.touch()
+        tmp_path.joinpath(f'{phase}.mem').touch()
+        checkpoints.entries.append(dict(phase=phase, key=f'{phase}-key', layer=str(layer), memory=str(tmp_path/f'{phase}.mem')))
+        layer = tmp_path/f'{phase}.qcow2'
+    checkpoints.save()
+    keys = {phase: f'{phase}-key' for phase in phases}
+    assert [e['phase'] for e in InstallCheckpoints(tmp_path).valid(keys)] == list(phases)
+    keys['specialize'] = 'changed specialize script'
+    assert [e['phase'] for e in checkpoints.valid(keys)] == ['setup']
+    tmp_path.joinpath('setup.mem').unlink()
+    assert checkpoints.valid(keys) == []
+    launcher = phase_launcher('specialize', 'firstlogon_body.ps1')
+    assert launcher.index('function Send-CarthageEvent') < launcher.index("Send-CarthageEvent specialize checkpoint") < launcher.index('carthage-checkpoint-specialize') < launcher.index('Copy-Item')
+    config = tmp_path/'domain.xml'
+    config.write_text("<domain><devices><disk device='cdrom'><source file='a.iso'/><target dev='hdb'/></disk>"
+                      "<disk device='cdrom'><target dev='hdd'/></disk></devices></domain>")
+    assert checkpoint_target(config) == 'hdd'
+
+@async_test
+async def test_layer_installs_on_its_overlay(ainjector, tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    import carthage.sh
+    config = ainjector.get_instance(ConfigLayout)
+    saved = (config.windows.image_dir, config.windows.build_scratch_dir, config.windows.install_checkpoints)
+    config.windows.image_dir = str(tmp_path/'images')
+    config.windows.build_scratch_dir = str(tmp_path/'scratch')
+    config.windows.install_checkpoints = True
+    created = {}
+    async def qemu_img(command, *args, **kwargs):
+        assert command == 'create'
+        path = Path(args[-1])
+        created[path] = args
+        path.write_text('qcow2')
+    monkeypatch.setattr(carthage.sh, 'qemu_img', qemu_img, raising=False)
+    base = SimpleNamespace(path=tmp_path/'windows_base.raw', qemu_format='raw')
+    install_disks = []
+    class layer(LibvirtWindowsLayerImage):
+        name = 'test_layer'
+        base_key = InjectionKey('test_layer_base')
+        async def _build_image(self):
+            install_disks.append(Path(self.qemu_config({})['path']))
+    try:
+        injector = ainjector.injector(Injector)
+        injector.add_provider(InjectionKey('test_layer_base'), base)
+        with instantiation_not_ready():
+            image = await injector(AsyncInjector)(layer)
+        await image.find()
+        await image.do_create()
+    finally:
+        config.windows.image_dir, config.windows.build_scratch_dir, config.windows.install_checkpoints = saved
+    assert install_disks == [image.path]
+    assert '-b'+str(base.path) in created[image.path] and '-Fraw' in created[image.path]
+    assert not tmp_path.joinpath('scratch').exists() or not any(tmp_path.joinpath('scratch').iterdir())
+
+def test_install_id_changes_with_the_image(tmp_path):
+    from types import SimpleNamespace
+    image = tmp_path/'windows_base.raw'
+    image.write_text('first install')
+    stamps = {}
+    base = SimpleNamespace(path=image, check_stamp=lambda s: (1.0, stamps[s]) if s in stamps else (False, ''))
+    pulled = LibvirtWindowsBaseImage.install_id(base)
+    # Pulled again: a new file replaces the image
+    tmp_path.joinpath('pulling').write_text('first install')
+    tmp_path.joinpath('pulling').rename(image)
+    assert LibvirtWindowsBaseImage.install_id(base) != pulled
+    stamps['windows_install'] = 'abc'
+    assert LibvirtWindowsBaseImage.install_id(base) == 'abc'